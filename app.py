@@ -1,12 +1,35 @@
 # import required libraries 
 import os
 import sqlite3
-from flask import Flask, render_template, request, redirect,flash, url_for, session
+from flask import Flask, render_template, request, redirect,flash, url_for, session, jsonify, Response, stream_with_context
 from flask_session import Session
 from werkzeug.security import check_password_hash, generate_password_hash
-from helper import get_db_connection, is_delete, admin_exists, login_required, SECRET_KEY
-from datetime import datetime, timedelta
-import traceback, re
+from db_pool import get_pool, get_read_pool, PoolExhausted
+import assets
+import export
+import overdue
+import rollups
+import recommendations
+import duplicates
+import scanner
+import copies
+import stocktake
+import typeahead
+from helper import get_db_connection, close_db_connection, is_delete, admin_exists, login_required, read_only, stream_with_connection, SECRET_KEY
+from datetime import datetime
+import re, io, hmac, time
+import click
+import circulation
+import instrumentation
+from search_index import rebuild_search_index, match_expression
+from pagination import Pager
+from dashboard_counters import read_counters, verify_counters
+from reference_cache import get_reference_lists, reference_cache
+from conditional_get import conditional_get, ENTITIES as CATALOG_ENTITIES
+from fragment_cache import fragment_cache
+from streaming import stream_fragment
+from migrations import migrate, current_version, pending_migrations
+from bulk_import import import_books as bulk_import_books, detect_format, FORMATS as IMPORT_FORMATS, BATCH_SIZE as IMPORT_BATCH_SIZE
 
 
 
@@ -16,12 +39,34 @@ app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY", "fallback_secret_key")
 
 app.config["TEMPLATES_AUTO_RELOAD"] = True
 
+# return pooled database connections at the end of every request
+app.teardown_appcontext(close_db_connection)
+# per-request latency and SQL statistics, served on /metrics
+instrumentation.init_app(app)
+# fingerprinted, precompressed static files on /assets/ and asset_url() for templates
+assets.init_app(app)
 
-conn = get_db_connection()
-if conn:
-    print("Database connection established in app.py")
+
+try:
+    conn = get_db_connection()
+except sqlite3.Error as e:
+    print(f"Failed to connect to the database in app.py: {e}")
 else:
-    print("Failed to connect to the database in app.py")
+    # bring the schema up to date; a no-op unless a migration is pending
+    for version, description in migrate(conn):
+        print(f"Applied migration {version}: {description}")
+    conn.close()
+
+
+# every pooled connection stayed busy for DB_POOL_TIMEOUT seconds: ask the
+# client to retry instead of failing the request with a 500
+@app.errorhandler(PoolExhausted)
+def pool_exhausted(e):
+    app.logger.warning("%s on %s %s", e, request.method, request.path)
+    headers = {'Retry-After': '1'}
+    if request.path.startswith('/api/'):
+        return jsonify(error="The server is busy, try again shortly."), 503, headers
+    return Response("The server is busy, try again shortly.\n", 503, headers, mimetype='text/plain')
     
     
 # route to the home page
@@ -35,7 +80,6 @@ def home():
 def register_admin():
     if admin_exists():
         flash("Admin already exists. Please deactivate the current admin to register a new one.", 403)
-        print(admin_exists())
         return redirect('/')
     
     if request.method == 'POST':
@@ -113,7 +157,6 @@ def change_password():
 
 @app.route('/deactivate_admin', methods=['GET','POST'])
 def deactivate_admin():   
-    print("Inside deactivate_admin route")
 
     admin_id = session.get('admin_id')  # Ensure session has admin_id
 
@@ -152,7 +195,6 @@ def deactivate_admin():
     # Update admin status
     cursor.execute("UPDATE admin SET is_active = 0 WHERE admin_id = ?", (admin_id,))
     conn.commit()  # Ensure changes are saved
-    print("Rows updated:", cursor.rowcount)  # Debugging output
 
     conn.close()
     session.pop('admin_id', None) 
@@ -190,7 +232,6 @@ def login():
             if check_password_hash(admin['password'], password):
                 session['admin_id'] = admin['admin_id']  # Save admin ID in session
                 session['admin_username'] = admin['username']
-                print(session)
                 flash("Login successful!", "success")
                 return redirect('/admin_dashboard')
             else:
@@ -211,6 +252,7 @@ def logout():
 
 # Create the admin_dashboard route
 @app.route('/admin_dashboard', methods=['GET'])
+@read_only
 @login_required
 def admin_dashboard():
 
@@ -221,24 +263,15 @@ def admin_dashboard():
             return redirect('/login')  # Redirect to login if session is missing
         
         conn = get_db_connection()
-        cursor = conn.cursor()
 
         try:
-            # Fetch total number of books in the library
-            cursor.execute("SELECT COUNT(*) AS total_books FROM books")
-            total_books = cursor.fetchone()['total_books']
-
-            # Fetch number of issued books
-            cursor.execute("SELECT COUNT(*) AS books_issued FROM users_record WHERE is_returned = 0")
-            books_issued = cursor.fetchone()['books_issued']
-
-            # Fetch number of returned books
-            cursor.execute("SELECT COUNT(*) AS books_returned FROM users_record WHERE is_returned = 1")
-            books_returned = cursor.fetchone()['books_returned']
-
-            # Fetch total number of users
-            cursor.execute("SELECT COUNT(*) AS members FROM users")
-            members = cursor.fetchone()['members']
+            # Totals are kept up to date by triggers (see dashboard_counters.py):
+            # total books, issued books, returned books and members
+            counters = read_counters(conn)
+            total_books = counters['total_books']
+            books_issued = counters['books_issued']
+            books_returned = counters['books_returned']
+            members = counters['members']
 
         except Exception as e:
             flash(f'An error occurred while fetching dashboard data: {e}', 'danger')
@@ -264,39 +297,65 @@ def admin_dashboard():
 
 # View all books or search for books
 @app.route('/books')
+@read_only
+@conditional_get(*CATALOG_ENTITIES)
 def books():
     conn = get_db_connection()
+    # the rendered table is cached per query until the catalog changes; on a
+    # miss its rows are rendered as they are read from the cursor
+    books_table = fragment_cache.stream(conn, 'books_table.html', CATALOG_ENTITIES, lambda: render_books_table(conn))
+    page = render_template('books.html', books_table=books_table)
+    conn.close()
+    return page
+
+
+def render_books_table(conn):
     cursor = conn.cursor()
     
     query = request.args.get('query', '')  # Get the search query from the request
-    if query:   
-        cursor.execute("""
+    if query:
+        # full text search through the books_fts index, best matches first
+        match = match_expression(query, request.args.get('search_by', ''))
+        if match is None:
+            return stream_fragment('books_table.html', books=[], page=None)
+        # page through the ranked results by (rank, book_id)
+        page = Pager(["books_fts.rank", "books.book_id"], types=(float, int))
+        keyset, keyset_params = page.where()
+        cursor.execute(f"""
             SELECT books.book_id, books.title,books.isbn, books.edition, books.copies_total, books.status, books.shelf_number, books.copies_available,
-            authors.name AS author, publishers.name AS publishers, GROUP_CONCAT(genres.genre_name, ', ') AS genres, books.published_year
-            FROM books
+            authors.name AS author, publishers.name AS publishers, books.published_year, books_fts.rank AS rank,
+            (SELECT GROUP_CONCAT(genres.genre_name, ', ') FROM book_genres
+             JOIN genres ON book_genres.genre_id = genres.genre_id
+             WHERE book_genres.book_id = books.book_id) AS genres
+            FROM books_fts
+            JOIN books ON books.book_id = books_fts.rowid
             JOIN authors ON books.author_id = authors.author_id
             JOIN publishers ON books.publisher_id = publishers.publisher_id
-            LEFT JOIN book_genres ON books.book_id = book_genres.book_id
-            LEFT JOIN genres ON book_genres.genre_id = genres.genre_id
-            WHERE books.title LIKE ? OR authors.name LIKE ? OR genres.genre_name LIKE ?
-            GROUP BY books.book_id
-        """, ('%' + query + '%', '%' + query + '%', '%' + query + '%'))
-        
+            WHERE books_fts MATCH ? AND {keyset}
+            ORDER BY {page.order_by()}
+            LIMIT ?
+        """, (match, *keyset_params, page.limit()))
+        books = page.iterate(cursor, key=lambda book: (book['rank'], book['book_id']))
+
     else:
-        cursor.execute("""
+        page = Pager(["books.book_id"])
+        keyset, keyset_params = page.where()
+        cursor.execute(f"""
             SELECT books.book_id,books.isbn, books.edition, books.copies_total ,books.shelf_number,books.status,books.copies_available,
-            books.title, authors.name AS author, publishers.name AS publishers, GROUP_CONCAT(genres.genre_name, ', ') AS genres, books.published_year
+            books.title, authors.name AS author, publishers.name AS publishers, books.published_year,
+            (SELECT GROUP_CONCAT(genres.genre_name, ', ') FROM book_genres
+             JOIN genres ON book_genres.genre_id = genres.genre_id
+             WHERE book_genres.book_id = books.book_id) AS genres
             FROM books
             JOIN authors ON books.author_id = authors.author_id
             JOIN publishers ON books.publisher_id = publishers.publisher_id
-            LEFT JOIN book_genres ON books.book_id = book_genres.book_id
-            LEFT JOIN genres ON book_genres.genre_id = genres.genre_id
-            GROUP BY books.book_id
-        """)    
+            WHERE {keyset}
+            ORDER BY {page.order_by()}
+            LIMIT ?
+        """, (*keyset_params, page.limit()))
+        books = page.iterate(cursor, key=lambda book: (book['book_id'],))
 
-    books = cursor.fetchall()
-    conn.close()
-    return render_template('books.html', books=books)
+    return stream_fragment('books_table.html', books=books, page=page)
 
 # Add a new book 
 @app.route('/add_book', methods=['GET', 'POST'])
@@ -305,13 +364,8 @@ def add_book():
     c = conn.cursor()
    
 
-    # Fetch authors, publishers, and genres for dropdowns
-    c.execute("SELECT author_id, name FROM authors")
-    authors = c.fetchall()
-    c.execute("SELECT publisher_id, name FROM publishers")
-    publishers = c.fetchall()
-    c.execute("SELECT genre_id, genre_name FROM genres")
-    genres = c.fetchall()
+    # Fetch authors, publishers, and genres for dropdowns (cached until they change)
+    authors, publishers, genres = get_reference_lists(conn, 'authors', 'publishers', 'genres')
     
   
 
@@ -342,20 +396,19 @@ def add_book():
             flash('Please fill in all required fields.')
             return render_template('add_update_book.html', authors=authors, publishers=publishers, genres=genres, book=None)
         
-        # Set copies_available to copies_total
-        copies_available = copies_total
-
-        # Set status based on copies_available
-        status = 'available' if copies_available > 0 else 'unavailable'
-
-
-        c.execute('''INSERT INTO books (title, isbn, edition, copies_total, copies_available,
-                     shelf_number, status, author_id, publisher_id, published_year)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                     (title, isbn, edition, copies_total, copies_available, shelf_number,
-                      status, author_id, publisher_id, year))
+        # the counters start at zero; adding the copies fills them in (see copies.py)
+        try:
+            c.execute('''INSERT INTO books (title, isbn, edition, copies_total, copies_available,
+                         shelf_number, status, author_id, publisher_id, published_year)
+                         VALUES (?, ?, ?, 0, 0, ?, 'unavailable', ?, ?, ?)''',
+                         (title, isbn, edition, shelf_number, author_id, publisher_id, year))
+        except sqlite3.IntegrityError:
+            # idx_isbn is unique
+            flash('A book with this ISBN already exists.')
+            return render_template('add_update_book.html', authors=authors, publishers=publishers, genres=genres, book=None)
         
         book_id = c.lastrowid  # Get the last inserted book ID
+        copies.add_copies(conn, book_id, max(copies_total, 0), shelf_number)
 
          # Insert into book_genres table (for multiple genres)
         if genre_ids:
@@ -382,9 +435,7 @@ def update_book(book_id):
     if request.method == 'GET':
         # Retrieve book data for pre-filling the form
         book = conn.execute('SELECT * FROM books WHERE book_id = ?', (book_id,)).fetchone()
-        authors = conn.execute('SELECT * FROM authors').fetchall()
-        publishers = conn.execute('SELECT * FROM publishers').fetchall()
-        genres = conn.execute('SELECT * FROM genres').fetchall()
+        authors, publishers, genres = get_reference_lists(conn, 'authors', 'publishers', 'genres')
         
         #fetch  exisiting genres for the book
         
@@ -392,17 +443,19 @@ def update_book(book_id):
             "SELECT genre_id FROM book_genres WHERE book_id = ?", (book_id,)
         ).fetchall()
         existing_genre_ids = {genre['genre_id'] for genre in existing_genres}  # Convert to set
+        related = recommendations.related_books(conn, book_id)
+        book_copies = copies.book_copies(conn, book_id)
 
         conn.close()
 
         if book is None:
-            print(f"Book with ID {book_id} not found.")
             return "Book not found", 404
 
         # Render the form with the book's current data
         book = dict(book)  # Convert row to dictionary if needed
         book['genre_ids'] = existing_genre_ids  # Attach genres to book
-        return render_template('add_update_book.html', book=book, authors=authors, publishers=publishers, genres=genres, existing_genre_ids=existing_genre_ids)
+        return render_template('add_update_book.html', book=book, authors=authors, publishers=publishers, genres=genres, existing_genre_ids=existing_genre_ids, related=related,
+                               copies=book_copies, copy_states=copies.STATES, copy_conditions=copies.CONDITIONS)
 
     if request.method == 'POST':
         # Get the form data
@@ -414,21 +467,35 @@ def update_book(book_id):
         year = request.form['published_year']
         genre_ids = request.form.getlist('genre_id[]')
         
-         # Automatically set copies_available to copies_total and status
-        copies_available = int(copies_total)
-        status = 'available' if copies_available > 0 else 'unavailable'
+        copies_total = int(copies_total)
 
         
         conn = get_db_connection()
         c = conn.cursor()
+        old = conn.execute('SELECT shelf_number FROM books WHERE book_id = ?', (book_id,)).fetchone()
 
-        # Update the book in the database
-        c.execute("""
-            UPDATE books
-            SET title = ?, isbn = ?, edition = ?, copies_total = ?, copies_available = ?, 
-                shelf_number = ?, status = ?, published_year = ?
-            WHERE book_id = ?
-        """, (title, isbn, edition, copies_total, copies_available, shelf_number, status, year, book_id))
+        # Update the book in the database; copies_total and copies_available
+        # follow its copies, so the loans out stay counted
+        try:
+            c.execute("""
+                UPDATE books
+                SET title = ?, isbn = ?, edition = ?, shelf_number = ?, published_year = ?
+                WHERE book_id = ?
+            """, (title, isbn, edition, shelf_number, year, book_id))
+            copies.set_total(conn, book_id, max(copies_total, 0), shelf_number)
+        except sqlite3.IntegrityError:
+            # idx_isbn is unique
+            conn.rollback()
+            flash('A book with this ISBN already exists.')
+            return redirect(f'/update_book/{book_id}')
+        except ValueError as e:
+            conn.rollback()
+            flash(str(e), 'danger')
+            return redirect(f'/update_book/{book_id}')
+        # copies shelved with the book move with it
+        if old is not None:
+            c.execute("UPDATE book_copies SET shelf_number = ? WHERE book_id = ? AND shelf_number IS ?",
+                      (shelf_number, book_id, old['shelf_number']))
         
          # Update book_genres table
         c.execute("DELETE FROM book_genres WHERE book_id = ?", (book_id,))  # Remove old genres
@@ -454,7 +521,8 @@ def delete_book(book_id):
         conn.close()
         return("Book not found", 404)  # Return a 404 error if the book doesn't exist
 
-    #delete the book
+    #delete the book and its copies (foreign keys are not enforced, so no cascade)
+    conn.execute("DELETE FROM book_copies WHERE book_id = ?", (book_id,))
     conn.execute("DELETE FROM books WHERE book_id = ?", (book_id,))
     conn.commit()
     conn.close()
@@ -462,6 +530,84 @@ def delete_book(book_id):
     return redirect('/books')  # Redirect to the books listing page after deletion
 
 
+# Edit one copy of a book: its state, condition or shelf
+@app.route('/book_copies/<int:copy_id>', methods=['POST'])
+@login_required
+def update_book_copy(copy_id):
+    shelf_number = (request.form.get('shelf_number') or '').strip() or None
+    conn = get_db_connection()
+    try:
+        with circulation.immediate_transaction(conn):
+            book_id = copies.update_copy(conn, copy_id, state=request.form.get('state') or None,
+                                         condition=request.form.get('condition') or None, shelf_number=shelf_number)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        book = conn.execute("SELECT book_id FROM book_copies WHERE copy_id = ?", (copy_id,)).fetchone()
+        return redirect(f'/update_book/{book[0]}' if book else '/books')
+    flash('Copy updated.', 'success')
+    return redirect(f'/update_book/{book_id}')
+
+
+# Cache and connection pool statistics for monitoring
+@app.route('/stats')
+@login_required
+def stats():
+    return jsonify(db_pool=get_pool().stats(), db_read_pool=get_read_pool().stats(),
+                   reference_cache=reference_cache.stats(), fragment_cache=fragment_cache.stats())
+
+
+# Prometheus metrics for this worker: request latency, status codes and SQL
+# work per route plus pool and cache statistics. Only served to a logged-in
+# admin, or to a scraper sending "Authorization: Bearer <METRICS_TOKEN>";
+# without METRICS_TOKEN set no token is accepted.
+@app.route('/metrics')
+def metrics():
+    token = os.environ.get("METRICS_TOKEN")
+    authorized = token and hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+    if not authorized and session.get("admin_id") is None:
+        return "Unauthorized", 401, {'WWW-Authenticate': 'Bearer'}
+    body = instrumentation.metrics.render({
+        "library_db_pool": get_pool().stats(),
+        "library_db_read_pool": get_read_pool().stats(),
+        "library_reference_cache": reference_cache.stats(),
+        "library_fragment_cache": fragment_cache.stats(),
+    })
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+# Import books in bulk from an uploaded CSV or JSON-lines file
+@app.route('/import_books', methods=['GET', 'POST'])
+@login_required
+def import_books():
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Please choose a CSV or JSON-lines file to import.', 'warning')
+            return redirect('/import_books')
+
+        fmt = request.form.get('format') or detect_format(upload.filename)
+        if fmt not in IMPORT_FORMATS:
+            flash('Unsupported file format.', 'danger')
+            return redirect('/import_books')
+
+        conn = get_db_connection()
+        # the upload is read row by row, never loaded into memory as a whole
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        try:
+            report = bulk_import_books(conn, stream, fmt)
+        except (sqlite3.Error, UnicodeDecodeError) as e:
+            flash(f'Import failed: {e}', 'danger')
+            return redirect('/import_books')
+        finally:
+            conn.close()
+
+        flash(f"Imported {report['inserted']} books, rejected {report['rejected']} rows "
+              f"({report['rows_per_second']} rows/second).", 'success')
+        return render_template('import_books.html', report=report)
+
+    return render_template('import_books.html', report=None)
+
+
 # Admin Manages Users
 
 # register_user a new user
@@ -529,35 +675,41 @@ def register_user():
     return render_template('register_user.html', username='', pa_pss_number='', email_id='', phone_number='', address='')
 
 @app.route('/view_users', methods=['GET', 'POST'])
+@read_only
 def view_users():
     conn = get_db_connection()
     c = conn.cursor()
 
     search_query = request.args.get('search', '')  # Get search term
+    page = Pager(["users.user_id"])
+    keyset, keyset_params = page.where()
     try:
 
         if search_query:
-        
-         c.execute("""SELECT users.user_id, users.username, users.pa_pss_number, users.email_id, users.phone_number,
+
+         c.execute(f"""SELECT users.user_id, users.username, users.pa_pss_number, users.email_id, users.phone_number,
                    users.address, users.is_active, users.date_activated
                           FROM users
                           WHERE (users.username LIKE ? OR users.pa_pss_number LIKE ? OR CAST(users.is_active AS TEXT) LIKE ?)
-                          AND is_deleted =0
+                          AND is_deleted =0 AND {keyset}
+                          ORDER BY {page.order_by()} LIMIT ?
                           """,
-                           (f'%{search_query}%', f'%{search_query}%', f'%{search_query}%'))
+                           (f'%{search_query}%', f'%{search_query}%', f'%{search_query}%', *keyset_params, page.limit()))
         else:
         #fetch all users without filtering
-            c.execute(""" SELECT users.user_id, users.username, users.pa_pss_number,users.phone_number, users.address, 
-                      users.email_id, users.is_active, users.date_activated FROM users where is_deleted = 0 
-                       """)
+            c.execute(f""" SELECT users.user_id, users.username, users.pa_pss_number,users.phone_number, users.address,
+                      users.email_id, users.is_active, users.date_activated FROM users where is_deleted = 0 AND {keyset}
+                      ORDER BY {page.order_by()} LIMIT ?
+                       """, (*keyset_params, page.limit()))
 
-        view_users = c.fetchall()
-    
-        return render_template('view_users.html', view_users=view_users)
+        # rows are rendered as they are fetched, one page window at a time
+        view_users = page.iterate(c, key=lambda user: (user['user_id'],))
+
+        return render_template('view_users.html', view_users=view_users, page=page)
     
-    except Exception as e:
+    except Exception:
         # Log the exception and flash a  message
-        print(f"Error: {e}")
+        app.logger.exception("Error fetching users")
         flash("An error occurred while fetching user data.", "danger")
         return redirect('/')
     finally:
@@ -608,8 +760,8 @@ def edit_user(user_id):
 # Create the delete_user Route
 @app.route('/delete_user/<int:user_id>', methods=['POST'])
 def soft_delete_user(user_id):
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
         c = conn.cursor()
         c.execute("""UPDATE users SET is_deleted = 1 WHERE user_id = ?""", (user_id,))
         conn.commit()
@@ -617,9 +769,8 @@ def soft_delete_user(user_id):
         return redirect('/view_users')
 
             
-    except Exception as e:
-        print(f"Error deleting user: {e}")
-        print(traceback.format_exc())  
+    except Exception:
+        app.logger.exception("Error deleting user %s", user_id)
         flash("An unexpected error occurred while trying to delete the user.", "danger")
         
     # Redirect back to the users list
@@ -631,197 +782,506 @@ def soft_delete_user(user_id):
 # Issue books to the user
 @app.route('/issue_book', methods=['GET', 'POST'])
 def issue_book():
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    c.execute("SELECT username FROM users WHERE is_deleted = 0")
-    users = c.fetchall()
-    c.execute("SELECT title FROM books WHERE copies_available > 0")
-    books = c.fetchall()
-
+    # the form picks the member and book through the typeahead endpoints
+    # below and submits their ids
     if request.method == 'POST':
-        username = request.form.get('username')
-        book_title = request.form.get('book_title')
+        user_id = request.form.get('user_id', type=int)
+        book_id = request.form.get('book_id', type=int)
 
-        if not username:
-            flash("Username required!", 'danger')
-            conn.close()
+        if not user_id:
+            flash("Select a member from the list!", 'danger')
             return redirect("/issue_book")  # Redirect to issue_books
-        elif not book_title:
-            flash("Book Title required!", 'danger')
-            conn.close()
+        elif not book_id:
+            flash("Select a book from the list!", 'danger')
             return redirect("/issue_book")  # Redirect to issue_books
 
-        # Fetch the user_id based on username
-        c.execute("SELECT user_id FROM users WHERE username = ?", (username,))
-        user = c.fetchone()
+        conn = get_db_connection()
+        # existence, availability, duplicate-loan check, loan record and copy
+        # count are handled in one transaction by the circulation engine
+        try:
+            result, users_record_id = circulation.issue_book(conn, user_id, book_id)
+        except sqlite3.Error as e:
+            flash(f"Database error: {e}")
+            return redirect("/issue_book")
 
-        if not user:
-            flash("User not found!", 'danger')
+        if result != circulation.ISSUED:
+            flash(circulation.MESSAGES[result], 'warning')
             conn.close()
-            return redirect("/issue_book")  # Redirect to issue_books
+            return redirect("/issue_book")
 
-        user_id = user[0]
+        flash(circulation.MESSAGES[result])
+        conn.close()
+        return redirect("/view_users_record")  # Redirect to the view_users_record page
 
-        # Fetch the book_id and copies_available
-        c.execute("SELECT book_id, copies_available  FROM books WHERE title = ?", (book_title,))
-        book = c.fetchone()
+    return render_template('issue_book.html', search_limit=typeahead.DEFAULT_LIMIT)
 
-        if not book:
-            flash("Book not found!", 'danger')
-            conn.close()
-            return redirect("/issue_book")  # Redirect to issue_books
 
+# Typeahead for the issue form: members by name or PA/PSS number prefix,
+# e.g. /api/users/search?q=ali&limit=10
+@app.route('/api/users/search', methods=['GET'])
+@read_only
+@login_required
+def search_users_api():
+    conn = get_db_connection()
+    users = typeahead.search_users(conn, request.args.get('q'), typeahead.clamp_limit(request.args.get('limit')))
+    conn.close()
+    return jsonify(users=users)
 
-        book_id = book[0]
-        copies_available = book[1]
-        
-        if copies_available == 0:
-            flash("This book is currently unavailable.")
-            conn.close()
-            return redirect("/issue_book")
-         # **Check if the user already has this book issued and not returned**
-        c.execute("""
-            SELECT COUNT(*) FROM users_record 
-            WHERE user_id = ? AND book_id = ? AND is_returned = 0
-        """, (user_id, book_id))
 
-        if c.fetchone()[0] > 0:
-            flash("This user already has this book issued and has not returned it!", 'warning')
-            conn.close()
-            return redirect("/issue_book")
+# books by title or ISBN prefix; available=1 leaves out books with no copy on the shelf
+@app.route('/api/books/search', methods=['GET'])
+@read_only
+@login_required
+def search_books_api():
+    conn = get_db_connection()
+    books = typeahead.search_books(conn, request.args.get('q'), typeahead.clamp_limit(request.args.get('limit')),
+                                   available_only=request.args.get('available') == '1')
+    conn.close()
+    return jsonify(books=books)
 
-        # Calculate the due date (30 days from now)
-        issue_date = datetime.now()
-        due_date = issue_date + timedelta(days=30)
-        return_date = '%Y-%m-%d'
 
-        try:
+# "members who borrowed this also borrowed", e.g. /api/books/12/related?limit=5
+@app.route('/api/books/<int:book_id>/related', methods=['GET'])
+@read_only
+@login_required
+def related_books_api(book_id):
+    conn = get_db_connection()
+    related = recommendations.related_books(conn, book_id, recommendations.clamp_limit(request.args.get('limit')))
+    conn.close()
+    return jsonify(book_id=book_id, related=related)
 
-            # Insert the record into users_record table
-            c.execute("""
-                INSERT INTO users_record (user_id, book_id, issue_date, due_date, is_returned, return_date)
-                VALUES (?, ?, ?, ?, 0, ?)
-            """, (user_id, book_id, issue_date, due_date,return_date))
-            conn.commit()
 
+# Barcode scanner desk: look up what was scanned, or scan a member card and
+# a book to issue it (or return it, if the member has it out) in one request
+SCAN_STATUS = {
+    circulation.ISSUED: 200, circulation.RETURNED: 200, circulation.INVALID: 400,
+    circulation.USER_NOT_FOUND: 404, circulation.BOOK_NOT_FOUND: 404,
+}
 
-                    # Update book's copies_available and status
-            c.execute("""
-                UPDATE books
-                SET copies_available = copies_available - 1, 
-                    status = CASE WHEN copies_available - 1 = 0 THEN 'unavailable' ELSE status END
-                WHERE book_id = ?
-            """, (book_id,))
-            conn.commit()
-            
-            flash("Book issued successfully!")
-            conn.close()
-            return redirect("/view_users_record")  # Redirect to the view_users_record page
-        except sqlite3.Error as e:
-                conn.rollback()
-                flash(f"Database error: {e}")
-                return redirect("/issue_book")
-    
-    conn.close()  # Close the connection for GET request
-    return render_template('issue_book.html', users=users, books=books)
 
+@app.route('/api/scan/book/<path:code>', methods=['GET'])
+@read_only
+@login_required
+def scan_book_api(code):
+    conn = get_db_connection()
+    book = scanner.find_book(conn, code)
+    conn.close()
+    if book is None:
+        return jsonify(error="unknown isbn"), 404
+    return jsonify(book)
 
-@app.route('/return_book/<int:users_record_id>', methods=['POST'])
-def return_book(users_record_id):
+
+@app.route('/api/scan/member/<path:code>', methods=['GET'])
+@read_only
+@login_required
+def scan_member_api(code):
     conn = get_db_connection()
-    c = conn.cursor()
+    member = scanner.find_member(conn, code)
+    conn.close()
+    if member is None:
+        return jsonify(error="unknown member number"), 404
+    return jsonify(member)
 
-    # Fetch the user_record and related book details
-    c.execute("""
-        SELECT users_record.book_id, books.copies_available
-        FROM users_record
-        JOIN books ON books.book_id = users_record.book_id
-        WHERE users_record.users_record_id = ?
-    """, (users_record_id,))
-    record = c.fetchone()
-
-    if not record:
-        flash("Record not found!")
+
+# body (JSON or form): {"member": "PA12345", "book": "9780061122415"}, with
+# an optional "action": "issue" or "return"
+@app.route('/api/scan', methods=['POST'])
+@login_required
+def scan_api():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        payload = request.form
+    conn = get_db_connection()
+    try:
+        result = scanner.scan(conn, payload.get('member'), payload.get('book'), payload.get('action'))
+    except sqlite3.Error as e:
+        return jsonify(error=f"Database error: {e}"), 500
+    finally:
         conn.close()
-        return redirect("/view_users_record")
+    return jsonify(result), SCAN_STATUS.get(result['result'], 409)
 
-    book_id, copies_available = record
-    
-    # Update users_record to mark the book as returned
-    return_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-    # Update users_record to mark the book as returned
-    c.execute("""
-        UPDATE users_record
-        SET is_returned = 1, return_date = ?
-        WHERE users_record_id = ?
-    """, (return_date, users_record_id))
-    conn.commit()
 
-    # Update the book's copies_available and status
-    new_copies_available = copies_available + 1
-    c.execute("""
-        UPDATE books
-        SET copies_available = ?, 
-            status = CASE WHEN ? > 0 THEN 'available' ELSE status END
-        WHERE book_id = ?
-    """, (new_copies_available, new_copies_available, book_id))
-    conn.commit()
+@app.route('/return_book/<int:users_record_id>', methods=['POST'])
+def return_book(users_record_id):
+    conn = get_db_connection()
+
+    # mark the loan returned and put the copy back in one transaction
+    try:
+        result, book_id = circulation.return_book(conn, users_record_id)
+    except sqlite3.Error as e:
+        flash(f"Database error: {e}", 'danger')
+        return redirect("/view_users_record")
 
-    flash("Book returned successfully!")
+    flash(circulation.MESSAGES[result])
     conn.close()
     return redirect("/view_users_record")
 
 
+# Issue and return many books in one request, e.g. a stack of returns at the
+# desk. Expects JSON {"items": [{"user_id": .., "book_id": ..} | {"users_record_id": ..}, ...]}
+# and applies them in a single transaction with a result per item.
+@app.route('/circulation/batch', methods=['POST'])
+@login_required
+def circulation_batch():
+    payload = request.get_json(silent=True) or {}
+    items = payload.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify(error="expected a non-empty 'items' list"), 400
+    if len(items) > circulation.MAX_BATCH:
+        return jsonify(error=f"at most {circulation.MAX_BATCH} items per batch"), 400
+
+    conn = get_db_connection()
+    try:
+        results = circulation.run_batch(conn, items)
+    except sqlite3.Error as e:
+        return jsonify(error=f"Database error: {e}"), 500
+    finally:
+        conn.close()
+
+    succeeded = sum(1 for result in results if result['ok'])
+    return jsonify(results=results, succeeded=succeeded, failed=len(results) - succeeded)
+
+
 
 @app.route("/view_users_record", methods=['GET'])
+@read_only
 def view_users_record():
     
     conn = get_db_connection()
+    # the rendered table is cached per query until loans, users or books
+    # change; on a miss its rows are rendered as they are read from the cursor
+    users_record_table = fragment_cache.stream(conn, 'users_record_table.html', USERS_RECORD_ENTITIES,
+                                               lambda: render_users_record_table(conn))
+    page = render_template('view_users_record.html', users_record_table=users_record_table)
+    conn.close()
+    return page
+
+
+USERS_RECORD_ENTITIES = ("users_record", "users", "books")
+
+
+def render_users_record_table(conn):
     cursor = conn.cursor()
     
     search_query = request.args.get('search', '')  # Get search term
-    
+    page = Pager(["users_record.users_record_id"])
+    keyset, keyset_params = page.where()
+
+    if search_query:
+        cursor.execute(f"""
+                    SELECT users_record.users_record_id, users_record.issue_date, users_record.return_date, users_record.due_date,users_record.is_returned,
+                    books.title, users.username
+                    FROM users_record
+                    JOIN
+                    books ON books.book_id=users_record.book_id
+                    JOIN
+                    users ON users.user_id=users_record.user_id
+                    WHERE (users.username LIKE ? OR users.pa_pss_number LIKE ? OR books.title LIKE ?) AND {keyset}
+                    ORDER BY {page.order_by()} LIMIT ? """, ( '%' + search_query + '%', '%' + search_query + '%', '%' + search_query + '%', *keyset_params, page.limit()))
+    else:
+    #fetch all users_record without filtering
+        cursor.execute(f""" SELECT users_record.users_record_id, users_record.issue_date, users_record.return_date, users_record.due_date, users_record.is_returned,
+                   books.title, users.username
+                  FROM users_record
+                 JOIN books books ON books.book_id = users_record.book_id
+                 JOIN users ON users.user_id = users_record.user_id
+                 WHERE {keyset}
+                 ORDER BY {page.order_by()} LIMIT ?
+                   """, (*keyset_params, page.limit()))
+
+    view_users_record = page.iterate(cursor, key=lambda record: (record['users_record_id'],))
+    return stream_fragment('users_record_table.html', view_users_record=view_users_record, page=page)
+
+
+# Overdue loans and fines, from the open-loan partial index
+@app.route("/overdue", methods=['GET'])
+@read_only
+@login_required
+def overdue_page():
+    conn = get_db_connection()
+    page = Pager(["overdue.due_date", "overdue.users_record_id"], types=(str, int))
+    loans = overdue.overdue_loans(conn, after=page.after, before=page.before, limit=page.limit())
+    loans = page.paginate(loans, key=lambda loan: (loan['due_date'], loan['users_record_id']))
+    data = {
+        "summary": overdue.summary(conn),
+        "members": overdue.fines_by_member(conn, limit=100),
+        "snapshots": overdue.recent_snapshots(conn, days=14),
+    }
+    conn.close()
+    return render_template('overdue.html', data=data, loans=loans, page=page)
+
+
+# JSON version: summary, fines per member and a page of overdue loans.
+# ?user_id= limits the loans to one member, ?after=<due_date>,<users_record_id> pages on.
+@app.route("/api/overdue", methods=['GET'])
+@read_only
+@login_required
+def overdue_api():
     try:
+        limit = max(1, min(int(request.args.get('limit', 100)), 1000))
+        user_id = int(request.args['user_id']) if request.args.get('user_id') else None
+        after = None
+        if request.args.get('after'):
+            due_date, users_record_id = request.args['after'].rsplit(',', 1)
+            after = (due_date, int(users_record_id))
+    except ValueError:
+        return jsonify(error="limit and user_id must be numbers and after must be <due_date>,<users_record_id>"), 400
 
-        if search_query:
-        
-         cursor.execute("""
-                        SELECT users_record.users_record_id, users_record.issue_date, users_record.return_date, users_record.due_date,users_record.is_returned,
-                        books.title, users.username
-                        FROM users_record
-                        JOIN
-                        books ON books.book_id=users_record.book_id
-                        JOIN
-                        users ON users.user_id=users_record.user_id
-                        WHERE users.username LIKE ? OR users.pa_pss_number LIKE ? OR books.title LIKE ? """, ( '%' + search_query + '%', '%' + search_query + '%', '%' + search_query + '%'))
-        else:
-        #fetch all users_record without filtering
-            cursor.execute(""" SELECT users_record.users_record_id, users_record.issue_date, users_record.return_date, users_record.due_date, users_record.is_returned,
-                       books.title, users.username
-                      FROM users_record 
-                     JOIN books books ON books.book_id = users_record.book_id
-                     JOIN users ON users.user_id = users_record.user_id
-                       """)
-
-        view_users_record = cursor.fetchall()
-        return render_template('view_users_record.html', view_users_record=view_users_record)
-    except sqlite3.Error as e:
-        flash(f"Database error: {e}", 'danger')
-        return redirect("/view_users_record")  # Redirect back to the records page
+    conn = get_db_connection()
+    loans = [dict(loan) for loan in overdue.overdue_loans(conn, user_id=user_id, after=after, limit=limit)]
+    result = {
+        "summary": overdue.summary(conn),
+        "members": [dict(member) for member in overdue.fines_by_member(conn, limit=limit)],
+        "loans": loans,
+        "next": f"{loans[-1]['due_date']},{loans[-1]['users_record_id']}" if len(loans) == limit else None,
+    }
+    conn.close()
+    return jsonify(result)
+
+
+# Circulation analytics from the rollup tables: issues and returns per day,
+# most borrowed titles, most active members. ?from= and ?to= (YYYY-MM-DD)
+# pick the days, the last 90 by default.
+@app.route("/analytics", methods=['GET'])
+@read_only
+@login_required
+def analytics_page():
+    try:
+        start, end = rollups.parse_range(request.args.get('from'), request.args.get('to'))
+    except ValueError as e:
+        flash(str(e), 'danger')
+        start, end = rollups.parse_range()
+    conn = get_db_connection()
+    report = rollups.report(conn, start, end)
+    conn.close()
+    peak = max([day['issues'] for day in report['daily']] + [day['returns'] for day in report['daily']] + [1])
+    return render_template('analytics.html', report=report, peak=peak)
+
+
+# JSON version, e.g. /api/analytics?from=2024-01-01&to=2024-03-31&limit=20
+@app.route("/api/analytics", methods=['GET'])
+@read_only
+@login_required
+def analytics_api():
+    try:
+        start, end = rollups.parse_range(request.args.get('from'), request.args.get('to'))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    limit = max(1, min(request.args.get('limit', 10, type=int), 100))
+    conn = get_db_connection()
+    report = rollups.report(conn, start, end, limit)
+    conn.close()
+    return jsonify(report)
+
+
+# Stocktake: list the sessions, or start a new one
+@app.route("/stocktake", methods=['GET', 'POST'])
+@read_only
+@login_required
+def stocktake_sessions():
+    conn = get_db_connection()
+    if request.method == 'POST':
+        name = (request.form.get('name') or '').strip() or f"Stocktake {datetime.now():%Y-%m-%d}"
+        session_id = stocktake.create_session(conn, name)
+        conn.close()
+        return redirect(f'/stocktake/{session_id}')
+    sessions = stocktake.list_sessions(conn)
+    conn.close()
+    return render_template('stocktake.html', sessions=sessions, session_row=None)
+
+
+# One stocktake session: totals, totals per shelf and the report, filtered
+# with ?kind=missing|misplaced|unexpected|found and paged with ?after=<result_id>
+@app.route("/stocktake/<int:session_id>", methods=['GET'])
+@read_only
+@login_required
+def stocktake_session(session_id):
+    kind = request.args.get('kind') if request.args.get('kind') in stocktake.KINDS else None
+    after = request.args.get('after', 0, type=int)
+    conn = get_db_connection()
+    session_row = stocktake.get_session(conn, session_id)
+    if session_row is None:
+        conn.close()
+        return "Stocktake session not found", 404
+    summary = stocktake.summary(conn, session_id)
+    shelves = stocktake.shelf_summary(conn, session_id)
+    results = stocktake.report(conn, session_id, kind, after)
+    conn.close()
+    return render_template('stocktake.html', session_row=session_row, summary=summary, shelves=shelves,
+                           results=results, kind=kind, kinds=stocktake.KINDS,
+                           next_after=results[-1]['result_id'] if len(results) == 200 else None)
+
+
+# Upload a scanner file to a session and compare it with the catalog
+@app.route("/stocktake/<int:session_id>/upload", methods=['POST'])
+@login_required
+def stocktake_upload(session_id):
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('Please choose a scanner file to upload.', 'warning')
+        return redirect(f'/stocktake/{session_id}')
+    conn = get_db_connection()
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    try:
+        report = stocktake.add_scans(conn, session_id, stocktake.read_scans(stream, request.form.get('shelf') or None))
+        summary = stocktake.compare(conn, session_id)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(f'/stocktake/{session_id}')
+    except (sqlite3.Error, UnicodeDecodeError) as e:
+        flash(f'Upload failed: {e}', 'danger')
+        return redirect(f'/stocktake/{session_id}')
     finally:
         conn.close()
-        
-        
+    flash(f"Added {report['scans']} scans ({report['unknown']} unknown codes, {report['rejected']} lines rejected). "
+          f"{summary['missing']} missing, {summary['misplaced']} misplaced, {summary['unexpected']} unexpected.",
+          'success')
+    return redirect(f'/stocktake/{session_id}')
+
+
+@app.route("/stocktake/<int:session_id>/compare", methods=['POST'])
+@login_required
+def stocktake_compare(session_id):
+    conn = get_db_connection()
+    if stocktake.get_session(conn, session_id) is None:
+        conn.close()
+        return "Stocktake session not found", 404
+    stocktake.compare(conn, session_id)
+    conn.close()
+    return redirect(f'/stocktake/{session_id}')
+
+
+# Close a session; with apply=1 copies reported missing are marked missing
+# and missing copies that were found are put back on the shelf
+@app.route("/stocktake/<int:session_id>/close", methods=['POST'])
+@login_required
+def stocktake_close(session_id):
+    conn = get_db_connection()
+    if stocktake.get_session(conn, session_id) is None:
+        conn.close()
+        return "Stocktake session not found", 404
+    summary = stocktake.close_session(conn, session_id, apply=request.form.get('apply') == '1')
+    conn.close()
+    flash(f"Stocktake closed: {summary['missing']} missing, {summary['misplaced']} misplaced, "
+          f"{summary['unexpected']} unexpected.", 'success')
+    return redirect(f'/stocktake/{session_id}')
+
+
+# The whole report (or one kind) as CSV, streamed from the cursor
+@app.route("/stocktake/<int:session_id>/report.csv", methods=['GET'])
+@read_only
+@login_required
+def stocktake_report_csv(session_id):
+    kind = request.args.get('kind') if request.args.get('kind') in stocktake.KINDS else None
+    conn = get_db_connection()
+    chunks = stocktake.report_csv(conn, session_id, kind)
+    return Response(stream_with_connection(chunks), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename="stocktake_{session_id}_{kind or "all"}.csv"',
+        'Cache-Control': 'no-store',
+    })
+
+
+# Scanners send what they read as they go: JSON {"shelf": "12", "codes": [...]}
+# or {"scans": [{"shelf": "12", "code": "..."}, ...]}
+@app.route("/api/stocktake/<int:session_id>/scans", methods=['POST'])
+@login_required
+def stocktake_scans_api(session_id):
+    payload = request.get_json(silent=True) or {}
+    if isinstance(payload.get('codes'), list):
+        scans = [(index, payload.get('shelf'), code) for index, code in enumerate(payload['codes'])]
+    elif isinstance(payload.get('scans'), list):
+        scans = [(index, scan.get('shelf'), scan.get('code')) if isinstance(scan, dict) else (index, None, None)
+                 for index, scan in enumerate(payload['scans'])]
+    else:
+        return jsonify(error="expected a 'codes' list with a 'shelf', or a 'scans' list"), 400
+    if not scans:
+        return jsonify(error="no scans"), 400
+    if len(scans) > stocktake.MAX_API_SCANS:
+        return jsonify(error=f"at most {stocktake.MAX_API_SCANS} scans per request"), 400
+    conn = get_db_connection()
+    try:
+        report = stocktake.add_scans(conn, session_id, scans)
+    except ValueError as e:
+        return jsonify(error=str(e)), 404 if 'not found' in str(e) else 409
+    finally:
+        conn.close()
+    return jsonify(report)
+
+
+@app.route("/api/stocktake/<int:session_id>", methods=['GET'])
+@read_only
+@login_required
+def stocktake_api(session_id):
+    conn = get_db_connection()
+    session_row = stocktake.get_session(conn, session_id)
+    summary = stocktake.summary(conn, session_id) if session_row else None
+    conn.close()
+    if session_row is None:
+        return jsonify(error="Stocktake session not found."), 404
+    return jsonify(session=session_row, summary=summary)
+
+
+# compare the scans with the catalog; returns the totals
+@app.route("/api/stocktake/<int:session_id>/compare", methods=['POST'])
+@login_required
+def stocktake_compare_api(session_id):
+    conn = get_db_connection()
+    if stocktake.get_session(conn, session_id) is None:
+        conn.close()
+        return jsonify(error="Stocktake session not found."), 404
+    summary = stocktake.compare(conn, session_id)
+    conn.close()
+    return jsonify(summary)
+
+
+# e.g. /api/stocktake/3/report?kind=missing&limit=500&after=1200
+@app.route("/api/stocktake/<int:session_id>/report", methods=['GET'])
+@read_only
+@login_required
+def stocktake_report_api(session_id):
+    kind = request.args.get('kind')
+    if kind and kind not in stocktake.KINDS:
+        return jsonify(error=f"kind must be one of {', '.join(stocktake.KINDS)}"), 400
+    limit = max(1, min(request.args.get('limit', 200, type=int), 1000))
+    conn = get_db_connection()
+    results = [dict(row) for row in stocktake.report(conn, session_id, kind, request.args.get('after', 0, type=int), limit)]
+    conn.close()
+    return jsonify(results=results, next=results[-1]['result_id'] if len(results) == limit else None)
+
+
+# Download the lending history as CSV or JSON lines, e.g.
+# /export/users_record?format=csv&from=2024-01-01&to=2024-12-31&user_id=7&returned=0&gzip=1
+# The file is streamed straight from the cursor, so any size can be exported.
+@app.route("/export/users_record", methods=['GET'])
+@read_only
+@login_required
+def export_users_record():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        return jsonify(error=f"format must be one of {', '.join(export.FORMATS)}"), 400
+    try:
+        filters = export.parse_filters(request.args.get('from'), request.args.get('to'),
+                                       request.args.get('user_id'), request.args.get('returned'))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    compress = request.args.get('gzip') in ('1', 'true', 'yes')
+
+    conn = get_db_connection()
+    chunks = export.export_records(conn, filters, fmt, compress)
+    mimetype = 'application/gzip' if compress else export.MIMETYPES[fmt]
+    return Response(stream_with_connection(stream_with_context(chunks)), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{export.filename(fmt, compress)}"',
+        'Cache-Control': 'no-store',
+    })
+
+
 @app.route("/add_author", methods=['GET', 'POST'])
 def add_author():
     conn = get_db_connection()
     c = conn.cursor()
     
     # Fetch all authors first (so authors variable is always assigned)
-    c.execute("SELECT * FROM authors ORDER BY author_id DESC")
-    authors = c.fetchall()
+    authors, = get_reference_lists(conn, 'authors')
     
     if request.method == 'POST':
         name = request.form.get('name')
@@ -831,13 +1291,21 @@ def add_author():
             return render_template("add_update_author.html", authors=authors)
 
 
-        c.execute("SELECT COUNT(*) FROM authors WHERE name = ?", (name,))
+        normalized_name = duplicates.normalize('authors', name)
+        c.execute("SELECT COUNT(*) FROM authors WHERE normalized_name = ? AND name = ?", (normalized_name, name))
         if c.fetchone()[0] > 0:
                 flash("Author already exists!")
                 return render_template("add_update_author.html", authors=authors)
 
-        c.execute("""INSERT INTO authors (name)
-                        VALUES (?)""", (name,))
+        # near duplicates ("J R R Tolkien" for "J.R.R. Tolkien") need a second submit
+        similar = duplicates.find_duplicates(conn, 'authors', name)
+        if similar and not request.form.get('confirm'):
+            conn.close()
+            flash("Similar authors already exist. Use one of them, or submit again to add it anyway.", "warning")
+            return render_template("add_update_author.html", authors=authors, name=name, duplicates=similar)
+
+        c.execute("""INSERT INTO authors (name, normalized_name)
+                        VALUES (?, ?)""", (name, normalized_name))
         conn.commit()
             
             # Redirect to the authors list page
@@ -863,11 +1331,15 @@ def update_author(author_id):
                 return redirect (f"/update_author/{author_id}")
             if name:  # If  name exists, update the author
         
-                c.execute(""" UPDATE authors SET name = ? WHERE author_id = ?
-             """, (name, author_id))
+                c.execute(""" UPDATE authors SET name = ?, normalized_name = ? WHERE author_id = ?
+             """, (name, duplicates.normalize('authors', name), author_id))
             conn.commit()
+            similar = duplicates.find_duplicates(conn, 'authors', name, exclude_id=author_id)
             conn.close()
             flash("Author updated successfully!")
+            if similar:
+                flash("This author looks like a duplicate of " + ", ".join(match['name'] for match in similar)
+                      + ". You can merge them from the author's edit page.", "warning")
             return redirect('/authors')
     else: # 
 
@@ -876,16 +1348,18 @@ def update_author(author_id):
         author = c.fetchone()
         
         
-        c.execute("SELECT * FROM authors WHERE is_deleted = 0 ORDER BY author_id DESC")
-    authors = c.fetchall()
+    authors, = get_reference_lists(conn, 'authors')
+    similar = duplicates.find_duplicates(conn, 'authors', author['name'], exclude_id=author_id) if author else []
     conn.close()
 
     if author:
-        return render_template("add_update_author.html", author=author, authors=authors)  # Show form with existing data
+        return render_template("add_update_author.html", author=author, authors=authors, duplicates=similar)  # Show form with existing data
     return "Author not found", 404
     
 # view all author
 @app.route('/authors', methods=['GET'])
+@read_only
+@conditional_get('authors')
 def authors():
     search_query = request.args.get('search', '').strip()
     conn = get_db_connection()
@@ -893,10 +1367,10 @@ def authors():
 
     if search_query:
         c.execute("SELECT author_id, name FROM authors WHERE is_deleted = 0 AND name LIKE ?", ('%' + search_query + '%',))
+        authors = c.fetchall()
     else:
-        c.execute("SELECT author_id, name FROM authors WHERE is_deleted = 0 ORDER BY author_id DESC")
+        authors, = get_reference_lists(conn, 'authors')
 
-    authors = c.fetchall()
     conn.close()
     return render_template("authors.html", authors=authors, search_query=search_query)
 
@@ -916,6 +1390,8 @@ def soft_delete_author(author_id):
 
 # view publishers
 @app.route('/publishers', methods=['GET'])
+@read_only
+@conditional_get('publishers')
 def publishers():
    
     search_query = request.args.get('search', '').strip()
@@ -924,10 +1400,10 @@ def publishers():
 
     if search_query:
         c.execute("SELECT publisher_id, name FROM publishers WHERE is_deleted = 0 AND name LIKE ?", ('%' + search_query + '%',))
+        publishers = c.fetchall()
     else:
-        c.execute("SELECT publisher_id, name FROM publishers WHERE is_deleted = 0 ORDER BY publisher_id DESC")
+        publishers, = get_reference_lists(conn, 'publishers')
 
-    publishers = c.fetchall()
     conn.close()
     return render_template("publishers.html", publishers=publishers, search_query=search_query)
 
@@ -939,8 +1415,7 @@ def add_publisher():
      c = conn.cursor()
     
     # Fetch all publishers first 
-     c.execute("SELECT * FROM publishers WHERE is_deleted = 0 ORDER BY publisher_id DESC")
-     publishers = c.fetchall()
+     publishers, = get_reference_lists(conn, 'publishers')
      if request.method == 'POST':
          name = request.form.get('name')
          if not name:
@@ -949,13 +1424,21 @@ def add_publisher():
         
          conn = get_db_connection()
          c = conn.cursor()  # Fixed cursor usage
-         c.execute("SELECT * FROM publishers WHERE name = ?", (name,))
+         normalized_name = duplicates.normalize('publishers', name)
+         c.execute("SELECT * FROM publishers WHERE normalized_name = ? AND name = ?", (normalized_name, name))
          existing_publisher = c.fetchone()
 
+         # near duplicates ("Penguin Books Ltd." for "Penguin Books") need a second submit
+         similar = [] if existing_publisher else duplicates.find_duplicates(conn, 'publishers', name)
+         if similar and not request.form.get('confirm'):
+             conn.close()
+             flash("Similar publishers already exist. Use one of them, or submit again to add it anyway.", "warning")
+             return render_template("add_update_publisher.html", publishers=publishers, name=name, duplicates=similar)
+
          if existing_publisher:
              flash("Publisher already exists!", "warning")
          else:
-             c.execute("INSERT INTO publishers(name) VALUES(?)", (name,))
+             c.execute("INSERT INTO publishers(name, normalized_name) VALUES(?, ?)", (name, normalized_name))
              conn.commit()
              flash("Publisher added successfully!", "success")
 
@@ -977,11 +1460,15 @@ def update_publisher(publisher_id):
                 return redirect (f"/update_publisher/{publisher_id}")
             if name:  # If  name exists, update the author
         
-                c.execute(""" UPDATE publishers SET name = ? WHERE publisher_id = ?
-             """, (name, publisher_id))
+                c.execute(""" UPDATE publishers SET name = ?, normalized_name = ? WHERE publisher_id = ?
+             """, (name, duplicates.normalize('publishers', name), publisher_id))
             conn.commit()
+            similar = duplicates.find_duplicates(conn, 'publishers', name, exclude_id=publisher_id)
             conn.close()
             flash("Pubisher updated successfully!")
+            if similar:
+                flash("This publisher looks like a duplicate of " + ", ".join(match['name'] for match in similar)
+                      + ". You can merge them from the publisher's edit page.", "warning")
             return redirect('/publishers')
     else: # 
 
@@ -990,11 +1477,11 @@ def update_publisher(publisher_id):
         publisher = c.fetchone()
         
         
-    c.execute("SELECT * FROM publishers WHERE is_deleted = 0 ORDER BY publisher_id DESC")
-    publishers = c.fetchall()
+    publishers, = get_reference_lists(conn, 'publishers')
+    similar = duplicates.find_duplicates(conn, 'publishers', publisher['name'], exclude_id=publisher_id) if publisher else []
     conn.close()
     if publisher:
-        return render_template("add_update_publisher.html", publisher=publisher, publishers=publishers)  # Show form with existing data
+        return render_template("add_update_publisher.html", publisher=publisher, publishers=publishers, duplicates=similar)  # Show form with existing data
     return "Publisher not found", 404
     
 #soft delete publisher
@@ -1013,6 +1500,8 @@ def soft_delete_publisher(publisher_id):
     
 # view genres
 @app.route('/genres', methods=['GET'])
+@read_only
+@conditional_get('genres')
 def genres():
    search_query = request.args.get('search', '').strip()
    conn = get_db_connection()
@@ -1020,10 +1509,10 @@ def genres():
 
    if search_query:
         c.execute("SELECT genre_id, genre_name FROM genres WHERE is_deleted = 0 AND  genre_name LIKE ?", ('%' + search_query + '%',))
+        genres = c.fetchall()
    else:
-        c.execute("SELECT genre_id, genre_name FROM genres WHERE is_deleted = 0 ORDER BY genre_id DESC")
+        genres, = get_reference_lists(conn, 'genres')
 
-   genres = c.fetchall()
    conn.close()
    return render_template("genres.html", genres=genres, search_query=search_query)
 
@@ -1036,8 +1525,7 @@ def add_genre():
      c = conn.cursor()
     
     # Fetch all genres first 
-     c.execute("SELECT * FROM genres  WHERE is_deleted = 0 ORDER BY genre_id DESC")
-     genres = c.fetchall()
+     genres, = get_reference_lists(conn, 'genres')
      
      if request.method == 'POST':
         genre_name = request.form.get('genre_name')
@@ -1047,12 +1535,20 @@ def add_genre():
             return redirect('/add_genre')  # Fixed redirect
          
                 # Check if genre already exists
-        c.execute("SELECT COUNT(*) FROM genres WHERE genre_name = ?", (genre_name,))
+        normalized_name = duplicates.normalize('genres', genre_name)
+        c.execute("SELECT COUNT(*) FROM genres WHERE normalized_name = ? AND genre_name = ?", (normalized_name, genre_name))
         if c.fetchone()[0] > 0:
             flash("Genre already exists!")
-            return redirect('/add_genre', genres=genres)
+            return redirect('/add_genre')
+
+        # near duplicates ("Sci-Fi" for "Sci Fi") need a second submit
+        similar = duplicates.find_duplicates(conn, 'genres', genre_name)
+        if similar and not request.form.get('confirm'):
+            conn.close()
+            flash("Similar genres already exist. Use one of them, or submit again to add it anyway.", "warning")
+            return render_template("add_update_genre.html", genres=genres, name=genre_name, duplicates=similar)
         
-        c.execute("INSERT INTO genres(genre_name) VALUES(?)", (genre_name,))
+        c.execute("INSERT INTO genres(genre_name, normalized_name) VALUES(?, ?)", (genre_name, normalized_name))
         conn.commit()  # Fixed commit usage
         flash("Genre added successfully!")
         return redirect("/genres")  # Redirecting to genres list
@@ -1066,19 +1562,19 @@ def update_genre(genre_id):
     c = conn.cursor()
     
     # fetch all genres
-    c.execute("SELECT * FROM genres  WHERE is_deleted = 0 ORDER BY genre_id DESC")
-    genres = c.fetchall()
+    genres, = get_reference_lists(conn, 'genres')
     
     if request.method == 'GET':
         c.execute("SELECT * FROM genres WHERE genre_id = ?", (genre_id,))
         genre = c.fetchone()
+        similar = duplicates.find_duplicates(conn, 'genres', genre['genre_name'], exclude_id=genre_id) if genre else []
         conn.close()
 
         if not genre:
             flash("Genre not found!")
             return redirect('/genres')
 
-        return render_template('add_update_genre.html', genre=genre, genres=genres)
+        return render_template('add_update_genre.html', genre=genre, genres=genres, duplicates=similar)
 
     elif request.method == "POST":
         genre_name = request.form.get('genre_name')
@@ -1087,11 +1583,15 @@ def update_genre(genre_id):
             return redirect(f"/update_genre/{genre_id}")
         c.execute("""
              UPDATE genres
-            SET genre_name = ? WHERE genre_id = ?
-             """, (genre_name, genre_id))
+            SET genre_name = ?, normalized_name = ? WHERE genre_id = ?
+             """, (genre_name, duplicates.normalize('genres', genre_name), genre_id))
         conn.commit()
+        similar = duplicates.find_duplicates(conn, 'genres', genre_name, exclude_id=genre_id)
         conn.close()
         flash("Genre updated successfully!")
+        if similar:
+            flash("This genre looks like a duplicate of " + ", ".join(match['name'] for match in similar)
+                  + ". You can merge them from the genre's edit page.", "warning")
         return redirect("/genres")
     
  #soft delete genre  
@@ -1106,6 +1606,246 @@ def soft_delete_genre(genre_id):
     return redirect('/genres')
 
 
+# likely duplicates of a name, e.g. /api/authors/duplicates?name=Tolkien, J.R.R.
+# (exclude_id leaves out the row being edited)
+@app.route('/api/<entity>/duplicates', methods=['GET'])
+@read_only
+@login_required
+def duplicates_api(entity):
+    if entity not in duplicates.ENTITIES:
+        return jsonify(error=f"unknown entity {entity}"), 404
+    conn = get_db_connection()
+    similar = duplicates.find_duplicates(conn, entity, request.args.get('name', ''),
+                                         exclude_id=request.args.get('exclude_id', type=int))
+    conn.close()
+    return jsonify(duplicates=similar)
+
+
+# merge duplicates into one author/publisher/genre: books and book genres
+# move to keep_id and the duplicates are soft deleted, in one transaction
+@app.route('/merge/<entity>/<int:keep_id>', methods=['POST'])
+@login_required
+def merge_duplicates(entity, keep_id):
+    if entity not in duplicates.ENTITIES:
+        return "Not found", 404
+    conn = get_db_connection()
+    try:
+        with circulation.immediate_transaction(conn):
+            moved = duplicates.merge(conn, entity, keep_id, request.form.getlist('merge_id[]', type=int))
+    except ValueError as e:
+        flash(str(e), 'danger')
+    else:
+        flash(f"Merged. {moved} book links moved.", 'success')
+    conn.close()
+    return redirect(f'/{entity}')
+
+
+# apply pending schema migrations
+@app.cli.command('migrate')
+@click.option('--status', is_flag=True, help="Only list pending migrations.")
+def migrate_command(status):
+    conn = get_db_connection()
+    if status:
+        for version, description, step in pending_migrations(conn):
+            print(f"Pending migration {version}: {description}")
+    else:
+        for version, description in migrate(conn):
+            print(f"Applied migration {version}: {description}")
+    print(f"Schema version {current_version(conn)}")
+    conn.close()
+
+
+# rebuild the full text catalog index from the books tables
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    conn = get_db_connection()
+    count = rebuild_search_index(conn)
+    conn.close()
+    print(f"Search index rebuilt: {count} books indexed")
+
+
+# recount the dashboard totals from scratch and report any drift
+@app.cli.command('verify-dashboard-counters')
+@click.option('--fix', is_flag=True, help="Overwrite drifted counters with the recomputed values.")
+def verify_dashboard_counters_command(fix):
+    conn = get_db_connection()
+    drift = verify_counters(conn, fix=fix)
+    conn.close()
+    if not drift:
+        print("Dashboard counters are up to date")
+    for name, (stored, actual) in drift.items():
+        print(f"{name}: stored {stored}, actual {actual}" + (" (fixed)" if fix else ""))
+
+
+# recount every book's copies and compare with copies_total/copies_available
+@app.cli.command('verify-copies')
+@click.option('--fix', is_flag=True, help="Overwrite drifted counters with the recounted values.")
+def verify_copies_command(fix):
+    conn = get_db_connection()
+    drift = copies.verify_copy_counters(conn, fix=fix)
+    conn.close()
+    if not drift:
+        print("Copy counters are up to date")
+    for book_id, (stored, actual) in drift.items():
+        print(f"book {book_id}: stored {stored[0]} total / {stored[1]} available, "
+              f"actual {actual[0]} / {actual[1]}" + (" (fixed)" if fix else ""))
+
+
+# load a scanner file into a stocktake session (a new one unless --session)
+# and print the comparison with the catalog
+@app.cli.command('stocktake-import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--session', 'session_id', type=int, help="Add to this session instead of starting a new one.")
+@click.option('--shelf', help="Shelf for codes before the file names one.")
+@click.option('--name', help="Name of the new session.")
+def stocktake_import_command(path, session_id, shelf, name):
+    conn = get_db_connection()
+    if session_id is None:
+        session_id = stocktake.create_session(conn, name or f"Stocktake {datetime.now():%Y-%m-%d}")
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        try:
+            report = stocktake.add_scans(conn, session_id, stocktake.read_scans(stream, shelf))
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    summary = stocktake.compare(conn, session_id)
+    conn.close()
+    print(f"Session {session_id}: {report['scans']} scans added in {report['seconds']}s "
+          f"({report['unknown']} unknown codes, {report['rejected']} lines rejected)")
+    print(f"Compared {summary['shelves']} shelves in {summary['seconds']}s: " +
+          ", ".join(f"{summary[kind]} {kind}" for kind in stocktake.KINDS))
+
+
+# write a stocktake session's report as CSV
+@app.cli.command('stocktake-report')
+@click.argument('session_id', type=int)
+@click.option('--kind', type=click.Choice(stocktake.KINDS))
+@click.option('--output', default='-', show_default=True, help="File to write.")
+def stocktake_report_command(session_id, kind, output):
+    conn = get_db_connection()
+    with click.open_file(output, 'w') as out:
+        for chunk in stocktake.report_csv(conn, session_id, kind):
+            out.write(chunk)
+    conn.close()
+
+
+# rebuild the analytics rollups from users_record
+@app.cli.command('backfill-rollups')
+def backfill_rollups_command():
+    conn = get_db_connection()
+    with circulation.immediate_transaction(conn):
+        counts = rollups.backfill(conn)
+    conn.close()
+    print("Rollups rebuilt: " + ", ".join(f"{table} {count} rows" for table, count in counts.items()))
+
+
+# rebuild the co-borrowing pairs behind the book recommendations
+@app.cli.command('rebuild-recommendations')
+def rebuild_recommendations_command():
+    conn = get_db_connection()
+    started = time.perf_counter()
+    with circulation.immediate_transaction(conn):
+        pairs = recommendations.rebuild(conn)
+    conn.close()
+    print(f"Rebuilt {pairs} book pairs in {time.perf_counter() - started:.1f}s")
+
+
+# list likely duplicate authors, publishers or genres
+@app.cli.command('find-duplicates')
+@click.argument('entity', type=click.Choice(sorted(duplicates.ENTITIES)))
+@click.option('--min-similarity', type=float, default=None, help='0-1, defaults to DUPLICATE_SIMILARITY')
+def find_duplicates_command(entity, min_similarity):
+    conn = get_db_connection()
+    groups = duplicates.duplicate_groups(conn, entity, min_similarity)
+    conn.close()
+    for row, matches in groups:
+        print(f"{row['id']}: {row['name']}")
+        for match in matches:
+            print(f"    {match['id']}: {match['name']} ({match['similarity']})")
+    print(f"{len(groups)} groups of likely duplicates")
+
+
+# merge duplicates into KEEP_ID, e.g. flask --app app merge-duplicates authors 3 17 42
+@app.cli.command('merge-duplicates')
+@click.argument('entity', type=click.Choice(sorted(duplicates.ENTITIES)))
+@click.argument('keep_id', type=int)
+@click.argument('merge_ids', type=int, nargs=-1, required=True)
+def merge_duplicates_command(entity, keep_id, merge_ids):
+    conn = get_db_connection()
+    try:
+        with circulation.immediate_transaction(conn):
+            moved = duplicates.merge(conn, entity, keep_id, merge_ids)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    finally:
+        conn.close()
+    print(f"Merged {len(set(merge_ids) - {keep_id})} {entity} into {keep_id}; {moved} book links moved")
+
+
+# import books from a CSV or JSON-lines file
+@app.cli.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), help="Defaults to the file extension.")
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True, help="Rows per transaction.")
+def import_books_command(path, fmt, batch_size):
+    conn = get_db_connection()
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        report = bulk_import_books(conn, stream, fmt or detect_format(path), batch_size)
+    conn.close()
+    for line_number, reason in report['rejects']:
+        print(f"line {line_number}: {reason}")
+    print(f"Imported {report['inserted']} books, rejected {report['rejected']} rows "
+          f"in {report['seconds']}s ({report['rows_per_second']} rows/second)")
+
+
+# export the lending history to a file (or stdout with --output -)
+@app.cli.command('export-records')
+@click.option('--format', 'fmt', type=click.Choice(export.FORMATS), default='csv', show_default=True)
+@click.option('--from', 'date_from', help="First issue date (YYYY-MM-DD).")
+@click.option('--to', 'date_to', help="Last issue date (YYYY-MM-DD).")
+@click.option('--user-id', type=int)
+@click.option('--returned', type=click.Choice(('0', '1')), help="Only returned (1) or open (0) loans.")
+@click.option('--gzip', 'compress', is_flag=True, help="Write a gzip compressed file.")
+@click.option('--output', default='-', show_default=True, help="File to write.")
+def export_records_command(fmt, date_from, date_to, user_id, returned, compress, output):
+    try:
+        filters = export.parse_filters(date_from, date_to, user_id, returned)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    conn = get_db_connection()
+    with click.open_file(output, 'wb') as out:
+        for chunk in export.export_records(conn, filters, fmt, compress):
+            out.write(chunk)
+    conn.close()
+
+
+# record today's overdue totals and fines per member; run daily from cron
+@app.cli.command('overdue-snapshot')
+def overdue_snapshot_command():
+    conn = get_db_connection()
+    snapshot = overdue.write_snapshot(conn)
+    conn.close()
+    print(f"Overdue snapshot {snapshot['snapshot_date']}: {snapshot['overdue_loans']} loans, "
+          f"{snapshot['overdue_members']} members, fines {snapshot['total_fines']:.2f}")
+
+
+# download the CDN assets into static/vendor (needs internet access; commit the result)
+@app.cli.command('vendor-assets')
+@click.option('--force', is_flag=True, help="download again even if the file is already vendored")
+def vendor_assets_command(force):
+    fetched = assets.vendor(force)
+    print(f"Vendored {len(fetched)} file(s)" + (": " + ", ".join(fetched) if fetched else ""))
+
+
+# fingerprint and precompress static/ into static/dist; run on every deploy
+@app.cli.command('build-assets')
+def build_assets_command():
+    manifest = assets.build()
+    for name, target in sorted(manifest.items()):
+        print(f"{name} -> {target}")
+    if assets.brotli is None:
+        print("brotli is not installed: only .gz variants were written")
+
+
 if __name__ == '__main__':
     app.run(debug=True)
  
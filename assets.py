@@ -0,0 +1,202 @@
+import gzip, hashlib, json, mimetypes, os, posixpath, re, urllib.request
+from flask import request, send_file, url_for, abort
+from werkzeug.security import safe_join
+
+try:
+    import brotli  # optional: .br variants are only built when it is installed
+except ImportError:
+    brotli = None
+
+
+# Static asset pipeline. The CSS/JS the templates used to pull from public
+# CDNs are vendored into static/vendor and committed (flask --app app
+# vendor-assets downloads them again, e.g. to upgrade). build-assets then
+# copies every static file to static/dist under a content hash
+# (bootstrap.min.<hash>.css), writes .gz (and .br when brotli is installed)
+# next to the text files and records the names in
+# static/dist/manifest.json. /assets/ serves those files with a one year
+# immutable Cache-Control, picking the precompressed variant the browser
+# accepts. Templates link assets with asset_url(name), which falls back to
+# the plain static file and fails for files that are in neither place.
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST = os.path.join(DIST_DIR, "manifest.json")
+MAX_AGE = 365 * 24 * 3600
+
+# static/ path -> where vendor-assets downloads it from
+VENDOR = {
+    "vendor/bootstrap/bootstrap.min.css":
+        "https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css",
+    "vendor/bootstrap/bootstrap.min.js":
+        "https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/js/bootstrap.min.js",
+    "vendor/popper/popper.min.js": "https://cdn.jsdelivr.net/npm/@popperjs/core@2.11.8/dist/umd/popper.min.js",
+    "vendor/bootstrap-icons/bootstrap-icons.min.css":
+        "https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/bootstrap-icons.min.css",
+    "vendor/bootstrap-icons/fonts/bootstrap-icons.woff2":
+        "https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/fonts/bootstrap-icons.woff2",
+    "vendor/bootstrap-icons/fonts/bootstrap-icons.woff":
+        "https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/fonts/bootstrap-icons.woff",
+    "vendor/jquery/jquery-3.6.0.min.js": "https://code.jquery.com/jquery-3.6.0.min.js",
+    "vendor/select2/select2.min.css": "https://cdn.jsdelivr.net/npm/select2@4.0.13/dist/css/select2.min.css",
+    "vendor/select2/select2.full.min.js":
+        "https://cdn.jsdelivr.net/npm/select2@4.0.13/dist/js/select2.full.min.js",
+}
+
+FINGERPRINTED = {".css", ".js", ".png", ".jpg", ".jpeg", ".gif", ".svg", ".ico", ".webp", ".woff", ".woff2"}
+COMPRESSED = {".css", ".js", ".svg", ".ico"}  # images and fonts are compressed already
+MIN_COMPRESS_SIZE = 1024
+
+
+def vendor(force=False):
+    # downloads VENDOR into static/; returns the paths fetched
+    fetched = []
+    for name, url in VENDOR.items():
+        path = os.path.join(STATIC_DIR, name)
+        if os.path.exists(path) and not force:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(url, timeout=30) as response:
+            data = response.read()
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        fetched.append(name)
+    return fetched
+
+
+def _sources():
+    for root, dirs, files in os.walk(STATIC_DIR):
+        if os.path.abspath(root) == DIST_DIR:
+            dirs[:] = []
+            continue
+        for filename in files:
+            name = os.path.relpath(os.path.join(root, filename), STATIC_DIR).replace(os.sep, "/")
+            if os.path.splitext(name)[1].lower() in FINGERPRINTED:
+                yield name
+
+
+def _fingerprinted_name(name, data):
+    base, ext = posixpath.splitext(name)
+    directory, filename = posixpath.split(base)
+    filename = re.sub(r"[^A-Za-z0-9._-]+", "-", filename)
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    return posixpath.join(directory, f"{filename}.{digest}{ext}")
+
+
+_CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def _rewrite_css(name, css, manifest):
+    # point relative url()s (icon fonts, images) at their fingerprinted copies
+    def replace(match):
+        reference = match.group(2)
+        if re.match(r"^(?:[a-z]+:|/|#)", reference):
+            return match.group(0)
+        path = re.split(r"[?#]", reference, maxsplit=1)[0]
+        target = manifest.get(posixpath.normpath(posixpath.join(posixpath.dirname(name), path)))
+        if target is None:
+            return match.group(0)
+        # the fingerprinted CSS stays in the same directory as its source
+        relative = posixpath.relpath(target, posixpath.dirname(name) or ".")
+        return f'url("{relative}")'
+    return _CSS_URL.sub(replace, css.decode("utf-8")).encode("utf-8")
+
+
+def build():
+    # (re)builds static/dist; returns the manifest
+    manifest, outputs = {}, {}
+    # CSS last, so the files it references already have their final names
+    for name in sorted(_sources(), key=lambda name: (name.endswith(".css"), name)):
+        with open(os.path.join(STATIC_DIR, name), "rb") as f:
+            data = f.read()
+        if name.endswith(".css"):
+            data = _rewrite_css(name, data, manifest)
+        target = manifest[name] = _fingerprinted_name(name, data)
+        outputs[target] = data
+
+    os.makedirs(DIST_DIR, exist_ok=True)
+    for target, data in outputs.items():
+        path = os.path.join(DIST_DIR, target)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write(path, data)
+        if os.path.splitext(target)[1] in COMPRESSED and len(data) >= MIN_COMPRESS_SIZE:
+            _write_if_smaller(path + ".gz", gzip.compress(data, 9, mtime=0), data)
+            if brotli is not None:
+                _write_if_smaller(path + ".br", brotli.compress(data, quality=11), data)
+    _remove_stale(set(outputs))
+    _write(MANIFEST, json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+    _manifest_cache.clear()
+    return manifest
+
+
+def _write(path, data):
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def _write_if_smaller(path, compressed, data):
+    if len(compressed) < len(data) * 0.9:
+        _write(path, compressed)
+
+
+def _remove_stale(current):
+    # drop files from earlier builds
+    for root, dirs, files in os.walk(DIST_DIR):
+        for filename in files:
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, DIST_DIR).replace(os.sep, "/")
+            if name == "manifest.json" or re.sub(r"\.(gz|br)$", "", name) in current:
+                continue
+            os.remove(path)
+
+
+_manifest_cache = {}
+
+
+def load_manifest():
+    # reread when build-assets has replaced it
+    try:
+        mtime = os.path.getmtime(MANIFEST)
+    except OSError:
+        return {}
+    if _manifest_cache.get("mtime") != mtime:
+        with open(MANIFEST) as f:
+            _manifest_cache.update(mtime=mtime, manifest=json.load(f))
+    return _manifest_cache["manifest"]
+
+
+def asset_url(name):
+    target = load_manifest().get(name)
+    if target is not None:
+        return url_for("assets", filename=target)
+    # a page must not silently depend on a file that is not deployed
+    if not os.path.isfile(os.path.join(STATIC_DIR, name)):
+        raise FileNotFoundError(f"static asset {name!r} is missing from static/")
+    return url_for("static", filename=name)
+
+
+def send_asset(filename):
+    path = safe_join(DIST_DIR, filename)
+    if path is None or filename == "manifest.json" or filename.endswith((".gz", ".br")) or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    accepted = request.accept_encodings
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if accepted[encoding] and os.path.isfile(path + suffix):
+            response = send_file(path + suffix, mimetype=mimetype, conditional=True)
+            response.headers["Content-Encoding"] = encoding
+            break
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True)
+    response.headers["Cache-Control"] = f"public, max-age={MAX_AGE}, immutable"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def init_app(app):
+    mimetypes.add_type("font/woff2", ".woff2")
+    mimetypes.add_type("font/woff", ".woff")
+    app.add_url_rule("/assets/<path:filename>", "assets", send_asset)
+    app.jinja_env.globals["asset_url"] = asset_url
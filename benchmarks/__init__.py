@@ -0,0 +1,2 @@
+# Benchmark suite: generate.py builds a synthetic database, run.py drives the
+# app with a concurrent workload and compare.py diffs two result files.
@@ -0,0 +1,57 @@
+import argparse, json
+
+
+# Compares two result files written by benchmarks.run --out, route by route.
+# Latency changes above --threshold percent are flagged.
+
+METRICS = ("p50_ms", "p95_ms", "p99_ms", "throughput_rps", "statements_per_request")
+
+
+def change(before, after):
+    if before in (None, 0) or after is None:
+        return None
+    return (after - before) / before * 100
+
+
+def compare(base, new, threshold=10.0):
+    # returns rows of (route, metric, before, after, percent change, flagged)
+    rows = []
+    routes = ["total"] + sorted(set(base["routes"]) | set(new["routes"]))
+    for route in routes:
+        before = base["total"] if route == "total" else base["routes"].get(route, {})
+        after = new["total"] if route == "total" else new["routes"].get(route, {})
+        for metric in METRICS:
+            if metric not in before and metric not in after:
+                continue
+            percent = change(before.get(metric), after.get(metric))
+            # lower is better except for throughput
+            worse = percent is not None and (-percent if metric == "throughput_rps" else percent) > threshold
+            if metric == "statements_per_request":
+                worse = percent is not None and percent > 0
+            rows.append((route, metric, before.get(metric), after.get(metric), percent, worse))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change worth flagging")
+    args = parser.parse_args(argv)
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    regressions = 0
+    print(f"{'route':<16}{'metric':<24}{'base':>10}{'new':>10}{'change':>10}")
+    for route, metric, before, after, percent, worse in compare(base, new, args.threshold):
+        shown = "-" if percent is None else f"{percent:+.1f}%"
+        print(f"{route:<16}{metric:<24}{'-' if before is None else before:>10}{'-' if after is None else after:>10}"
+              f"{shown:>10}{'  <-- worse' if worse else ''}")
+        regressions += worse
+    print(f"{regressions} regression(s) above {args.threshold}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import argparse, os, random, sqlite3, sys, time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from migrations import migrate, LATEST_VERSION
+from werkzeug.security import generate_password_hash
+
+
+# Builds a synthetic library.db for benchmarking. Popularity is skewed the
+# way a real library is: a few titles and a few members account for most of
+# the loans (Zipf-like weights), and most loans are old and returned.
+
+ADMIN_USERNAME = "bench"
+ADMIN_PASSWORD = "bench"
+
+WORDS = ("war peace river night garden empire shadow light storm city stone glass winter summer "
+         "forty rules love alchemist secret history world journey island ocean fire silent king "
+         "queen soldier tactics infantry battle strategy leader mountain desert road letters").split()
+FIRST_NAMES = "Ali Sara Omar Ayesha Bilal Fatima Hamza Zainab Usman Maryam Imran Hina Tariq Nadia".split()
+LAST_NAMES = "Khan Ahmed Malik Hussain Qureshi Shah Butt Chaudhry Raza Iqbal Sheikh Mirza".split()
+
+
+def zipf_weights(n, s=1.1):
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def skewed_choices(rng, population, s, k):
+    # k draws where the i-th item of population has weight 1 / i**s
+    cumulative, total = [], 0.0
+    for weight in zipf_weights(len(population), s):
+        total += weight
+        cumulative.append(total)
+    return rng.choices(population, cum_weights=cumulative, k=k)
+
+
+def title(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).title()
+
+
+def generate(path, books=5000, authors=800, publishers=120, genres=40, users=2000, loans=50000,
+             years=3, open_days=45, overdue_ratio=0.01, seed=42, batch=10000):
+    for stale in (path, path + "-wal", path + "-shm"):
+        if os.path.exists(stale):
+            os.remove(stale)
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+
+    # base tables only; the remaining migrations build their derived data
+    # (search index, counters, ...) from scratch once the rows are loaded
+    migrate(conn, target=1)
+    started = time.perf_counter()
+
+    conn.executemany("INSERT INTO authors (author_id, name) VALUES (?, ?)",
+                     ((i, f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}") for i in range(1, authors + 1)))
+    conn.executemany("INSERT INTO publishers (publisher_id, name) VALUES (?, ?)",
+                     ((i, f"{rng.choice(LAST_NAMES)} Press {i}") for i in range(1, publishers + 1)))
+    conn.executemany("INSERT INTO genres (genre_id, genre_name) VALUES (?, ?)",
+                     ((i, f"{rng.choice(WORDS).title()} {i}") for i in range(1, genres + 1)))
+
+    book_authors = skewed_choices(rng, range(1, authors + 1), 1.1, books)
+    book_rows, book_genres = [], []
+    for book_id in range(1, books + 1):
+        copies = rng.choice((1, 1, 2, 2, 3, 5))
+        book_rows.append((book_id, title(rng), f"978{book_id:010d}", str(rng.randint(1, 5)), copies, copies,
+                          rng.randint(1, 60), 'available', rng.randint(1950, 2025),
+                          book_authors[book_id - 1], rng.randint(1, publishers)))
+        for genre_id in rng.sample(range(1, genres + 1), rng.randint(1, min(3, genres))):
+            book_genres.append((book_id, genre_id))
+    conn.executemany("""
+        INSERT INTO books (book_id, title, isbn, edition, copies_total, copies_available, shelf_number,
+                           status, published_year, author_id, publisher_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, book_rows)
+    conn.executemany("INSERT INTO book_genres (book_id, genre_id) VALUES (?, ?)", book_genres)
+
+    conn.executemany("""
+        INSERT INTO users (user_id, username, pa_pss_number, email_id, phone_number, address, is_active, date_activated)
+        VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+    """, ((i, f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}", f"{rng.choice(('PA', 'PSS'))}{100000 + i}",
+           f"member{i}@example.com", f"0300{i:07d}", f"Block {i % 40}, Lines", "2024-01-01 00:00:00")
+          for i in range(1, users + 1)))
+
+    # loans in date order: popular books and active members borrow far more
+    # often; recent loans are mostly still out, a few old ones never came back
+    book_ids = list(range(1, books + 1))
+    rng.shuffle(book_ids)  # popularity independent of id order
+    user_ids = list(range(1, users + 1))
+    rng.shuffle(user_ids)
+    loan_books = skewed_choices(rng, book_ids, 1.1, loans)
+    loan_users = skewed_choices(rng, user_ids, 0.8, loans)
+    copies_out = {}
+    copies_total = {row[0]: row[4] for row in book_rows}
+    open_loans = set()
+    now = datetime.now()
+    span = years * 365
+    rows = []
+    for record_id in range(1, loans + 1):
+        book_id, user_id = loan_books[record_id - 1], loan_users[record_id - 1]
+        age = span * (1 - record_id / loans)
+        issued = now - timedelta(days=age, minutes=rng.uniform(0, 600))
+        due = issued + timedelta(days=30)
+        wants_open = rng.random() < (0.8 if age < open_days else overdue_ratio)
+        is_open = (wants_open and copies_out.get(book_id, 0) < copies_total[book_id]
+                   and (user_id, book_id) not in open_loans)
+        if is_open:
+            open_loans.add((user_id, book_id))
+            copies_out[book_id] = copies_out.get(book_id, 0) + 1
+            returned = '%Y-%m-%d'
+        else:
+            returned = (issued + timedelta(days=rng.uniform(1, 45))).strftime('%Y-%m-%d %H:%M:%S')
+        rows.append((record_id, issued.strftime('%Y-%m-%d %H:%M:%S'), returned, due.strftime('%Y-%m-%d %H:%M:%S'),
+                     0 if is_open else 1, book_id, user_id))
+        if len(rows) >= batch:
+            _insert_loans(conn, rows)
+            rows = []
+    _insert_loans(conn, rows)
+    conn.executemany("""
+        UPDATE books SET copies_available = copies_total - ?,
+                         status = CASE WHEN copies_total - ? > 0 THEN 'available' ELSE 'unavailable' END
+        WHERE book_id = ?
+    """, ((out, out, book_id) for book_id, out in copies_out.items()))
+
+    conn.execute("INSERT INTO admin (username, password, email_id, phone_number, is_active) VALUES (?, ?, ?, ?, 1)",
+                 (ADMIN_USERNAME, generate_password_hash(ADMIN_PASSWORD), "bench@example.com", "0"))
+    conn.commit()
+    loaded = time.perf_counter() - started
+
+    migrate(conn)
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    return {"path": path, "books": books, "authors": authors, "publishers": publishers, "genres": genres,
+            "users": users, "loans": loans, "open_loans": sum(copies_out.values()),
+            "schema_version": LATEST_VERSION, "seconds": round(time.perf_counter() - started, 2),
+            "load_seconds": round(loaded, 2)}
+
+
+def _insert_loans(conn, rows):
+    conn.executemany("""
+        INSERT INTO users_record (users_record_id, issue_date, return_date, due_date, is_returned, book_id, user_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic library database for benchmarks.")
+    parser.add_argument("--out", default="bench_library.db")
+    parser.add_argument("--books", type=int, default=5000)
+    parser.add_argument("--authors", type=int, default=800)
+    parser.add_argument("--publishers", type=int, default=120)
+    parser.add_argument("--genres", type=int, default=40)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--loans", type=int, default=50000)
+    parser.add_argument("--years", type=int, default=3, help="years of loan history")
+    parser.add_argument("--open-days", type=int, default=45, help="loans younger than this are mostly still out")
+    parser.add_argument("--overdue-ratio", type=float, default=0.01, help="share of older loans never returned")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+    summary = generate(args.out, args.books, args.authors, args.publishers, args.genres, args.users,
+                       args.loans, args.years, args.open_days, args.overdue_ratio, args.seed)
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
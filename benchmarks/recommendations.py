@@ -0,0 +1,91 @@
+import argparse, os, random, sqlite3, statistics, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import recommendations
+from benchmarks.generate import generate
+from circulation import immediate_transaction, issue_in_transaction, return_in_transaction, ISSUED
+
+
+# Times the co-borrowing recommendations on a large synthetic history: a
+# full rebuild of book_pairs, the extra cost record_loan adds to each issue
+# and top-N lookups for random books. Without --db a million-loan database
+# is generated first (this takes a few minutes).
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def timings(values):
+    return {"p50_ms": round(percentile(values, 50) * 1000, 3), "p99_ms": round(percentile(values, 99) * 1000, 3),
+            "mean_ms": round(statistics.mean(values) * 1000, 3)}
+
+
+def run(db, issues=500, lookups=5000, limit=10, seed=42):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    loans = conn.execute("SELECT COUNT(*) FROM users_record").fetchone()[0]
+    max_book_id = conn.execute("SELECT MAX(book_id) FROM books").fetchone()[0]
+    user_ids = [row[0] for row in conn.execute("SELECT user_id FROM users WHERE is_deleted = 0")]
+
+    started = time.perf_counter()
+    with immediate_transaction(conn):
+        pairs = recommendations.rebuild(conn)
+    rebuild_seconds = time.perf_counter() - started
+
+    # issue (and return again, to keep copies on the shelf) random loans,
+    # timing record_loan on its own
+    pair_times, issued = [], 0
+    while issued < issues:
+        user_id, book_id = rng.choice(user_ids), rng.randint(1, max_book_id)
+        with immediate_transaction(conn):
+            status, record_id = issue_in_transaction(conn, user_id, book_id)
+            if status != ISSUED:
+                continue
+            conn.execute("SAVEPOINT timing")
+            started = time.perf_counter()
+            recommendations.record_loan(conn, user_id, book_id)
+            pair_times.append(time.perf_counter() - started)
+            conn.execute("ROLLBACK TO timing")  # issue_in_transaction already counted the pairs
+            conn.execute("RELEASE timing")
+            return_in_transaction(conn, record_id)
+        issued += 1
+
+    lookup_times = []
+    for _ in range(lookups):
+        book_id = rng.randint(1, max_book_id)
+        started = time.perf_counter()
+        recommendations.related_books(conn, book_id, limit)
+        lookup_times.append(time.perf_counter() - started)
+    conn.close()
+    return {"loans": loans, "pairs": pairs, "window": recommendations.PAIR_WINDOW,
+            "rebuild_seconds": round(rebuild_seconds, 2),
+            "record_loan": timings(pair_times), "related_books": timings(lookup_times)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the co-borrowing recommendations.")
+    parser.add_argument("--db", help="existing benchmark database (generated if omitted)")
+    parser.add_argument("--out", default="bench_recommendations.db", help="where to generate the database")
+    parser.add_argument("--loans", type=int, default=1000000)
+    parser.add_argument("--books", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--issues", type=int, default=500, help="loans to issue while timing record_loan")
+    parser.add_argument("--lookups", type=int, default=5000)
+    parser.add_argument("--limit", type=int, default=10, help="related books per lookup")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+    db = args.db
+    if db is None:
+        summary = generate(args.out, books=args.books, users=args.users, loans=args.loans, seed=args.seed)
+        print(f"generated {summary['path']} in {summary['seconds']}s")
+        db = args.out
+    for key, value in run(db, args.issues, args.lookups, args.limit, args.seed).items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
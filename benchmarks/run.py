@@ -0,0 +1,311 @@
+import argparse, http.cookiejar, json, os, platform, random, sqlite3, sys, threading, time
+import urllib.error, urllib.parse, urllib.request
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.generate import ADMIN_USERNAME, ADMIN_PASSWORD, WORDS
+
+
+# Drives the app with a concurrent, weighted mix of requests and reports
+# latency percentiles, throughput and SQL statements per request for every
+# route. By default requests go through Flask's test client in this process
+# (so statements can be counted); with --url they go over HTTP to a running
+# server, e.g. gunicorn started against the same database.
+
+# operation -> relative weight
+MIX = {
+    "search": 20,
+    "books": 12,
+    "books_page": 5,
+    "dashboard": 10,
+    "users": 5,
+    "records": 10,
+    "records_search": 5,
+    "issue_form": 3,
+    "user_search": 6,
+    "book_search": 6,
+    "issue": 8,
+    "return": 8,
+    "scan": 8,
+    "authors": 4,
+    "publishers": 3,
+    "genres": 4,
+}
+
+
+class Workload:
+    # ids and names sampled from the benchmark database, shared by all workers
+    def __init__(self, db, seed):
+        conn = sqlite3.connect(f"file:{db}?mode=ro", uri=True)
+        self.usernames = [row[0] for row in conn.execute("SELECT username FROM users WHERE is_deleted = 0")]
+        self.titles = [row[0] for row in conn.execute("SELECT title FROM books")]
+        self.user_ids = [row[0] for row in conn.execute("SELECT user_id FROM users WHERE is_deleted = 0")]
+        self.member_numbers = [row[0] for row in conn.execute("SELECT pa_pss_number FROM users WHERE is_deleted = 0")]
+        self.isbns = [row[0] for row in conn.execute("SELECT isbn FROM books")]
+        self.max_book_id = conn.execute("SELECT MAX(book_id) FROM books").fetchone()[0] or 1
+        self.max_record_id = conn.execute("SELECT MAX(users_record_id) FROM users_record").fetchone()[0] or 1
+        open_loans = [row[0] for row in conn.execute("SELECT users_record_id FROM users_record WHERE is_returned = 0")]
+        conn.close()
+        random.Random(seed).shuffle(open_loans)
+        self.open_loans = open_loans
+        self.lock = threading.Lock()
+
+    def next_open_loan(self):
+        with self.lock:
+            return self.open_loans.pop() if self.open_loans else None
+
+    def request(self, operation, rng):
+        # returns (method, path, form data) for one operation
+        if operation == "search":
+            return "GET", "/books?" + urllib.parse.urlencode({"query": rng.choice(WORDS)}), None
+        if operation == "books":
+            return "GET", "/books", None
+        if operation == "books_page":
+            return "GET", f"/books?after={rng.randint(1, self.max_book_id)}", None
+        if operation == "dashboard":
+            return "GET", "/admin_dashboard", None
+        if operation == "users":
+            return "GET", "/view_users", None
+        if operation == "records":
+            return "GET", "/view_users_record", None
+        if operation == "records_search":
+            return "GET", "/view_users_record?" + urllib.parse.urlencode(
+                {"search": rng.choice(self.usernames).split()[-1]}), None
+        if operation == "issue_form":
+            return "GET", "/issue_book", None
+        if operation == "user_search":
+            return "GET", "/api/users/search?" + urllib.parse.urlencode(
+                {"q": rng.choice(self.usernames)[:rng.randint(1, 4)]}), None
+        if operation == "book_search":
+            return "GET", "/api/books/search?" + urllib.parse.urlencode(
+                {"q": rng.choice(self.titles)[:rng.randint(1, 6)], "available": 1}), None
+        if operation == "issue":
+            return "POST", "/issue_book", {"user_id": rng.choice(self.user_ids),
+                                           "book_id": rng.randint(1, self.max_book_id)}
+        if operation == "return":
+            users_record_id = self.next_open_loan() or rng.randint(1, self.max_record_id)
+            return "POST", f"/return_book/{users_record_id}", None
+        if operation == "scan":
+            # a desk scanning a member card and a book: issues it, or returns it if already out
+            return "POST", "/api/scan", {"member": rng.choice(self.member_numbers), "book": rng.choice(self.isbns)}
+        if operation in ("authors", "publishers", "genres"):
+            return "GET", f"/{operation}", None
+        raise ValueError(f"unknown operation {operation}")
+
+
+# SQL statements executed by the current thread, counted with a trace
+# callback installed on every pooled connection
+_counter = threading.local()
+
+
+def _count_statements(conn):
+    def trace(statement):
+        # statements run by triggers are reported as "-- TRIGGER name"
+        if not statement.startswith("--"):
+            _counter.statements = getattr(_counter, "statements", 0) + 1
+    conn.set_trace_callback(trace)
+
+
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def login(self):
+        response = self.client.post("/login", data={"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD})
+        if response.status_code != 302:
+            raise SystemExit(f"could not log in as {ADMIN_USERNAME} (status {response.status_code})")
+
+    def request(self, method, path, data):
+        _counter.statements = 0
+        response = self.client.open(path, method=method, data=data)
+        response.get_data()  # streamed exports run their queries while the body is read
+        response.close()
+        return response.status_code, _counter.statements
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # time the route itself, not the page it redirects to
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def login(self):
+        status, _ = self.request("POST", "/login", {"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD})
+        if status != 302:
+            raise SystemExit(f"could not log in as {ADMIN_USERNAME} (status {status})")
+
+    def request(self, method, path, data):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        if method == "POST" and body is None:
+            body = b""
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method)) as response:
+                response.read()
+                return response.status, None
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code, None
+
+
+def percentile(ordered, fraction):
+    # nearest-rank percentile of an already sorted list
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def summarize(samples, seconds):
+    # samples: (operation, milliseconds, status, statements or None)
+    routes = {}
+    for operation in sorted({sample[0] for sample in samples}):
+        rows = [sample for sample in samples if sample[0] == operation]
+        latencies = sorted(row[1] for row in rows)
+        statements = [row[3] for row in rows if row[3] is not None]
+        routes[operation] = {
+            "count": len(rows),
+            "errors": sum(1 for row in rows if row[2] is None or row[2] >= 400),
+            "p50_ms": round(percentile(latencies, 0.50), 3),
+            "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3),
+            "mean_ms": round(sum(latencies) / len(latencies), 3),
+            "max_ms": round(latencies[-1], 3),
+            "throughput_rps": round(len(rows) / seconds, 2) if seconds else None,
+            "statements_per_request": round(sum(statements) / len(statements), 2) if statements else None,
+        }
+    latencies = sorted(sample[1] for sample in samples)
+    total = {
+        "count": len(samples),
+        "errors": sum(route["errors"] for route in routes.values()),
+        "seconds": round(seconds, 3),
+        "throughput_rps": round(len(samples) / seconds, 2) if seconds else None,
+        "p50_ms": round(percentile(latencies, 0.50), 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95), 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99), 3) if latencies else None,
+    }
+    return routes, total
+
+
+def run(db, url=None, requests=2000, concurrency=4, warmup=50, mix=MIX, seed=1):
+    if url:
+        make_client = lambda: HttpClient(url)
+    else:
+        # the app reads LIBRARY_DB when it is first imported
+        os.environ["LIBRARY_DB"] = os.path.abspath(db)
+        import db_pool
+        db_pool.CONNECT_HOOKS.append(_count_statements)
+        from app import app
+        make_client = lambda: TestClient(app)
+
+    workload = Workload(db, seed)
+    operations, weights = zip(*mix.items())
+    samples, errors = [], []
+    samples_lock = threading.Lock()
+    remaining = iter(range(warmup + requests))
+    remaining_lock = threading.Lock()
+
+    def worker(number):
+        rng = random.Random(seed * 1000 + number)
+        client = make_client()
+        client.login()
+        while True:
+            with remaining_lock:
+                index = next(remaining, None)
+            if index is None:
+                return
+            operation = rng.choices(operations, weights)[0]
+            method, path, data = workload.request(operation, rng)
+            started = time.perf_counter()
+            try:
+                status, statements = client.request(method, path, data)
+            except Exception as e:
+                status, statements = None, None
+                with samples_lock:
+                    errors.append(f"{operation} {path}: {e!r}")
+            elapsed = (time.perf_counter() - started) * 1000
+            if index >= warmup:
+                with samples_lock:
+                    samples.append((operation, elapsed, status, statements))
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    routes, total = summarize(samples, seconds)
+    return {
+        "meta": {
+            "db": os.path.abspath(db),
+            "target": url or "test_client",
+            "requests": requests,
+            "concurrency": concurrency,
+            "warmup": warmup,
+            "seed": seed,
+            "mix": dict(mix),
+            "started_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+        },
+        "total": total,
+        "routes": routes,
+        "errors": errors[:50],
+    }
+
+
+def print_report(result):
+    meta, total = result["meta"], result["total"]
+    print(f"{meta['target']}  {total['count']} requests  concurrency {meta['concurrency']}  "
+          f"{total['seconds']}s  {total['throughput_rps']} req/s  errors {total['errors']}")
+    print(f"{'route':<16}{'count':>7}{'err':>5}{'p50':>9}{'p95':>9}{'p99':>9}{'mean':>9}{'req/s':>9}{'sql/req':>9}")
+    for name, route in result["routes"].items():
+        statements = route["statements_per_request"]
+        print(f"{name:<16}{route['count']:>7}{route['errors']:>5}{route['p50_ms']:>9.2f}{route['p95_ms']:>9.2f}"
+              f"{route['p99_ms']:>9.2f}{route['mean_ms']:>9.2f}{route['throughput_rps']:>9.1f}"
+              f"{'-' if statements is None else statements:>9}")
+    for error in result["errors"]:
+        print("error:", error)
+
+
+def parse_mix(values):
+    # --mix search=40 --mix issue=0 overrides single weights
+    mix = dict(MIX)
+    for value in values or ():
+        name, _, weight = value.partition("=")
+        if name not in MIX or not weight.isdigit():
+            raise SystemExit(f"bad --mix {value!r}; use one of {', '.join(MIX)} with an integer weight")
+        mix[name] = int(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the benchmark workload against the library app.")
+    parser.add_argument("--db", default="bench_library.db", help="database made by benchmarks.generate")
+    parser.add_argument("--url", help="benchmark a running server (e.g. http://127.0.0.1:8000) instead of the test client")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=50, help="requests run before measuring")
+    parser.add_argument("--mix", action="append", metavar="OPERATION=WEIGHT")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.db):
+        raise SystemExit(f"{args.db} not found; create it with python -m benchmarks.generate --out {args.db}")
+
+    result = run(args.db, args.url, args.requests, args.concurrency, args.warmup, parse_mix(args.mix), args.seed)
+    print_report(result)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
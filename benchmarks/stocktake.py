@@ -0,0 +1,97 @@
+import argparse, os, random, sqlite3, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stocktake
+from benchmarks.generate import generate
+
+
+# Times a full stocktake: every copy on the shelf is scanned (by ISBN or by
+# copy barcode), with a share of copies left unscanned (missing), scanned on
+# another shelf (misplaced) and unknown codes mixed in. Reports the time to
+# load the scans and to compare them with the catalog, and checks that the
+# comparison finds what was planted. Without --db a library of about 50k
+# copies is generated first.
+
+
+def scan_file(conn, rng, barcode_share, missing, misplaced, unknown):
+    # scanner file lines plus the number of copies planted per kind
+    copies = conn.execute("""
+        SELECT book_copies.barcode, book_copies.shelf_number, books.isbn FROM book_copies
+        JOIN books ON books.book_id = book_copies.book_id
+        WHERE book_copies.state = 'available'
+    """).fetchall()
+    shelves = sorted({row[1] for row in copies}, key=str)
+    by_shelf, planted = {}, {"missing": 0, "misplaced": 0, "unknown": 0}
+    for barcode, shelf, isbn in copies:
+        roll = rng.random()
+        if roll < missing:
+            planted["missing"] += 1
+            continue
+        if roll < missing + misplaced:
+            planted["misplaced"] += 1
+            shelf = rng.choice([other for other in shelves if other != shelf] or shelves)
+        by_shelf.setdefault(shelf, []).append(barcode if rng.random() < barcode_share else isbn)
+    for _ in range(int(len(copies) * unknown)):
+        planted["unknown"] += 1
+        rng.choice(list(by_shelf.values())).append(f"UNKNOWN{rng.randrange(10 ** 9)}")
+    lines = []
+    for shelf, codes in by_shelf.items():
+        rng.shuffle(codes)
+        lines.append(f"SHELF {shelf}\n")
+        lines.extend(f"{code}\n" for code in codes)
+    return lines, len(copies), planted
+
+
+def run(db, barcode_share=0.3, missing=0.01, misplaced=0.01, unknown=0.005, seed=42):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    lines, expected, planted = scan_file(conn, rng, barcode_share, missing, misplaced, unknown)
+
+    session_id = stocktake.create_session(conn, "benchmark")
+    started = time.perf_counter()
+    loaded = stocktake.add_scans(conn, session_id, stocktake.read_scans(lines))
+    load_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    summary = stocktake.compare(conn, session_id)
+    compare_seconds = time.perf_counter() - started
+
+    # leave the database as it was
+    conn.execute("DELETE FROM stocktake_results WHERE session_id = ?", (session_id,))
+    conn.execute("DELETE FROM stocktake_scans WHERE session_id = ?", (session_id,))
+    conn.execute("DELETE FROM stocktake_sessions WHERE session_id = ?", (session_id,))
+    conn.close()
+    # ISBN scans of a misplaced title may pair with a different copy of it
+    # on the scanned shelf, so missing/misplaced can shift between each other
+    return {"copies_on_shelves": expected, "scans": loaded["scans"], "shelves": summary["shelves"],
+            "planted": planted,
+            "reported": {kind: summary[kind] for kind in stocktake.KINDS},
+            "load_seconds": round(load_seconds, 2), "scans_per_second": round(loaded["scans"] / load_seconds),
+            "compare_seconds": round(compare_seconds, 2)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark a full stocktake.")
+    parser.add_argument("--db", help="existing benchmark database (generated if omitted)")
+    parser.add_argument("--out", default="bench_stocktake.db", help="where to generate the database")
+    parser.add_argument("--books", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--loans", type=int, default=100000)
+    parser.add_argument("--barcode-share", type=float, default=0.3, help="share of copies scanned by barcode")
+    parser.add_argument("--missing", type=float, default=0.01, help="share of copies not scanned")
+    parser.add_argument("--misplaced", type=float, default=0.01, help="share of copies scanned on another shelf")
+    parser.add_argument("--unknown", type=float, default=0.005, help="unknown codes per copy")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+    db = args.db
+    if db is None:
+        summary = generate(args.out, books=args.books, users=args.users, loans=args.loans, seed=args.seed)
+        print(f"generated {summary['path']} in {summary['seconds']}s")
+        db = args.out
+    for key, value in run(db, args.barcode_share, args.missing, args.misplaced, args.unknown, args.seed).items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
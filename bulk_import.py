@@ -0,0 +1,189 @@
+import csv, json, time
+from datetime import datetime
+from duplicates import ENTITIES as NAMED_ENTITIES, normalize
+from scanner import isbn_key
+from copies import add_copies_many
+
+
+# Streaming catalog import. Rows are read one at a time from a CSV or
+# JSON-lines file, authors/publishers/genres are resolved through in-memory
+# normalized name -> id maps (created when missing, see duplicates.py) so
+# "J.R.R. Tolkien" and "Tolkien, J R R" land on the same author, and books are written with
+# executemany in batched transactions, each with its copies (copies.py). A bad row is reported and skipped; it
+# never aborts the load.
+
+BATCH_SIZE = 1000
+FORMATS = ('csv', 'jsonl')
+# CSV genre lists are separated with ';' or '|'
+GENRE_SEPARATORS = (';', '|')
+
+
+def detect_format(filename):
+    name = (filename or '').lower()
+    if name.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return 'csv'
+
+
+def read_rows(stream, fmt):
+    # yields (line number, row dict) from a text stream opened with newline=''
+    if fmt == 'jsonl':
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_number, row if isinstance(row, dict) else None
+    else:
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, {(key or '').strip().lower(): value for key, value in row.items()}
+
+
+def _key(name):
+    return ' '.join(name.split()).casefold()
+
+
+def _text(row, field):
+    value = row.get(field)
+    return str(value).strip() if value is not None else ''
+
+
+def _genres(row):
+    value = row.get('genres', row.get('genre'))
+    if isinstance(value, list):
+        names = value
+    else:
+        names = [str(value or '')]
+        for separator in GENRE_SEPARATORS:
+            names = [part for name in names for part in name.split(separator)]
+    return [str(name).strip() for name in names if str(name).strip()]
+
+
+class Importer:
+    def __init__(self, conn, batch_size=BATCH_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.inserted = 0
+        self.rejects = []
+        self.max_year = datetime.now().year + 1
+        # name -> id maps for the reference tables and the ISBNs we already hold
+        self.authors = self._name_map("authors")
+        self.publishers = self._name_map("publishers")
+        self.genres = self._name_map("genres")
+        self.isbns = {isbn_key(row[0]) for row in conn.execute("SELECT isbn FROM books")}
+
+    def _name_map(self, entity):
+        id_column, name_column, _ = NAMED_ENTITIES[entity]
+        names = {}
+        for name, id in self.conn.execute(f"""SELECT {name_column}, {id_column} FROM {entity}
+                                             WHERE is_deleted = 0 ORDER BY {id_column}"""):
+            names.setdefault(normalize(entity, name) or _key(name or ''), id)
+        return names
+
+    def _resolve(self, names, entity, name):
+        key = normalize(entity, name) or _key(name)
+        if key not in names:
+            name_column = NAMED_ENTITIES[entity][1]
+            names[key] = self.conn.execute(f"INSERT INTO {entity} ({name_column}, normalized_name) VALUES (?, ?)",
+                                           (name, normalize(entity, name))).lastrowid
+        return names[key]
+
+    def _validate(self, row):
+        # returns (book values, genre names) or raises ValueError with the reason
+        if row is None:
+            raise ValueError("unreadable row")
+        title, isbn = _text(row, 'title'), _text(row, 'isbn')
+        author, publisher = _text(row, 'author'), _text(row, 'publisher')
+        if not title:
+            raise ValueError("missing title")
+        if not isbn:
+            raise ValueError("missing isbn")
+        if not author or not publisher:
+            raise ValueError("missing author or publisher")
+        if isbn_key(isbn) in self.isbns:
+            raise ValueError(f"duplicate isbn {isbn}")
+        try:
+            year = int(_text(row, 'published_year') or _text(row, 'year'))
+        except ValueError:
+            raise ValueError("bad year")
+        if not 0 < year <= self.max_year:
+            raise ValueError(f"bad year {year}")
+        try:
+            copies = int(_text(row, 'copies_total') or 1)
+            shelf = int(_text(row, 'shelf_number') or 0)
+        except ValueError:
+            raise ValueError("copies_total and shelf_number must be numbers")
+        if copies < 0:
+            raise ValueError("copies_total cannot be negative")
+        edition = _text(row, 'edition') or '1'
+        return (title, isbn, edition, copies, shelf, year, author, publisher), _genres(row)
+
+    def _write_batch(self, batch):
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # assign book ids ourselves so book_genres can be written with
+            # executemany too; safe because we hold the write lock
+            next_id = conn.execute("""
+                SELECT MAX(COALESCE((SELECT MAX(book_id) FROM books), 0),
+                           COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'books'), 0))
+            """).fetchone()[0] + 1
+            books, book_genres, book_copies = [], [], []
+            for book_id, ((title, isbn, edition, copies, shelf, year, author, publisher), genres) \
+                    in enumerate(batch, start=next_id):
+                author_id = self._resolve(self.authors, "authors", author)
+                publisher_id = self._resolve(self.publishers, "publishers", publisher)
+                # the counters start at zero; adding the copies fills them in
+                books.append((book_id, title, isbn, edition, 0, 0, shelf, 'unavailable', year, author_id, publisher_id))
+                book_copies.append((book_id, copies, shelf))
+                genre_ids = {self._resolve(self.genres, "genres", genre) for genre in genres}
+                book_genres.extend((book_id, genre_id) for genre_id in genre_ids)
+            conn.executemany("""
+                INSERT INTO books (book_id, title, isbn, edition, copies_total, copies_available,
+                                   shelf_number, status, published_year, author_id, publisher_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, books)
+            conn.executemany("INSERT INTO book_genres (book_id, genre_id) VALUES (?, ?)", book_genres)
+            add_copies_many(conn, book_copies)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            # ids handed out for rows that were rolled back are no longer valid
+            self.authors = self._name_map("authors")
+            self.publishers = self._name_map("publishers")
+            self.genres = self._name_map("genres")
+            raise
+        self.inserted += len(books)
+
+    def run(self, rows):
+        # rows: iterable of (line number, row dict); returns the import report
+        started = time.perf_counter()
+        batch = []
+        for line_number, row in rows:
+            try:
+                book, genres = self._validate(row)
+            except ValueError as e:
+                self.rejects.append((line_number, str(e)))
+                continue
+            self.isbns.add(isbn_key(book[1]))
+            batch.append((book, genres))
+            if len(batch) >= self.batch_size:
+                self._write_batch(batch)
+                batch = []
+        if batch:
+            self._write_batch(batch)
+        seconds = time.perf_counter() - started
+        return {
+            "inserted": self.inserted,
+            "rejected": len(self.rejects),
+            "rejects": self.rejects,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round((self.inserted + len(self.rejects)) / seconds, 1) if seconds else 0.0,
+        }
+
+
+def import_books(conn, stream, fmt='csv', batch_size=BATCH_SIZE):
+    return Importer(conn, batch_size).run(read_rows(stream, fmt))
@@ -0,0 +1,186 @@
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from rollups import record_issue, record_return
+from recommendations import record_loan
+
+
+# Issuing and returning books. Each operation runs in one BEGIN IMMEDIATE
+# transaction: the write lock is taken up front, a copy is taken off the
+# shelf with a guarded UPDATE of its state (never read-modify-write in
+# Python; triggers move books.copies_available, see copies.py) and there is
+# a single commit, so concurrent workers can neither oversell a book nor
+# lose a returned copy. The analytics rollups (rollups.py) and the co-borrowing
+# pairs (recommendations.py) are updated in the same transaction.
+
+LOAN_DAYS = 30
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# users_record.return_date is NOT NULL in the live schema; open loans carry
+# this placeholder until the book comes back
+NOT_RETURNED = '%Y-%m-%d'
+
+# result codes
+ISSUED = 'issued'
+RETURNED = 'returned'
+UNAVAILABLE = 'unavailable'
+ALREADY_ISSUED = 'already_issued'
+ALREADY_RETURNED = 'already_returned'
+USER_NOT_FOUND = 'user_not_found'
+BOOK_NOT_FOUND = 'book_not_found'
+RECORD_NOT_FOUND = 'record_not_found'
+
+MESSAGES = {
+    ISSUED: "Book issued successfully!",
+    RETURNED: "Book returned successfully!",
+    UNAVAILABLE: "This book is currently unavailable.",
+    ALREADY_ISSUED: "This user already has this book issued and has not returned it!",
+    ALREADY_RETURNED: "This book has already been returned.",
+    USER_NOT_FOUND: "User not found!",
+    BOOK_NOT_FOUND: "Book not found!",
+    RECORD_NOT_FOUND: "Record not found!",
+}
+
+
+@contextmanager
+def immediate_transaction(conn):
+    # take the write lock now rather than at the first write, so two workers
+    # cannot both read "1 copy left" and then both issue it
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def issue_book(conn, user_id, book_id, now=None, copy_id=None):
+    # returns (result code, users_record_id or None)
+    with immediate_transaction(conn):
+        return issue_in_transaction(conn, user_id, book_id, now, copy_id)
+
+
+def return_book(conn, users_record_id, now=None):
+    # returns (result code, book_id or None)
+    with immediate_transaction(conn):
+        return return_in_transaction(conn, users_record_id, now)
+
+
+def issue_in_transaction(conn, user_id, book_id, now=None, copy_id=None):
+    # the issue itself, for callers that already hold a write transaction;
+    # copy_id: the copy scanned at the desk, else the first one on the shelf
+    if conn.execute("SELECT 1 FROM users WHERE user_id = ? AND is_deleted = 0", (user_id,)).fetchone() is None:
+        return USER_NOT_FOUND, None
+
+    open_loan = conn.execute("""
+        SELECT 1 FROM users_record
+        WHERE user_id = ? AND book_id = ? AND is_returned = 0
+    """, (user_id, book_id)).fetchone()
+    if open_loan:
+        return ALREADY_ISSUED, None
+
+    # take a copy only if it is on the shelf
+    if copy_id is None:
+        copy = conn.execute("""
+            SELECT copy_id FROM book_copies WHERE book_id = ? AND state = 'available' ORDER BY copy_id LIMIT 1
+        """, (book_id,)).fetchone()
+        copy_id = copy[0] if copy else None
+    taken = conn.execute("""
+        UPDATE book_copies SET state = 'on_loan'
+        WHERE copy_id = ? AND book_id = ? AND state = 'available'
+    """, (copy_id, book_id)).rowcount if copy_id is not None else 0
+    if not taken:
+        exists = conn.execute("SELECT 1 FROM books WHERE book_id = ?", (book_id,)).fetchone()
+        return (UNAVAILABLE if exists else BOOK_NOT_FOUND), None
+
+    issue_date = now or datetime.now()
+    due_date = issue_date + timedelta(days=LOAN_DAYS)
+    cursor = conn.execute("""
+        INSERT INTO users_record (user_id, book_id, copy_id, issue_date, due_date, is_returned, return_date)
+        VALUES (?, ?, ?, ?, ?, 0, ?)
+    """, (user_id, book_id, copy_id, issue_date.strftime(DATE_FORMAT), due_date.strftime(DATE_FORMAT), NOT_RETURNED))
+    record_issue(conn, user_id, book_id, issue_date.strftime(DATE_FORMAT))
+    record_loan(conn, user_id, book_id)
+    return ISSUED, cursor.lastrowid
+
+
+def return_in_transaction(conn, users_record_id, now=None):
+    # the return itself, for callers that already hold a write transaction
+    return_date = (now or datetime.now()).strftime(DATE_FORMAT)
+    closed = conn.execute("""
+        UPDATE users_record
+        SET is_returned = 1, return_date = ?
+        WHERE users_record_id = ? AND is_returned = 0
+    """, (return_date, users_record_id)).rowcount
+
+    record = conn.execute("SELECT book_id, user_id, copy_id FROM users_record WHERE users_record_id = ?",
+                          (users_record_id,)).fetchone()
+    if record is None:
+        return RECORD_NOT_FOUND, None
+    if not closed:
+        return ALREADY_RETURNED, record[0]
+
+    # put the copy back on the shelf; a loan without a copy (never expected
+    # after migration 14) frees a copy of the book no open loan holds
+    conn.execute("""
+        UPDATE book_copies SET state = 'available'
+        WHERE state = 'on_loan' AND copy_id = COALESCE(?, (
+            SELECT copy_id FROM book_copies
+            WHERE book_id = ? AND state = 'on_loan' AND copy_id NOT IN (
+                SELECT copy_id FROM users_record WHERE book_id = ? AND is_returned = 0 AND copy_id IS NOT NULL)
+            LIMIT 1))
+    """, (record[2], record[0], record[0]))
+    record_return(conn, record[1], record[0], return_date)
+    return RETURNED, record[0]
+
+
+# batch circulation: many issues/returns in one transaction and one commit
+MAX_BATCH = 500
+ISSUE = 'issue'
+RETURN = 'return'
+INVALID = 'invalid'
+
+
+def _as_id(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def run_batch(conn, items, now=None):
+    # items: dicts like {"user_id": 1, "book_id": 2} (issue) or
+    # {"users_record_id": 3} (return); "action" may be given explicitly.
+    # Every item runs in its own savepoint, so a failing item is rolled back
+    # on its own while the rest of the batch commits together.
+    results = []
+    with immediate_transaction(conn):
+        for index, item in enumerate(items):
+            item = item if isinstance(item, dict) else {}
+            action = item.get('action') or (RETURN if 'users_record_id' in item else ISSUE)
+            result = {"index": index, "action": action}
+            if action == RETURN and _as_id(item.get('users_record_id')) is not None:
+                args = (_as_id(item['users_record_id']),)
+                operation, key = return_in_transaction, 'book_id'
+            elif action == ISSUE and None not in (_as_id(item.get('user_id')), _as_id(item.get('book_id'))):
+                args = (_as_id(item['user_id']), _as_id(item['book_id']))
+                operation, key = issue_in_transaction, 'users_record_id'
+            else:
+                result.update(result=INVALID, ok=False)
+                results.append(result)
+                continue
+
+            conn.execute("SAVEPOINT batch_item")
+            try:
+                code, value = operation(conn, *args, now)
+            except sqlite3.Error as e:
+                conn.execute("ROLLBACK TO batch_item")
+                code, value = 'error', None
+                result["error"] = str(e)
+            conn.execute("RELEASE batch_item")
+            result.update(result=code, ok=code in (ISSUED, RETURNED), **{key: value})
+            results.append(result)
+    return results
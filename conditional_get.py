@@ -0,0 +1,66 @@
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+from flask import request, session, make_response
+from data_versions import read_stamps
+from helper import get_db_connection
+
+
+# Conditional GET for the catalog pages. A page's ETag is derived from the
+# data versions of the tables it shows, its query parameters and the signed
+# in admin (the layout shows the admin's name). A browser revalidating with
+# If-None-Match (or If-Modified-Since) gets a 304 after one lookup in
+# data_versions, without running the page's queries or rendering it.
+
+# every table that feeds a catalog page; triggers keep their versions current
+ENTITIES = ("books", "book_genres", "authors", "publishers", "genres")
+
+
+def _etag(stamps):
+    parts = [request.endpoint, session.get('admin_username') or '']
+    parts += [f"{key}={value}" for key, value in sorted(request.args.items(multi=True))]
+    parts += [f"{entity}:{stamps[entity][0]}" for entity in sorted(stamps)]
+    return hashlib.blake2b("\n".join(parts).encode(), digest_size=16).hexdigest()
+
+
+def _last_modified(stamps):
+    times = [stamp[1] for stamp in stamps.values() if stamp[1]]
+    if not times:
+        return None
+    return datetime.strptime(max(times), '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+
+
+def conditional_get(*entities):
+    # use below @app.route on GET pages built only from the given tables
+    def decorator(view):
+        @wraps(view)
+        def decorated_function(*args, **kwargs):
+            # pending flash messages are rendered into the page, so such a
+            # response must be neither answered with 304 nor cached
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            stamps = read_stamps(get_db_connection(), entities)
+            if len(stamps) != len(entities):
+                return view(*args, **kwargs)  # not migrated yet
+            etag, last_modified = _etag(stamps), _last_modified(stamps)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = (request.if_modified_since is not None and last_modified is not None
+                                and last_modified <= request.if_modified_since)
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # browsers keep the page but must revalidate before showing it
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Cookie')
+            return response
+        return decorated_function
+    return decorator
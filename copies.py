@@ -0,0 +1,128 @@
+import os
+
+
+# Item-level copies. Every physical copy of a book is a book_copies row with
+# its own barcode, shelf, condition and state; a loan (users_record.copy_id)
+# points at the copy that went out. books.copies_total (copies not
+# withdrawn) and books.copies_available (copies on the shelf) stay as
+# counters, kept up to date by triggers on book_copies, so listing pages
+# read them directly and nothing ever recomputes them. The circulation
+# engine changes a copy's state; editing a title only adds or withdraws
+# copies, so outstanding loans are never lost.
+
+AVAILABLE, ON_LOAN, MISSING, WITHDRAWN = "available", "on_loan", "missing", "withdrawn"
+STATES = (AVAILABLE, ON_LOAN, MISSING, WITHDRAWN)
+CONDITIONS = ("new", "good", "fair", "poor", "damaged")
+BARCODE_PREFIX = os.environ.get("COPY_BARCODE_PREFIX", "C")
+
+# the counters computed from scratch, used to seed and verify them
+_RECOUNT = f"""
+    SELECT books.book_id, books.copies_total, books.copies_available,
+           COALESCE(SUM(book_copies.state <> '{WITHDRAWN}'), 0) AS actual_total,
+           COALESCE(SUM(book_copies.state = '{AVAILABLE}'), 0) AS actual_available
+    FROM books LEFT JOIN book_copies ON book_copies.book_id = books.book_id
+    GROUP BY books.book_id
+"""
+
+
+def barcode_for(copy_id):
+    return f"{BARCODE_PREFIX}{copy_id:08d}"
+
+
+def _next_copy_id(conn):
+    # hand out ids ourselves so the barcode can be written with the row;
+    # safe inside a write transaction
+    return conn.execute("""
+        SELECT MAX(COALESCE((SELECT MAX(copy_id) FROM book_copies), 0),
+                   COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'book_copies'), 0))
+    """).fetchone()[0] + 1
+
+
+def add_copies(conn, book_id, count, shelf_number=None, condition="good"):
+    # new copies on the shelf, with generated barcodes; run inside a write
+    # transaction. Returns their copy ids.
+    return add_copies_many(conn, [(book_id, count, shelf_number)], condition)
+
+
+def add_copies_many(conn, books, condition="good"):
+    # add_copies for many books in one statement; books: (book_id, count,
+    # shelf_number) tuples
+    first, rows = _next_copy_id(conn), []
+    for book_id, count, shelf_number in books:
+        for copy_id in range(first + len(rows), first + len(rows) + count):
+            rows.append((copy_id, book_id, barcode_for(copy_id), shelf_number, condition))
+    conn.executemany("""INSERT INTO book_copies (copy_id, book_id, barcode, shelf_number, condition)
+                        VALUES (?, ?, ?, ?, ?)""", rows)
+    return [row[0] for row in rows]
+
+
+def set_total(conn, book_id, total, shelf_number=None):
+    # add copies, or withdraw copies that are on the shelf, until the book
+    # has `total` copies in circulation; run inside a write transaction.
+    # Raises ValueError when too few copies are on the shelf to withdraw.
+    current = conn.execute(f"SELECT COUNT(*) FROM book_copies WHERE book_id = ? AND state <> '{WITHDRAWN}'",
+                           (book_id,)).fetchone()[0]
+    if total > current:
+        add_copies(conn, book_id, total - current, shelf_number)
+    elif total < current:
+        withdrawn = conn.execute(f"""
+            UPDATE book_copies SET state = '{WITHDRAWN}'
+            WHERE copy_id IN (SELECT copy_id FROM book_copies WHERE book_id = ? AND state IN ('{AVAILABLE}', '{MISSING}')
+                              ORDER BY state = '{AVAILABLE}', copy_id DESC LIMIT ?)
+        """, (book_id, current - total)).rowcount
+        if withdrawn < current - total:
+            raise ValueError(f"Only {withdrawn} copies are on the shelf or missing; the rest are out on loan.")
+
+
+def update_copy(conn, copy_id, state=None, condition=None, shelf_number=None):
+    # edit one copy. Loans move copies in and out of on_loan, so that state
+    # can be neither set nor left here. Returns the book_id.
+    copy = conn.execute("SELECT book_id, state FROM book_copies WHERE copy_id = ?", (copy_id,)).fetchone()
+    if copy is None:
+        raise ValueError("Copy not found.")
+    if state is not None and state != copy[1]:
+        if state not in STATES or ON_LOAN in (state, copy[1]):
+            raise ValueError("A copy out on loan can only be changed by returning it.")
+        conn.execute("UPDATE book_copies SET state = ? WHERE copy_id = ?", (state, copy_id))
+    if condition is not None:
+        if condition not in CONDITIONS:
+            raise ValueError(f"Condition must be one of {', '.join(CONDITIONS)}.")
+        conn.execute("UPDATE book_copies SET condition = ? WHERE copy_id = ?", (condition, copy_id))
+    if shelf_number is not None:
+        conn.execute("UPDATE book_copies SET shelf_number = ? WHERE copy_id = ?", (shelf_number, copy_id))
+    return copy[0]
+
+
+def find_copy(conn, barcode):
+    row = conn.execute("""
+        SELECT copy_id, book_id, barcode, shelf_number, condition, state FROM book_copies WHERE barcode = ?
+    """, ((barcode or "").strip().upper(),)).fetchone()
+    return dict(row) if row else None
+
+
+def book_copies(conn, book_id):
+    return conn.execute("""
+        SELECT book_copies.*, users_record.user_id, users_record.due_date
+        FROM book_copies
+        LEFT JOIN users_record INDEXED BY idx_users_record_open_copy
+               ON users_record.copy_id = book_copies.copy_id AND users_record.is_returned = 0
+        WHERE book_copies.book_id = ?
+        ORDER BY book_copies.copy_id
+    """, (book_id,)).fetchall()
+
+
+def verify_copy_counters(conn, fix=False, commit=True):
+    # Recount every book's copies and compare with the counters. Returns
+    # {book_id: ((total, available) stored, (total, available) actual)}.
+    drift = {row[0]: ((row[1], row[2]), (row[3], row[4]))
+             for row in conn.execute(f"SELECT * FROM ({_RECOUNT}) WHERE copies_total IS NOT actual_total "
+                                     "OR copies_available IS NOT actual_available").fetchall()}
+    if drift and fix:
+        conn.executemany("""
+            UPDATE books SET copies_total = ?, copies_available = ?,
+                             status = CASE WHEN ? > 0 THEN 'available' ELSE 'unavailable' END
+            WHERE book_id = ?
+        """, [(actual[0], actual[1], actual[1], book_id) for book_id, (_, actual) in drift.items()])
+        if commit:
+            conn.commit()
+    return drift
@@ -0,0 +1,31 @@
+# Precomputed totals for the admin dashboard. A single row kept up to date by
+# triggers, so the dashboard reads one row instead of running four COUNT(*)
+# queries (two of them over users_record) on every page view. The table and
+# its triggers are created by migration 3 (migrations.py).
+
+COUNTERS = ("total_books", "books_issued", "books_returned", "members")
+
+# the same counts computed from scratch, used to seed and verify the row
+_RECOUNT = """
+    SELECT (SELECT COUNT(*) FROM books) AS total_books,
+           (SELECT COUNT(*) FROM users_record WHERE is_returned = 0) AS books_issued,
+           (SELECT COUNT(*) FROM users_record WHERE is_returned = 1) AS books_returned,
+           (SELECT COUNT(*) FROM users) AS members
+"""
+
+def read_counters(conn):
+    row = conn.execute(f"SELECT {', '.join(COUNTERS)} FROM dashboard_counters WHERE id = 1").fetchone()
+    return dict(row) if row else None
+
+
+def verify_counters(conn, fix=False):
+    # Recount everything and compare with the stored row. Returns
+    # {counter: (stored, actual)} for every counter that has drifted.
+    stored = read_counters(conn) or dict.fromkeys(COUNTERS)
+    actual = dict(conn.execute(_RECOUNT).fetchone())
+    drift = {name: (stored[name], actual[name]) for name in COUNTERS if stored[name] != actual[name]}
+    if drift and fix:
+        conn.execute(f"INSERT OR REPLACE INTO dashboard_counters (id, {', '.join(COUNTERS)}) VALUES (1, ?, ?, ?, ?)",
+                     tuple(actual[name] for name in COUNTERS))
+        conn.commit()
+    return drift
@@ -0,0 +1,17 @@
+# Per-table data version stamps. Triggers bump an entity's version (and,
+# since migration 6, record when it changed) on every insert, update or
+# delete, so any worker can tell whether its cached copy of that data is
+# still current with a single lookup in this tiny table. Migrations 4, 6
+# and 7 (migrations.py) create the stamps and triggers.
+
+def read_versions(conn):
+    # {entity: version} for every tracked table
+    return dict(conn.execute("SELECT entity, version FROM data_versions").fetchall())
+
+
+def read_stamps(conn, entities):
+    # {entity: (version, updated_at)} for the given tables; updated_at is UTC
+    placeholders = ", ".join("?" * len(entities))
+    rows = conn.execute(f"SELECT entity, version, updated_at FROM data_versions WHERE entity IN ({placeholders})",
+                        entities).fetchall()
+    return {row[0]: (row[1], row[2]) for row in rows}
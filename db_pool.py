@@ -0,0 +1,206 @@
+import os, pathlib, sqlite3, threading, time
+from instrumentation import InstrumentedCursor
+
+
+# database location and pool tuning (can be overridden per deployment)
+DATABASE = os.getenv("LIBRARY_DB", "library.db")
+# threads per worker process (gunicorn --threads, see Procfile). A request
+# uses one connection, and a streamed export keeps it until the client has
+# downloaded everything, so each pool needs at least one per thread.
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "1"))
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(max(5, WORKER_THREADS))))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", str(POOL_SIZE)))
+STATEMENT_CACHE_SIZE = 256
+
+# applied once when a connection is opened, not on every request
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",       # ~16 MB page cache per connection
+    "PRAGMA mmap_size = 268435456",     # 256 MB memory mapped I/O
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# The read-only lane used by GET routes marked with helper.read_only. Its
+# connections are opened with mode=ro and query_only, so they never take the
+# write lock; in WAL mode they read from a snapshot and neither wait for nor
+# hold up the issue/return writes on the read-write pool. The journal mode is
+# set by the read-write connections.
+READ_ONLY_PRAGMAS = tuple(pragma for pragma in PRAGMAS if "journal_mode" not in pragma) + (
+    "PRAGMA query_only = ON",
+)
+
+# functions called with every newly opened connection (used by tooling such
+# as the benchmarks to install trace callbacks)
+CONNECT_HOOKS = []
+
+
+class PoolExhausted(sqlite3.OperationalError):
+    # no connection was released within the pool timeout; app.py answers
+    # it with 503 Service Unavailable
+    pass
+
+
+class PooledConnection(sqlite3.Connection):
+    # close() hands the connection back to its pool instead of closing the file
+    pool = None
+    checked_out = False
+    # set while the connection belongs to a request: close() is then a no-op
+    # and the connection goes back at teardown, so a route that closes early
+    # cannot return it while the request still holds (and later re-closes) it
+    request_bound = False
+
+    # statements go through InstrumentedCursor so requests can be profiled
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def close(self):
+        if self.pool is None:
+            return super().close()
+        if self.request_bound:
+            return
+        self.pool.release(self)
+
+    def really_close(self):
+        super().close()
+
+
+class ConnectionPool:
+    def __init__(self, database=DATABASE, max_size=POOL_SIZE, timeout=POOL_TIMEOUT, read_only=False):
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        self.read_only = read_only
+        self._idle = []
+        self._opened = 0
+        self._lock = threading.Condition()
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+
+    def _connect(self):
+        if self.read_only:
+            database = pathlib.Path(self.database).absolute().as_uri() + "?mode=ro"
+        else:
+            database = self.database
+        conn = sqlite3.connect(database, timeout=self.timeout, check_same_thread=False, uri=self.read_only,
+                               cached_statements=STATEMENT_CACHE_SIZE, factory=PooledConnection)
+        conn.row_factory = sqlite3.Row  # Enables accessing rows like dictionaries
+        for pragma in READ_ONLY_PRAGMAS if self.read_only else PRAGMAS:
+            conn.execute(pragma)
+        for hook in CONNECT_HOOKS:
+            hook(conn)
+        conn.pool = self
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if not self._idle and self._opened >= self.max_size:
+                # every connection is busy, wait for one to be released
+                self.waits += 1
+                started = time.perf_counter()
+                ready = self._lock.wait_for(lambda: self._idle, timeout=self.timeout)
+                self.wait_time += time.perf_counter() - started
+                if not ready:
+                    self.timeouts += 1
+                    raise PoolExhausted("database connection pool exhausted")
+
+            if self._idle:
+                self.hits += 1
+                conn = self._idle.pop()
+            else:
+                self.misses += 1
+                self._opened += 1
+                try:
+                    conn = self._connect()
+                except sqlite3.Error:
+                    self._opened -= 1
+                    raise
+            conn.checked_out = True
+            return conn
+
+    def release(self, conn):
+        with self._lock:
+            if not conn.checked_out:
+                return  # already back in the pool (closed twice)
+            conn.checked_out = False
+            conn.request_bound = False
+            try:
+                # never leak an unfinished transaction to the next request
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                self._opened -= 1
+                conn.really_close()
+                self._lock.notify()
+                return
+            self._idle.append(conn)
+            self._lock.notify()
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.really_close()
+            self._opened -= len(self._idle)
+            self._idle = []
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "size": self._opened,
+                "max_size": self.max_size,
+                "idle": len(self._idle),
+                "in_use": self._opened - len(self._idle),
+                "hits": self.hits,
+                "misses": self.misses,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "wait_time": round(self.wait_time, 6),
+                "hit_rate": round(self.hits / requests, 4) if requests else 0.0,
+            }
+
+
+# one read-write and one read-only pool per worker process; gunicorn forks
+# workers after import, so the pools are created lazily and re-created if
+# the pid changes
+_pools = {}
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(read_only):
+    global _pool_pid
+    pool = _pools.get(read_only)
+    if pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pools.clear()
+                _pool_pid = os.getpid()
+            pool = _pools.get(read_only)
+            if pool is None:
+                pool = _pools[read_only] = ConnectionPool(
+                    max_size=READ_POOL_SIZE if read_only else POOL_SIZE, read_only=read_only)
+    return pool
+
+
+def get_pool():
+    return _get_pool(read_only=False)
+
+
+def get_read_pool():
+    return _get_pool(read_only=True)
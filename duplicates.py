@@ -0,0 +1,153 @@
+import math, os, re, unicodedata
+
+
+# Near-duplicate authors, publishers and genres. Every row carries a
+# normalized_name ("Tolkien, J.R.R." -> "jrr tolkien": accents and
+# punctuation dropped, initials run together, "Last, First" turned round for
+# authors) and <table>_names, an FTS5 trigram index of it kept up to date by
+# triggers. find_duplicates() counts, in SQL, how many trigrams of a name
+# each indexed row shares and only scores (in Python) the rows that share
+# enough to reach MIN_SIMILARITY. Trigrams found in more than
+# COMMON_TRIGRAM rows are left out of the count when the bound allows it
+# (how common each one is comes from <table>_names_vocab), so a check stays
+# in the milliseconds however large the table grows. merge() re-points books and book_genres
+# from the duplicates to the row that is kept and soft deletes the rest.
+
+# entity -> (id column, name column, names are people)
+ENTITIES = {
+    "authors": ("author_id", "name", True),
+    "publishers": ("publisher_id", "name", False),
+    "genres": ("genre_id", "genre_name", False),
+}
+
+MIN_SIMILARITY = float(os.environ.get("DUPLICATE_SIMILARITY", "0.7"))
+MAX_DUPLICATES = 10
+CANDIDATES = 200  # most rows scored per check
+COMMON_TRIGRAM = 1000
+
+
+def normalize_name(name, person=False):
+    text = unicodedata.normalize("NFKD", name or "")
+    text = "".join(char for char in text if not unicodedata.combining(char)).casefold()
+    if person and text.count(",") == 1:
+        last, first = text.split(",")
+        text = f"{first} {last}"
+    words, initials = [], ""
+    for word in re.findall(r"[^\W_]+", text):
+        # "j r r" and "j.r.r." both become "jrr"
+        if len(word) == 1:
+            initials += word
+            continue
+        if initials:
+            words.append(initials)
+            initials = ""
+        words.append(word)
+    if initials:
+        words.append(initials)
+    return " ".join(words)
+
+
+def normalize(entity, name):
+    return normalize_name(name, ENTITIES[entity][2])
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def similarity(first, second):
+    # Dice coefficient of the trigrams of two normalized names, also tried
+    # with the words sorted so the order of the words does not matter
+    best = 0.0
+    for a, b in ((first, second), (" ".join(sorted(first.split())), " ".join(sorted(second.split())))):
+        if a == b:
+            return 1.0
+        ta, tb = _trigrams(a), _trigrams(b)
+        if ta and tb:
+            best = max(best, 2 * len(ta & tb) / (len(ta) + len(tb)))
+    return best
+
+
+def find_duplicates(conn, entity, name, exclude_id=None, limit=MAX_DUPLICATES, min_similarity=None):
+    # live rows whose name looks like name, most similar first:
+    # [{"id", "name", "similarity"}]
+    id_column, name_column, person = ENTITIES[entity]
+    key = normalize_name(name, person)
+    if not key:
+        return []
+    min_similarity = MIN_SIMILARITY if min_similarity is None else min_similarity
+    scores = {row[0]: 1.0 for row in conn.execute(
+        f"SELECT {id_column} FROM {entity} WHERE normalized_name = ?", (key,)).fetchall()}
+    trigrams = _trigrams(key)
+    if trigrams:
+        # a row with Dice similarity s shares at least s * n / (2 - s) of
+        # our n trigrams; leaving out the m commonest lowers that by m
+        shared = max(1, math.ceil(min_similarity * len(trigrams) / (2 - min_similarity) - 1e-9))
+        documents = dict(conn.execute(
+            f"SELECT term, doc FROM {entity}_names_vocab WHERE term IN ({','.join('?' * len(trigrams))})",
+            tuple(trigrams)).fetchall())
+        ordered = sorted((trigram for trigram in trigrams if documents.get(trigram)), key=documents.get)
+        common = sum(1 for trigram in ordered if documents[trigram] > COMMON_TRIGRAM)
+        skipped = min(common, shared - 1, len(ordered))
+        kept = ordered[:len(ordered) - skipped]
+        if kept:
+            postings = " UNION ALL ".join(f"SELECT rowid FROM {entity}_names WHERE {entity}_names MATCH ?" for _ in kept)
+            rows = conn.execute(f"""
+                SELECT names.rowid, names.name FROM {entity}_names AS names
+                WHERE names.rowid IN (SELECT rowid FROM ({postings}) GROUP BY rowid HAVING COUNT(*) >= ? LIMIT ?)
+            """, (*('"' + trigram.replace('"', '""') + '"' for trigram in kept), shared - skipped, CANDIDATES)).fetchall()
+            for rowid, indexed in rows:
+                scores.setdefault(rowid, similarity(key, indexed))
+    scores.pop(exclude_id, None)
+    scores = {id: score for id, score in scores.items() if score >= min_similarity}
+    if not scores:
+        return []
+    rows = conn.execute(f"""
+        SELECT {id_column}, {name_column} FROM {entity}
+        WHERE is_deleted = 0 AND {id_column} IN ({",".join("?" * len(scores))})
+    """, tuple(scores)).fetchall()
+    matches = [{"id": row[0], "name": row[1], "similarity": round(scores[row[0]], 3)} for row in rows]
+    matches.sort(key=lambda match: (-match["similarity"], match["id"]))
+    return matches[:limit]
+
+
+def duplicate_groups(conn, entity, min_similarity=None):
+    # every live row with its likely duplicates, each pair listed once
+    id_column, name_column, person = ENTITIES[entity]
+    groups, seen = [], set()
+    for row in conn.execute(f"SELECT {id_column}, {name_column} FROM {entity} WHERE is_deleted = 0 ORDER BY {id_column}").fetchall():
+        if row[0] in seen:
+            continue
+        matches = [match for match in find_duplicates(conn, entity, row[1], exclude_id=row[0],
+                                                      min_similarity=min_similarity) if match["id"] not in seen]
+        if matches:
+            seen.update(match["id"] for match in matches)
+            groups.append(({"id": row[0], "name": row[1]}, matches))
+        seen.add(row[0])
+    return groups
+
+
+def merge(conn, entity, keep_id, merge_ids):
+    # re-point everything that uses merge_ids to keep_id and soft delete
+    # them; run inside a write transaction. Returns the number of books moved.
+    id_column, name_column, person = ENTITIES[entity]
+    merge_ids = sorted({int(merge_id) for merge_id in merge_ids} - {keep_id})
+    if not merge_ids:
+        raise ValueError("Choose at least one duplicate to merge.")
+    ids = (keep_id, *merge_ids)
+    found = conn.execute(f"SELECT COUNT(*) FROM {entity} WHERE is_deleted = 0 AND {id_column} IN ({','.join('?' * len(ids))})",
+                         ids).fetchone()[0]
+    if found != len(ids):
+        raise ValueError(f"Some of the {entity} to merge no longer exist.")
+    placeholders = ",".join("?" * len(merge_ids))
+    if entity == "genres":
+        moved = conn.execute(f"""
+            INSERT OR IGNORE INTO book_genres (book_id, genre_id)
+            SELECT book_id, ? FROM book_genres WHERE genre_id IN ({placeholders})
+        """, (keep_id, *merge_ids)).rowcount
+        conn.execute(f"DELETE FROM book_genres WHERE genre_id IN ({placeholders})", merge_ids)
+    else:
+        moved = conn.execute(f"UPDATE books SET {id_column} = ? WHERE {id_column} IN ({placeholders})",
+                             (keep_id, *merge_ids)).rowcount
+    conn.execute(f"UPDATE {entity} SET is_deleted = 1 WHERE {id_column} IN ({placeholders})", merge_ids)
+    return moved
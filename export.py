@@ -0,0 +1,137 @@
+import csv, io, json, zlib
+from datetime import datetime
+from circulation import NOT_RETURNED
+
+
+# Streaming export of the lending history. Rows of users_record (joined with
+# books and users) are read from one cursor in FETCH_SIZE batches and encoded
+# as CSV or JSON lines chunk by chunk, optionally through a gzip compressor,
+# so memory use stays flat no matter how long the history is.
+
+FORMATS = ('csv', 'jsonl')
+FETCH_SIZE = 1000
+COLUMNS = ('users_record_id', 'user_id', 'username', 'pa_pss_number', 'book_id', 'title', 'isbn',
+           'issue_date', 'due_date', 'return_date', 'is_returned')
+MIMETYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+
+def _date(value, name):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"{name} must be a date like 2024-01-31")
+
+
+def parse_filters(date_from=None, date_to=None, user_id=None, returned=None):
+    # validates raw filter values (strings or None); raises ValueError
+    filters = {}
+    if date_from:
+        filters['date_from'] = _date(date_from, 'from')
+    if date_to:
+        filters['date_to'] = _date(date_to, 'to')
+    if user_id not in (None, ''):
+        try:
+            filters['user_id'] = int(user_id)
+        except ValueError:
+            raise ValueError("user_id must be a number")
+    if returned not in (None, ''):
+        value = str(returned).strip().lower()
+        if value not in ('0', '1', 'yes', 'no', 'true', 'false'):
+            raise ValueError("returned must be 0 or 1")
+        filters['returned'] = 1 if value in ('1', 'yes', 'true') else 0
+    return filters
+
+
+def export_query(filters):
+    # returns (sql, params); issue dates are compared as text, which sorts
+    # correctly for the 'YYYY-MM-DD HH:MM:SS' values we store
+    conditions, params = [], []
+    if 'date_from' in filters:
+        conditions.append("users_record.issue_date >= ?")
+        params.append(filters['date_from'])
+    if 'date_to' in filters:
+        conditions.append("users_record.issue_date < date(?, '+1 day')")
+        params.append(filters['date_to'])
+    if 'user_id' in filters:
+        conditions.append("users_record.user_id = ?")
+        params.append(filters['user_id'])
+    if 'returned' in filters:
+        conditions.append("users_record.is_returned = ?")
+        params.append(filters['returned'])
+    where = " AND ".join(conditions) or "1"
+    return f"""
+        SELECT users_record.users_record_id, users_record.user_id, users.username, users.pa_pss_number,
+               users_record.book_id, books.title, books.isbn, users_record.issue_date, users_record.due_date,
+               users_record.return_date, users_record.is_returned
+        FROM users_record
+        LEFT JOIN users ON users.user_id = users_record.user_id
+        LEFT JOIN books ON books.book_id = users_record.book_id
+        WHERE {where}
+        ORDER BY users_record.users_record_id
+    """, params
+
+
+def iter_records(conn, filters, fetch_size=FETCH_SIZE):
+    # yields lists of row tuples, at most fetch_size at a time
+    sql, params = export_query(filters)
+    cursor = conn.execute(sql, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                return
+            yield [tuple(row) for row in rows]
+    finally:
+        cursor.close()
+
+
+def _clean(row):
+    # open loans carry a placeholder return_date; export them without one
+    row = list(row)
+    if row[9] == NOT_RETURNED:
+        row[9] = None
+    return row
+
+
+def encode(batches, fmt):
+    # yields utf-8 encoded chunks, one per batch of rows
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(COLUMNS)
+        for rows in batches:
+            writer.writerows(_clean(row) for row in rows)
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+    else:
+        for rows in batches:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(COLUMNS, _clean(row))), ensure_ascii=False))
+                buffer.write('\n')
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+
+
+def gzip_chunks(chunks, level=6):
+    # wraps a stream of bytes in a gzip stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_records(conn, filters, fmt='csv', compress=False, fetch_size=FETCH_SIZE):
+    # the complete export as a generator of bytes
+    chunks = encode(iter_records(conn, filters, fetch_size), fmt)
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def filename(fmt, compress=False):
+    name = f"users_record-{datetime.now().strftime('%Y%m%d')}.{fmt}"
+    return name + '.gz' if compress else name
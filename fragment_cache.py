@@ -0,0 +1,103 @@
+import os, threading
+from collections import OrderedDict
+from flask import request
+from markupsafe import Markup
+from data_versions import read_versions
+
+
+# Cache of rendered listing tables (the rows plus their page links). An entry
+# is keyed by template, query parameters and the data versions of the tables
+# the listing reads, so any write to those tables (from any worker) makes the
+# old entries unreachable; they are dropped the next time that listing is
+# rendered, or evicted least recently used first once the cache holds more
+# than FRAGMENT_CACHE_BYTES of HTML.
+
+FRAGMENT_CACHE_BYTES = int(os.environ.get("FRAGMENT_CACHE_BYTES", 8 * 1024 * 1024))
+
+
+class FragmentCache:
+    def __init__(self, max_bytes=FRAGMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> Markup, least recently used first
+        self._versions = {}  # template -> data versions of its cached entries
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def render(self, conn, template, entities, render):
+        # returns the cached fragment, or calls render() and caches its result
+        key, stamp, html = self._lookup(conn, template, entities)
+        if html is not None:
+            return html
+        html = Markup(render())
+        self._store(template, key, stamp, html)
+        return html
+
+    def stream(self, conn, template, entities, generate):
+        # like render() for a fragment rendered piece by piece: yields the
+        # cached fragment, or passes on the chunks of generate() as they are
+        # produced and caches the fragment once it is complete
+        key, stamp, html = self._lookup(conn, template, entities)
+        if html is not None:
+            yield html
+            return
+        chunks = []
+        for chunk in generate():
+            chunks.append(chunk)
+            yield chunk
+        self._store(template, key, stamp, Markup("".join(chunks)))
+
+    def _lookup(self, conn, template, entities):
+        versions = read_versions(conn)
+        stamp = tuple(versions.get(entity) for entity in entities)
+        key = (template, tuple(sorted(request.args.items(multi=True))), stamp)
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        return key, stamp, html
+
+    def _store(self, template, key, stamp, html):
+        size = len(html)  # characters; close enough to bytes for HTML
+        with self._lock:
+            if self._versions.get(template) != stamp:
+                # the data changed: entries rendered from older versions are dead
+                self._discard(lambda old: old[0] == template and old[2] != stamp)
+                self._versions[template] = stamp
+            if size <= self.max_bytes and key not in self._entries:
+                self._entries[key] = html
+                self.bytes += size
+                while self.bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.bytes -= len(evicted)
+                    self.evictions += 1
+
+    def _discard(self, stale):
+        for key in [key for key in self._entries if stale(key)]:
+            self.bytes -= len(self._entries.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+fragment_cache = FragmentCache()
@@ -1,8 +1,9 @@
-import os, sqlite3
-from flask import Flask, render_template, request, redirect,flash, url_for, session
+import os, sqlite3, logging
+from flask import Flask, render_template, request, redirect,flash, url_for, session, g, has_app_context, has_request_context, current_app
 from flask_session import Session
 from datetime import datetime, timedelta
 from functools import wraps
+from db_pool import get_pool, get_read_pool
 
 
 
@@ -12,12 +13,75 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 
 
 def get_db_connection():
-    try:
-        conn = sqlite3.connect('library.db')
-        conn.row_factory = sqlite3.Row  # Enables accessing rows like dictionaries
-        return conn
-    except sqlite3.Error as e:
-        return None
+    # Connections come from the per-worker pool. Inside a request the same
+    # connection is reused for the whole request and handed back to the pool
+    # by close_db_connection, so early returns can no longer leak it (and
+    # conn.close() in a route does nothing until then). GET requests to
+    # routes marked with @read_only get a connection from the read-only pool.
+    # Errors propagate: db_pool.PoolExhausted becomes a 503 (see app.py).
+    if not has_app_context():
+        return get_pool().acquire()  # caller must close() it
+    conn = g.get('db_conn')
+    if conn is None:
+        pool = get_read_pool() if is_read_only_request() else get_pool()
+        conn = g.db_conn = pool.acquire()
+        conn.request_bound = True
+    return conn
+
+def read_only(f):
+    # Marks a route whose GET requests only read the database; they are
+    # served from the read-only connection lane (see db_pool.py). Other
+    # methods on the same route still get a read-write connection.
+    f.read_only = True
+    return f
+
+def is_read_only_request():
+    if not has_request_context() or request.method not in ('GET', 'HEAD'):
+        return False
+    # functools.wraps copies the flag onto decorators applied after it
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(view, 'read_only', False)
+
+def close_db_connection(exception=None):
+    # registered with app.teardown_appcontext
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn.request_bound = False
+        conn.close()
+
+def stream_with_connection(chunks):
+    # Flask tears the app context down (running close_db_connection) as soon
+    # as the view returns, before a streamed body is sent, which would hand
+    # the request's connection back to the pool while the stream still reads
+    # from it. Detach the connection from the request instead: the stream
+    # owns it until the server closes the response. Wrap chunks with
+    # stream_with_context first if they need the request.
+    # A slow client keeps the connection checked out for the whole download,
+    # so only use this for bodies that cannot be buffered (the exports);
+    # pages are rendered first (streaming.stream_page). db_pool sizes the
+    # pools from WORKER_THREADS so every thread can hold one connection.
+    return ConnectionStream(chunks, g.pop('db_conn', None))
+
+class ConnectionStream:
+    # response body that returns its connection to the pool on close(),
+    # which WSGI servers call even if the body was never iterated
+    def __init__(self, chunks, conn):
+        self.chunks = chunks
+        self.conn = conn
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        try:
+            close = getattr(self.chunks, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            conn, self.conn = self.conn, None
+            if conn is not None:
+                conn.request_bound = False
+                conn.close()
 
 def is_delete(user_id):
     # Mark user as deleted by setting the is_delete column to 1
@@ -38,7 +102,7 @@ def is_delete(user_id):
         return True
     except Exception as e:
          # Error message
-        print(f"Error deleting user: {e}") 
+        logging.getLogger(__name__).exception("Error deleting user %s", user_id)
         # if something goes wrong
         return False
     
@@ -54,10 +118,7 @@ def admin_exists():
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        print("Decorator triggered")
-        print("Session data:", session)
         if session.get("admin_id") is None:
-            print("Redirecting to login...")
             session.clear()  # Ensure session is cleared
             return redirect("/login")
         return f(*args, **kwargs)
@@ -0,0 +1,245 @@
+import os, threading, time
+from contextvars import ContextVar
+import sqlite3
+from flask import request, g
+
+
+# Per-request SQL instrumentation and Prometheus metrics. Pooled connections
+# hand out InstrumentedCursor (see db_pool.py), which adds the time of every
+# execute and fetch call to the RequestStats of the request being served.
+# init_app() records each request's latency, status and SQL work in
+# process-wide histograms and counters that /metrics renders in the
+# Prometheus text format. Requests slower than SLOW_REQUEST_MS are logged
+# together with their slowest statement.
+
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 0))  # 0 = off
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+MAX_SQL_LENGTH = 500
+
+_current = ContextVar("request_stats", default=None)
+
+
+class RequestStats:
+    __slots__ = ("statements", "sql_time", "slowest_time", "slowest_sql")
+
+    def __init__(self):
+        self.statements = 0
+        self.sql_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_sql = None
+
+    def record(self, sql, seconds, statement_time, statement=True):
+        # seconds: time of this call; statement_time: everything spent on
+        # the statement so far (execute plus fetches)
+        self.statements += statement
+        self.sql_time += seconds
+        if statement_time > self.slowest_time:
+            self.slowest_time = statement_time
+            self.slowest_sql = sql
+
+
+def current_stats():
+    # the RequestStats of the request being served, or None
+    return _current.get()
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # execute* count as statements; fetch* add their time to the statement
+    # that produced the rows (SQLite does most of a SELECT's work while
+    # rows are fetched). Rows read by iterating the cursor are not timed.
+    _sql = None
+    _elapsed = 0.0
+
+    def _timed_execute(self, execute, sql, *args):
+        stats = _current.get()
+        if stats is None:
+            return execute(sql, *args)
+        started = time.perf_counter()
+        try:
+            return execute(sql, *args)
+        finally:
+            self._sql, self._elapsed = sql, time.perf_counter() - started
+            stats.record(sql, self._elapsed, self._elapsed)
+
+    def execute(self, sql, parameters=()):
+        return self._timed_execute(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed_execute(super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self._timed_execute(super().executescript, sql_script)
+
+    def _timed_fetch(self, fetch, *args):
+        stats = _current.get()
+        if stats is None:
+            return fetch(*args)
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._elapsed += elapsed
+            stats.record(self._sql, elapsed, self._elapsed, statement=False)
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed_fetch(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # non-cumulative, one per bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}   # (endpoint, method, status) -> count
+        self.latency = {}    # (endpoint, method) -> Histogram of seconds
+        self.statements = {}  # endpoint -> Histogram of statements per request
+        self.sql_seconds = {}  # endpoint -> total SQL seconds
+        self.slow_requests = 0
+
+    def observe(self, endpoint, method, status, seconds, stats):
+        with self._lock:
+            key = (endpoint, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get((endpoint, method))
+            if histogram is None:
+                histogram = self.latency[(endpoint, method)] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+            histogram = self.statements.get(endpoint)
+            if histogram is None:
+                histogram = self.statements[endpoint] = Histogram(STATEMENT_BUCKETS)
+            histogram.observe(stats.statements)
+            self.sql_seconds[endpoint] = self.sql_seconds.get(endpoint, 0.0) + stats.sql_time
+
+    def render(self, collectors=None):
+        # collectors: {metric prefix: stats dict} for pool and cache stats;
+        # hits/misses/waits/timeouts/wait_time become counters, the rest gauges
+        lines = []
+        with self._lock:
+            lines += _header("library_requests_total", "counter", "HTTP requests by route and status")
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(_sample("library_requests_total",
+                                     {"endpoint": endpoint, "method": method, "status": status}, count))
+            lines += _header("library_request_duration_seconds", "histogram", "Request latency by route")
+            for (endpoint, method), histogram in sorted(self.latency.items()):
+                lines += _histogram("library_request_duration_seconds",
+                                    {"endpoint": endpoint, "method": method}, histogram)
+            lines += _header("library_sql_statements_per_request", "histogram", "SQL statements run per request")
+            for endpoint, histogram in sorted(self.statements.items()):
+                lines += _histogram("library_sql_statements_per_request", {"endpoint": endpoint}, histogram)
+            lines += _header("library_sql_seconds_total", "counter", "Time spent in SQLite by route")
+            for endpoint, seconds in sorted(self.sql_seconds.items()):
+                lines.append(_sample("library_sql_seconds_total", {"endpoint": endpoint}, round(seconds, 6)))
+            lines += _header("library_slow_requests_total", "counter", "Requests slower than SLOW_REQUEST_MS")
+            lines.append(_sample("library_slow_requests_total", {}, self.slow_requests))
+        for prefix, stats in (collectors or {}).items():
+            for key, value in stats.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                if key in COUNTER_KEYS:
+                    name = f"{prefix}_{key}_total"
+                    lines += _header(name, "counter", f"{prefix} {key}")
+                else:
+                    name = f"{prefix}_{key}"
+                    lines += _header(name, "gauge", f"{prefix} {key}")
+                lines.append(_sample(name, {}, value))
+        return "\n".join(lines) + "\n"
+
+
+COUNTER_KEYS = {"hits", "misses", "waits", "timeouts", "wait_time", "evictions"}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _sample(name, labels, value):
+    if labels:
+        label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+        return f"{name}{{{label_text}}} {value}"
+    return f"{name} {value}"
+
+
+def _header(name, kind, help_text):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+
+
+def _histogram(name, labels, histogram):
+    lines, cumulative = [], 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(_sample(f"{name}_bucket", {**labels, "le": bound}, cumulative))
+    lines.append(_sample(f"{name}_bucket", {**labels, "le": "+Inf"}, histogram.count))
+    lines.append(_sample(f"{name}_sum", labels, round(histogram.sum, 6)))
+    lines.append(_sample(f"{name}_count", labels, histogram.count))
+    return lines
+
+
+metrics = Metrics()
+
+
+def _one_line(sql):
+    sql = " ".join((sql or "").split())
+    return sql if len(sql) <= MAX_SQL_LENGTH else sql[:MAX_SQL_LENGTH] + "..."
+
+
+def init_app(app):
+    @app.before_request
+    def start_request_stats():
+        g.request_started = time.perf_counter()
+        g.request_stats = RequestStats()
+        g.request_stats_token = _current.set(g.request_stats)
+
+    @app.after_request
+    def record_request_stats(response):
+        stats = g.pop("request_stats", None)
+        if stats is None:
+            return response
+        token, started = g.pop("request_stats_token"), g.pop("request_started")
+        # unmatched URLs share one label so scanners cannot blow up the series
+        endpoint = request.endpoint or "unmatched"
+        method, path = request.method, request.full_path.rstrip("?")
+
+        def finish():
+            try:
+                _current.reset(token)
+            except ValueError:
+                pass  # closed from another context; the next request sets its own
+            seconds = time.perf_counter() - started
+            metrics.observe(endpoint, method, response.status_code, seconds, stats)
+            if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+                with metrics._lock:
+                    metrics.slow_requests += 1
+                app.logger.warning(
+                    "slow request %s %s -> %s in %.1f ms: %d statements, %.1f ms in SQL; slowest %.1f ms: %s",
+                    method, path, response.status_code, seconds * 1000, stats.statements,
+                    stats.sql_time * 1000, stats.slowest_time * 1000, _one_line(stats.slowest_sql))
+
+        if response.is_streamed:
+            # streamed pages run most of their queries while the body is sent:
+            # keep collecting until the server closes the response
+            response.call_on_close(finish)
+        else:
+            finish()
+        return response
@@ -0,0 +1,737 @@
+import os, re, unicodedata
+from datetime import datetime
+
+
+# Versioned schema migrations. Every step runs once, in order, inside its own
+# BEGIN IMMEDIATE transaction and is recorded in schema_version. Starting the
+# app (or running library_db.py) only applies the steps a database has not
+# seen yet, so a normal start does no schema work at all. Steps are written to
+# be idempotent so databases created before schema_version existed can be
+# brought under migration safely.
+#
+# Each step carries its own SQL, as it was when the step was released, and
+# does not call into the feature modules: their code keeps changing, while a
+# database migrated today must end up exactly like one migrated back then.
+# Never edit a released step; a schema change is a new step.
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def baseline(conn):
+    # the schema library_db.py used to build, without rewriting existing tables
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS genres(
+            genre_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            genre_name TEXT NOT NULL,
+            is_deleted BOOLEAN DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS publishers(
+            publisher_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            is_deleted BOOLEAN DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS authors(
+            author_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            is_deleted BOOLEAN DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS books(
+            book_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            isbn TEXT NOT NULL,
+            edition TEXT NOT NULL,
+            copies_total INTEGER NOT NULL,
+            copies_available INTEGER NOT NULL,
+            shelf_number INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'available',
+            published_year INTEGER NOT NULL,
+            author_id INTEGER NOT NULL,
+            publisher_id INTEGER NOT NULL,
+            FOREIGN KEY (author_id) REFERENCES authors(author_id) ON DELETE CASCADE,
+            FOREIGN KEY (publisher_id) REFERENCES publishers(publisher_id) ON DELETE CASCADE
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            pa_pss_number TEXT UNIQUE NOT NULL CHECK(pa_pss_number LIKE 'PA%' OR pa_pss_number LIKE 'PSS%'),
+            email_id TEXT NOT NULL,
+            phone_number TEXT NOT NULL,
+            address TEXT NOT NULL,
+            is_active BOOLEAN NOT NULL DEFAULT 1,
+            date_activated DATE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            is_deleted BOOLEAN DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users_record(
+            users_record_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            issue_date DATE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            return_date DATE NOT NULL,
+            due_date DATE NOT NULL,
+            is_returned BOOLEAN NOT NULL DEFAULT 0,   --- 0 = Not Returned, 1 = Returned
+            book_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            FOREIGN KEY (book_id) REFERENCES books(book_id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS admin (
+            admin_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            email_id TEXT NOT NULL,
+            phone_number TEXT NOT NULL,
+            is_active BOOLEAN NOT NULL DEFAULT 1,
+            date_created DATE NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS book_genres (
+            book_id INTEGER,
+            genre_id INTEGER,
+            FOREIGN KEY (book_id) REFERENCES books(book_id) ON DELETE CASCADE,
+            FOREIGN KEY (genre_id) REFERENCES genres(genre_id) ON DELETE CASCADE,
+            PRIMARY KEY (book_id, genre_id)
+        )
+    """)
+
+    # soft delete columns added after the first release
+    for table in ("publishers", "authors", "genres", "users"):
+        if "is_deleted" not in _columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN is_deleted BOOLEAN DEFAULT 0")
+
+    # very old databases still have books.genre_id (genres moved to
+    # book_genres); rebuild books once without it
+    if "genre_id" in _columns(conn, "books"):
+        conn.execute("DROP TABLE IF EXISTS new_books")
+        conn.execute("""
+            CREATE TABLE new_books(
+                book_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                isbn TEXT NOT NULL,
+                edition TEXT NOT NULL,
+                copies_total INTEGER NOT NULL,
+                copies_available INTEGER NOT NULL,
+                shelf_number INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'available',
+                published_year INTEGER NOT NULL,
+                author_id INTEGER NOT NULL,
+                publisher_id INTEGER NOT NULL,
+                FOREIGN KEY (author_id) REFERENCES authors(author_id) ON DELETE CASCADE,
+                FOREIGN KEY (publisher_id) REFERENCES publishers(publisher_id) ON DELETE CASCADE
+            )
+        """)
+        conn.execute("""
+            INSERT INTO new_books (book_id, title, isbn, edition, copies_total, copies_available,
+                                   shelf_number, status, author_id, publisher_id, published_year)
+            SELECT book_id, title, isbn, edition, copies_total, copies_available,
+                   shelf_number, status, author_id, publisher_id, published_year
+            FROM books
+        """)
+        conn.execute("INSERT OR IGNORE INTO book_genres (book_id, genre_id) SELECT book_id, genre_id FROM books")
+        conn.execute("DROP TABLE books")
+        conn.execute("ALTER TABLE new_books RENAME TO books")
+
+    # leftovers of earlier versions of library_db.py
+    conn.execute("DROP TABLE IF EXISTS reserve_a_book")
+    conn.execute("DROP TABLE IF EXISTS new_users")
+    conn.execute("DROP TRIGGER IF EXISTS update_copies_and_status")
+
+
+# rows of books_fts for every book matching the WHERE clause appended to it
+_BOOKS_FTS_ROWS = """
+    INSERT INTO books_fts (rowid, title, isbn, author, publisher, genres)
+    SELECT b.book_id, b.title, b.isbn, a.name, p.name,
+           (SELECT GROUP_CONCAT(g.genre_name, ' ')
+              FROM book_genres bg JOIN genres g ON g.genre_id = bg.genre_id
+             WHERE bg.book_id = b.book_id)
+    FROM books b
+    LEFT JOIN authors a ON a.author_id = b.author_id
+    LEFT JOIN publishers p ON p.publisher_id = b.publisher_id
+"""
+
+
+def books_fts_index(conn):
+    # the full text index of search_index.py, its triggers and its rows
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'").fetchone()
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+            title, isbn, author, publisher, genres,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    """)
+    triggers = {
+        "books_fts_books_insert": """
+            AFTER INSERT ON books BEGIN
+                {rows} WHERE b.book_id = NEW.book_id;
+            END""",
+        "books_fts_books_update": """
+            AFTER UPDATE OF title, isbn, author_id, publisher_id ON books BEGIN
+                DELETE FROM books_fts WHERE rowid = OLD.book_id;
+                {rows} WHERE b.book_id = NEW.book_id;
+            END""",
+        "books_fts_books_delete": """
+            AFTER DELETE ON books BEGIN
+                DELETE FROM books_fts WHERE rowid = OLD.book_id;
+            END""",
+        "books_fts_authors_update": """
+            AFTER UPDATE OF name ON authors BEGIN
+                DELETE FROM books_fts WHERE rowid IN (SELECT book_id FROM books WHERE author_id = NEW.author_id);
+                {rows} WHERE b.author_id = NEW.author_id;
+            END""",
+        "books_fts_publishers_update": """
+            AFTER UPDATE OF name ON publishers BEGIN
+                DELETE FROM books_fts WHERE rowid IN (SELECT book_id FROM books WHERE publisher_id = NEW.publisher_id);
+                {rows} WHERE b.publisher_id = NEW.publisher_id;
+            END""",
+        "books_fts_genres_update": """
+            AFTER UPDATE OF genre_name ON genres BEGIN
+                DELETE FROM books_fts WHERE rowid IN (SELECT book_id FROM book_genres WHERE genre_id = NEW.genre_id);
+                {rows} WHERE b.book_id IN (SELECT book_id FROM book_genres WHERE genre_id = NEW.genre_id);
+            END""",
+        "books_fts_book_genres_insert": """
+            AFTER INSERT ON book_genres BEGIN
+                DELETE FROM books_fts WHERE rowid = NEW.book_id;
+                {rows} WHERE b.book_id = NEW.book_id;
+            END""",
+        "books_fts_book_genres_delete": """
+            AFTER DELETE ON book_genres BEGIN
+                DELETE FROM books_fts WHERE rowid = OLD.book_id;
+                {rows} WHERE b.book_id = OLD.book_id;
+            END""",
+    }
+    for name, body in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} " + body.format(rows=_BOOKS_FTS_ROWS))
+    if not exists:
+        conn.execute("INSERT INTO books_fts (books_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 4.0, 2.0, 2.0)')")
+        conn.execute("DELETE FROM books_fts")
+        conn.execute(_BOOKS_FTS_ROWS)
+        conn.execute("INSERT INTO books_fts (books_fts) VALUES ('optimize')")
+
+
+def dashboard_counters(conn):
+    # the one-row totals table of dashboard_counters.py, its triggers and
+    # its first counts
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS dashboard_counters (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_books INTEGER NOT NULL DEFAULT 0,
+            books_issued INTEGER NOT NULL DEFAULT 0,
+            books_returned INTEGER NOT NULL DEFAULT 0,
+            members INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    triggers = {
+        "dashboard_books_insert": """
+            AFTER INSERT ON books BEGIN
+                UPDATE dashboard_counters SET total_books = total_books + 1 WHERE id = 1;
+            END""",
+        "dashboard_books_delete": """
+            AFTER DELETE ON books BEGIN
+                UPDATE dashboard_counters SET total_books = total_books - 1 WHERE id = 1;
+            END""",
+        "dashboard_users_insert": """
+            AFTER INSERT ON users BEGIN
+                UPDATE dashboard_counters SET members = members + 1 WHERE id = 1;
+            END""",
+        "dashboard_users_delete": """
+            AFTER DELETE ON users BEGIN
+                UPDATE dashboard_counters SET members = members - 1 WHERE id = 1;
+            END""",
+        "dashboard_users_record_insert": """
+            AFTER INSERT ON users_record BEGIN
+                UPDATE dashboard_counters
+                   SET books_issued = books_issued + (NEW.is_returned = 0),
+                       books_returned = books_returned + (NEW.is_returned = 1)
+                 WHERE id = 1;
+            END""",
+        "dashboard_users_record_update": """
+            AFTER UPDATE OF is_returned ON users_record
+            WHEN OLD.is_returned IS NOT NEW.is_returned BEGIN
+                UPDATE dashboard_counters
+                   SET books_issued = books_issued + (NEW.is_returned = 0) - (OLD.is_returned = 0),
+                       books_returned = books_returned + (NEW.is_returned = 1) - (OLD.is_returned = 1)
+                 WHERE id = 1;
+            END""",
+        "dashboard_users_record_delete": """
+            AFTER DELETE ON users_record BEGIN
+                UPDATE dashboard_counters
+                   SET books_issued = books_issued - (OLD.is_returned = 0),
+                       books_returned = books_returned - (OLD.is_returned = 1)
+                 WHERE id = 1;
+            END""",
+    }
+    for name, body in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+    conn.execute("""
+        INSERT OR IGNORE INTO dashboard_counters (id, total_books, books_issued, books_returned, members)
+        SELECT 1, (SELECT COUNT(*) FROM books),
+                  (SELECT COUNT(*) FROM users_record WHERE is_returned = 0),
+                  (SELECT COUNT(*) FROM users_record WHERE is_returned = 1),
+                  (SELECT COUNT(*) FROM users)
+    """)
+
+
+def data_version_stamps(conn, tables):
+    # the data_versions table read by data_versions.py, with a version row
+    # and bump triggers for each table
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            entity TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    for table in tables:
+        conn.execute("INSERT OR IGNORE INTO data_versions (entity, version) VALUES (?, 0)", (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS data_version_{table}_{event.lower()}
+                AFTER {event} ON {table} BEGIN
+                    UPDATE data_versions SET version = version + 1 WHERE entity = '{table}';
+                END
+            """)
+
+
+def hot_query_indexes(conn):
+    # open-loan checks in issue_book and the circulation engine
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_users_record_user_book
+                    ON users_record(user_id, book_id, is_returned)""")
+    # issue_book looks users up by name and books by title
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_books_title ON books(title)")
+    # restore the isbn index lost when books was rebuilt; it can only be
+    # unique once the catalog has no duplicate ISBNs
+    duplicates = conn.execute(
+        "SELECT 1 FROM books GROUP BY isbn HAVING COUNT(*) > 1 LIMIT 1").fetchone()
+    unique = "" if duplicates else "UNIQUE"
+    conn.execute(f"CREATE {unique} INDEX IF NOT EXISTS idx_isbn ON books(isbn)")
+
+
+def timestamped_data_versions(conn, tables):
+    # data versions that also record when they changed (for Last-Modified):
+    # adds data_versions.updated_at and (re)creates the bump triggers of the
+    # given tables so they set it, including tables migration 4 set up
+    if "updated_at" not in _columns(conn, "data_versions"):
+        conn.execute("ALTER TABLE data_versions ADD COLUMN updated_at TEXT")
+    for table in tables:
+        conn.execute("""INSERT OR IGNORE INTO data_versions (entity, version, updated_at)
+                        VALUES (?, 0, CURRENT_TIMESTAMP)""", (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f"DROP TRIGGER IF EXISTS data_version_{table}_{event.lower()}")
+            conn.execute(f"""
+                CREATE TRIGGER data_version_{table}_{event.lower()}
+                AFTER {event} ON {table} BEGIN
+                    UPDATE data_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+                    WHERE entity = '{table}';
+                END
+            """)
+    conn.execute("UPDATE data_versions SET updated_at = CURRENT_TIMESTAMP WHERE updated_at IS NULL")
+
+
+def overdue_tables(conn):
+    # for overdue.py: the open loans by due date and the daily snapshots
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_users_record_open_due
+                    ON users_record(due_date) WHERE is_returned = 0""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS overdue_snapshots (
+            snapshot_date TEXT PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            overdue_loans INTEGER NOT NULL,
+            overdue_members INTEGER NOT NULL,
+            total_fines REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS overdue_snapshot_members (
+            snapshot_date TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            overdue_loans INTEGER NOT NULL,
+            max_days_overdue INTEGER NOT NULL,
+            fine REAL NOT NULL,
+            PRIMARY KEY (snapshot_date, user_id)
+        )
+    """)
+
+
+def typeahead_indexes(conn):
+    # case-insensitive indexes for the name/number searches of typeahead.py
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_pa_pss_nocase ON users(pa_pss_number COLLATE NOCASE)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_books_title_nocase ON books(title COLLATE NOCASE)")
+
+
+def rollup_tables(conn):
+    # the rollups of rollups.py, filled from the lending history
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS circulation_daily (
+            day TEXT PRIMARY KEY,
+            issues INTEGER NOT NULL DEFAULT 0,
+            returns INTEGER NOT NULL DEFAULT 0,
+            active_members INTEGER NOT NULL DEFAULT 0   -- members who borrowed that day
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS circulation_books (
+            book_id INTEGER PRIMARY KEY,
+            issues INTEGER NOT NULL DEFAULT 0,
+            returns INTEGER NOT NULL DEFAULT 0,
+            last_issued TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS circulation_users (
+            user_id INTEGER PRIMARY KEY,
+            issues INTEGER NOT NULL DEFAULT 0,
+            returns INTEGER NOT NULL DEFAULT 0,
+            last_issued TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_circulation_books_issues ON circulation_books(issues)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_circulation_users_issues ON circulation_users(issues)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_circulation_users_last_issued ON circulation_users(last_issued)")
+    for table in ("circulation_daily", "circulation_books", "circulation_users"):
+        conn.execute(f"DELETE FROM {table}")
+    conn.execute("""
+        INSERT INTO circulation_daily (day, issues, returns, active_members)
+        SELECT day, SUM(issues), SUM(returns), SUM(active_members) FROM (
+            SELECT date(issue_date) AS day, COUNT(*) AS issues, 0 AS returns,
+                   COUNT(DISTINCT user_id) AS active_members
+            FROM users_record WHERE date(issue_date) IS NOT NULL
+            GROUP BY day
+            UNION ALL
+            SELECT date(return_date), 0, COUNT(*), 0
+            FROM users_record WHERE is_returned = 1 AND date(return_date) IS NOT NULL
+            GROUP BY date(return_date)
+        )
+        GROUP BY day
+    """)
+    for table, column in (("circulation_books", "book_id"), ("circulation_users", "user_id")):
+        conn.execute(f"""
+            INSERT INTO {table} ({column}, issues, returns, last_issued)
+            SELECT {column}, COUNT(*), SUM(is_returned = 1), MAX(issue_date)
+            FROM users_record GROUP BY {column}
+        """)
+
+
+def recommendation_tables(conn):
+    # the co-borrowing matrix of recommendations.py, filled from the lending
+    # history with the configured pair window
+    window = int(os.environ.get("RECOMMENDATION_WINDOW", "20"))
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS book_pairs (
+            book_id INTEGER NOT NULL,
+            related_id INTEGER NOT NULL,
+            together INTEGER NOT NULL,
+            PRIMARY KEY (book_id, related_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_book_pairs_top ON book_pairs(book_id, together)")
+    conn.execute("DROP TABLE IF EXISTS temp.member_books")
+    conn.execute("""
+        CREATE TEMP TABLE member_books AS
+        SELECT user_id, book_id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY MIN(users_record_id)) AS position
+        FROM users_record
+        GROUP BY user_id, book_id
+    """)
+    conn.execute("CREATE INDEX temp.idx_member_books ON member_books(user_id, position)")
+    conn.execute("DELETE FROM book_pairs")
+    conn.execute("""
+        INSERT INTO book_pairs (book_id, related_id, together)
+        SELECT first.book_id, second.book_id, COUNT(*)
+        FROM member_books AS first
+        JOIN member_books AS second
+          ON second.user_id = first.user_id
+         AND second.position BETWEEN first.position - ? AND first.position + ?
+         AND second.position <> first.position
+        GROUP BY first.book_id, second.book_id
+    """, (window, window))
+    conn.execute("DROP TABLE temp.member_books")
+
+
+def _normalized_name(name, person):
+    # duplicates.normalize_name as released with migration 12
+    text = unicodedata.normalize("NFKD", name or "")
+    text = "".join(char for char in text if not unicodedata.combining(char)).casefold()
+    if person and text.count(",") == 1:
+        last, first = text.split(",")
+        text = f"{first} {last}"
+    words, initials = [], ""
+    for word in re.findall(r"[^\W_]+", text):
+        if len(word) == 1:
+            initials += word
+            continue
+        if initials:
+            words.append(initials)
+            initials = ""
+        words.append(word)
+    if initials:
+        words.append(initials)
+    return " ".join(words)
+
+
+def duplicate_indexes(conn):
+    # for duplicates.py: normalized_name on authors, publishers and genres,
+    # an index on it and a trigram index of it kept up to date by triggers
+    for entity, id_column, name_column, person in (("authors", "author_id", "name", True),
+                                                   ("publishers", "publisher_id", "name", False),
+                                                   ("genres", "genre_id", "genre_name", False)):
+        if "normalized_name" not in _columns(conn, entity):
+            conn.execute(f"ALTER TABLE {entity} ADD COLUMN normalized_name TEXT")
+        rows = conn.execute(f"SELECT {id_column}, {name_column} FROM {entity}").fetchall()
+        conn.executemany(f"UPDATE {entity} SET normalized_name = ? WHERE {id_column} = ?",
+                         [(_normalized_name(row[1], person), row[0]) for row in rows])
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{entity}_normalized_name ON {entity}(normalized_name)")
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {entity}_names USING fts5(name, tokenize = 'trigram')")
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {entity}_names_vocab USING fts5vocab({entity}_names, row)")
+        # rows written without a normalized_name (by another tool) are
+        # indexed by their lower-cased name instead
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {entity}_names_insert AFTER INSERT ON {entity} BEGIN
+                INSERT INTO {entity}_names (rowid, name)
+                VALUES (NEW.{id_column}, COALESCE(NEW.normalized_name, lower(NEW.{name_column})));
+            END""")
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {entity}_names_update AFTER UPDATE OF {name_column}, normalized_name ON {entity} BEGIN
+                DELETE FROM {entity}_names WHERE rowid = OLD.{id_column};
+                INSERT INTO {entity}_names (rowid, name)
+                VALUES (NEW.{id_column}, COALESCE(NEW.normalized_name, lower(NEW.{name_column})));
+            END""")
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {entity}_names_delete AFTER DELETE ON {entity} BEGIN
+                DELETE FROM {entity}_names WHERE rowid = OLD.{id_column};
+            END""")
+        conn.execute(f"DELETE FROM {entity}_names")
+        conn.execute(f"""INSERT INTO {entity}_names (rowid, name)
+                         SELECT {id_column}, COALESCE(normalized_name, lower({name_column})) FROM {entity}""")
+
+
+def scanner_indexes(conn):
+    # the normalized ISBN and member number lookups of scanner.py; unique
+    # unless existing rows collide (like idx_isbn)
+    for name, table, key in (("idx_books_isbn_key", "books", "upper(replace(replace(trim(isbn), '-', ''), ' ', ''))"),
+                             ("idx_users_pa_pss_key", "users", "upper(trim(pa_pss_number))")):
+        duplicates = conn.execute(f"SELECT 1 FROM {table} GROUP BY {key} HAVING COUNT(*) > 1 LIMIT 1").fetchone()
+        conn.execute(f"CREATE {'' if duplicates else 'UNIQUE'} INDEX IF NOT EXISTS {name} ON {table}({key})")
+
+
+def book_copies(conn):
+    # the copies of copies.py: one per copies_total (more if more loans are
+    # open), open loans tied to a copy each, the triggers that keep the
+    # books counters, then the counters recomputed from the copies
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS book_copies (
+            copy_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL,
+            barcode TEXT NOT NULL,
+            shelf_number INTEGER,
+            condition TEXT NOT NULL DEFAULT 'good',
+            state TEXT NOT NULL DEFAULT 'available' CHECK (state IN ('available', 'on_loan', 'missing', 'withdrawn')),
+            added_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (book_id) REFERENCES books(book_id) ON DELETE CASCADE
+        )
+    """)
+    if "copy_id" not in _columns(conn, "users_record"):
+        conn.execute("ALTER TABLE users_record ADD COLUMN copy_id INTEGER REFERENCES book_copies(copy_id)")
+
+    if conn.execute("SELECT 1 FROM book_copies LIMIT 1").fetchone() is None:
+        prefix = os.environ.get("COPY_BARCODE_PREFIX", "C")
+        open_loans = {}
+        for users_record_id, book_id in conn.execute("""
+                SELECT users_record_id, book_id FROM users_record WHERE is_returned = 0
+                ORDER BY book_id, users_record_id""").fetchall():
+            open_loans.setdefault(book_id, []).append(users_record_id)
+        copies, loans = [], []
+        copy_id = 0
+        for book_id, copies_total, shelf_number in conn.execute(
+                "SELECT book_id, copies_total, shelf_number FROM books ORDER BY book_id").fetchall():
+            out = open_loans.get(book_id, [])
+            for index in range(max(copies_total or 0, len(out))):
+                copy_id += 1
+                state = "on_loan" if index < len(out) else "available"
+                copies.append((copy_id, book_id, f"{prefix}{copy_id:08d}", shelf_number, state))
+                if state == "on_loan":
+                    loans.append((copy_id, out[index]))
+        conn.executemany("""INSERT INTO book_copies (copy_id, book_id, barcode, shelf_number, state)
+                            VALUES (?, ?, ?, ?, ?)""", copies)
+        conn.executemany("UPDATE users_record SET copy_id = ? WHERE users_record_id = ?", loans)
+
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_book_copies_barcode ON book_copies(barcode)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_book_copies_book_state ON book_copies(book_id, state)")
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_users_record_open_copy
+                    ON users_record(copy_id) WHERE is_returned = 0""")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS book_copies_insert
+        AFTER INSERT ON book_copies BEGIN
+            UPDATE books
+               SET copies_total = copies_total + (NEW.state <> 'withdrawn'),
+                   copies_available = copies_available + (NEW.state = 'available'),
+                   status = CASE WHEN copies_available + (NEW.state = 'available') > 0 THEN 'available' ELSE 'unavailable' END
+             WHERE book_id = NEW.book_id;
+        END""")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS book_copies_update
+        AFTER UPDATE OF state, book_id ON book_copies
+        WHEN OLD.state IS NOT NEW.state OR OLD.book_id IS NOT NEW.book_id BEGIN
+            UPDATE books
+               SET copies_total = copies_total - (OLD.state <> 'withdrawn'),
+                   copies_available = copies_available - (OLD.state = 'available'),
+                   status = CASE WHEN copies_available - (OLD.state = 'available') > 0 THEN 'available' ELSE 'unavailable' END
+             WHERE book_id = OLD.book_id;
+            UPDATE books
+               SET copies_total = copies_total + (NEW.state <> 'withdrawn'),
+                   copies_available = copies_available + (NEW.state = 'available'),
+                   status = CASE WHEN copies_available + (NEW.state = 'available') > 0 THEN 'available' ELSE 'unavailable' END
+             WHERE book_id = NEW.book_id;
+        END""")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS book_copies_delete
+        AFTER DELETE ON book_copies BEGIN
+            UPDATE books
+               SET copies_total = copies_total - (OLD.state <> 'withdrawn'),
+                   copies_available = copies_available - (OLD.state = 'available'),
+                   status = CASE WHEN copies_available - (OLD.state = 'available') > 0 THEN 'available' ELSE 'unavailable' END
+             WHERE book_id = OLD.book_id;
+        END""")
+    conn.execute("""
+        UPDATE books SET copies_total = counts.total, copies_available = counts.available,
+                         status = CASE WHEN counts.available > 0 THEN 'available' ELSE 'unavailable' END
+        FROM (SELECT books.book_id,
+                     COALESCE(SUM(book_copies.state <> 'withdrawn'), 0) AS total,
+                     COALESCE(SUM(book_copies.state = 'available'), 0) AS available
+              FROM books LEFT JOIN book_copies ON book_copies.book_id = books.book_id
+              GROUP BY books.book_id) AS counts
+        WHERE books.book_id = counts.book_id
+          AND (books.copies_total IS NOT counts.total OR books.copies_available IS NOT counts.available)
+    """)
+
+
+def stocktake_tables(conn):
+    # sessions, scans and results of stocktake.py
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stocktake_sessions (
+            session_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            closed_at TEXT,
+            scans INTEGER NOT NULL DEFAULT 0,
+            compared_at TEXT,
+            compared_scans INTEGER          -- scans when compare() last ran
+        )
+    """)
+    # shelf_number has the affinity of books.shelf_number, so "12" from a
+    # scanner file compares equal to the stored 12
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stocktake_scans (
+            scan_id INTEGER PRIMARY KEY,
+            session_id INTEGER NOT NULL,
+            shelf_number INTEGER NOT NULL,
+            code TEXT NOT NULL,
+            copy_id INTEGER,
+            book_id INTEGER,
+            scanned_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stocktake_results (
+            result_id INTEGER PRIMARY KEY,
+            session_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            reason TEXT,
+            scan_id INTEGER,
+            copy_id INTEGER,
+            book_id INTEGER,
+            shelf_number INTEGER,           -- where it was scanned (missing: where it belongs)
+            expected_shelf INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stocktake_scans_session ON stocktake_scans(session_id, shelf_number)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stocktake_results_session ON stocktake_results(session_id, kind)")
+    # the expected holdings of a shelf
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_book_copies_shelf_state ON book_copies(shelf_number, state)")
+
+
+# (version, description, step) in the order they must run; never reorder or
+# edit a released step, add a new one instead
+MIGRATIONS = [
+    (1, "baseline schema", baseline),
+    (2, "books_fts full text index", books_fts_index),
+    (3, "dashboard counters", dashboard_counters),
+    (4, "reference data versions", lambda conn: data_version_stamps(conn, ("authors", "publishers", "genres"))),
+    (5, "hot query indexes", hot_query_indexes),
+    # also recreates the reference triggers so they record updated_at
+    (6, "catalog data versions",
+     lambda conn: timestamped_data_versions(conn, ("authors", "publishers", "genres", "books", "book_genres"))),
+    (7, "circulation data versions", lambda conn: timestamped_data_versions(conn, ("users", "users_record"))),
+    (8, "overdue index and snapshots", overdue_tables),
+    (9, "typeahead indexes", typeahead_indexes),
+    (10, "circulation rollups", rollup_tables),
+    (11, "co-borrowing recommendations", recommendation_tables),
+    (12, "normalized names and trigram indexes", duplicate_indexes),
+    (13, "scanner isbn and member number indexes", scanner_indexes),
+    (14, "book copies", book_copies),
+    (15, "stocktake sessions", stocktake_tables),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _create_version_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    """)
+    conn.commit()
+
+
+def current_version(conn):
+    _create_version_table(conn)
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def pending_migrations(conn):
+    _create_version_table(conn)
+    applied = {row[0] for row in conn.execute("SELECT version FROM schema_version")}
+    return [migration for migration in MIGRATIONS if migration[0] not in applied]
+
+
+def migrate(conn, target=None):
+    # apply every pending step (up to and including version target, if
+    # given); returns the list of (version, description) applied
+    pending = [m for m in pending_migrations(conn) if target is None or m[0] <= target]
+    if not pending:
+        return []
+    applied = []
+    for version, description, step in pending:
+        # workers may start at the same time: take the write lock, then check
+        # again whether another worker applied this step meanwhile
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            done = conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone()
+            if not done:
+                step(conn)
+                conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                             (version, description, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+                applied.append((version, description))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    if applied:
+        conn.execute("PRAGMA optimize")
+    return applied
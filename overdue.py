@@ -0,0 +1,112 @@
+import os
+from datetime import datetime
+from circulation import DATE_FORMAT, immediate_transaction
+
+
+# Overdue loans and fines. Open loans past their due date are found through
+# the partial index idx_users_record_open_due (due_date WHERE is_returned = 0),
+# which only holds loans that are still out, and days overdue and fines are
+# computed in SQL in one pass, so the cost follows the number of open loans
+# rather than the size of the lending history. A daily snapshot of the
+# totals and per-member fines is written by the overdue-snapshot command.
+
+FINE_PER_DAY = float(os.environ.get("FINE_PER_DAY", "10"))
+GRACE_DAYS = int(os.environ.get("FINE_GRACE_DAYS", "0"))
+MAX_FINE_PER_LOAN = float(os.environ.get("MAX_FINE_PER_LOAN", "0"))  # 0 = no cap
+
+
+def _now(now):
+    return (now or datetime.now()).strftime(DATE_FORMAT)
+
+
+# open loans past due with days overdue and the fine each one has accrued;
+# bind :now and the fine settings (see _params)
+OVERDUE_LOANS = """
+    SELECT users_record_id, user_id, book_id, issue_date, due_date, days_overdue,
+           CASE WHEN :cap > 0 THEN MIN(MAX(days_overdue - :grace, 0) * :per_day, :cap)
+                ELSE MAX(days_overdue - :grace, 0) * :per_day END AS fine
+    FROM (
+        SELECT users_record_id, user_id, book_id, issue_date, due_date,
+               CAST(julianday(:now) - julianday(due_date) AS INTEGER) AS days_overdue
+        FROM users_record INDEXED BY idx_users_record_open_due
+        WHERE is_returned = 0 AND due_date < :now
+    )
+"""
+
+
+def _params(now, **extra):
+    return {"now": _now(now), "grace": GRACE_DAYS, "per_day": FINE_PER_DAY, "cap": MAX_FINE_PER_LOAN, **extra}
+
+
+def summary(conn, now=None):
+    row = conn.execute(f"""
+        SELECT COUNT(*), COUNT(DISTINCT user_id), COALESCE(SUM(fine), 0), COALESCE(MAX(days_overdue), 0)
+        FROM ({OVERDUE_LOANS})
+    """, _params(now)).fetchone()
+    return {"overdue_loans": row[0], "overdue_members": row[1], "total_fines": row[2], "max_days_overdue": row[3],
+            "as_of": _now(now), "fine_per_day": FINE_PER_DAY, "grace_days": GRACE_DAYS,
+            "max_fine_per_loan": MAX_FINE_PER_LOAN or None}
+
+
+def overdue_loans(conn, now=None, user_id=None, after=None, before=None, limit=100):
+    # most overdue first. after/before: (due_date, users_record_id) keyset
+    # cursor; with before the rows come back in reverse order (as Pager expects)
+    conditions, params = [], _params(now, limit=limit)
+    if user_id is not None:
+        conditions.append("overdue.user_id = :user_id")
+        params["user_id"] = user_id
+    cursor = after or before
+    if cursor is not None:
+        conditions.append(f"(overdue.due_date, overdue.users_record_id) {'>' if after else '<'} (:cursor_due, :cursor_id)")
+        params.update(cursor_due=cursor[0], cursor_id=cursor[1])
+    direction = "DESC" if before and not after else "ASC"
+    return conn.execute(f"""
+        SELECT overdue.*, users.username, users.pa_pss_number, books.title
+        FROM ({OVERDUE_LOANS}) AS overdue
+        LEFT JOIN users ON users.user_id = overdue.user_id
+        LEFT JOIN books ON books.book_id = overdue.book_id
+        WHERE {" AND ".join(conditions) or "1"}
+        ORDER BY overdue.due_date {direction}, overdue.users_record_id {direction}
+        LIMIT :limit
+    """, params).fetchall()
+
+
+def fines_by_member(conn, now=None, limit=None):
+    # members with overdue loans, largest fine first
+    return conn.execute(f"""
+        SELECT overdue.user_id, users.username, users.pa_pss_number, COUNT(*) AS overdue_loans,
+               MAX(overdue.days_overdue) AS max_days_overdue, SUM(overdue.fine) AS fine
+        FROM ({OVERDUE_LOANS}) AS overdue
+        LEFT JOIN users ON users.user_id = overdue.user_id
+        GROUP BY overdue.user_id
+        ORDER BY fine DESC, overdue.user_id
+        LIMIT :limit
+    """, _params(now, limit=-1 if limit is None else limit)).fetchall()
+
+
+def write_snapshot(conn, now=None):
+    # (re)writes the snapshot for now's date in one transaction; returns its summary
+    now = now or datetime.now()
+    snapshot_date = now.strftime('%Y-%m-%d')
+    params = _params(now, snapshot_date=snapshot_date)
+    with immediate_transaction(conn):
+        conn.execute("DELETE FROM overdue_snapshot_members WHERE snapshot_date = ?", (snapshot_date,))
+        conn.execute("DELETE FROM overdue_snapshots WHERE snapshot_date = ?", (snapshot_date,))
+        conn.execute(f"""
+            INSERT INTO overdue_snapshot_members (snapshot_date, user_id, overdue_loans, max_days_overdue, fine)
+            SELECT :snapshot_date, user_id, COUNT(*), MAX(days_overdue), SUM(fine)
+            FROM ({OVERDUE_LOANS})
+            GROUP BY user_id
+        """, params)
+        conn.execute("""
+            INSERT INTO overdue_snapshots (snapshot_date, created_at, overdue_loans, overdue_members, total_fines)
+            SELECT :snapshot_date, :now, COALESCE(SUM(overdue_loans), 0), COUNT(*), COALESCE(SUM(fine), 0)
+            FROM overdue_snapshot_members WHERE snapshot_date = :snapshot_date
+        """, params)
+    row = conn.execute("""SELECT overdue_loans, overdue_members, total_fines FROM overdue_snapshots
+                          WHERE snapshot_date = ?""", (snapshot_date,)).fetchone()
+    return {"snapshot_date": snapshot_date, "overdue_loans": row[0], "overdue_members": row[1], "total_fines": row[2]}
+
+
+def recent_snapshots(conn, days=30):
+    return conn.execute("SELECT * FROM overdue_snapshots ORDER BY snapshot_date DESC LIMIT ?", (days,)).fetchall()
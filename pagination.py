@@ -0,0 +1,124 @@
+import os
+from flask import request, url_for
+
+
+# Keyset (cursor) pagination for the listing pages. Instead of OFFSET, each
+# page remembers the sort key of its first and last row, and the next query
+# starts right after it, so every page costs an index range scan of
+# per_page rows no matter how deep into the table it is.
+
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "500"))
+FETCH_SIZE = 100  # rows read per fetchmany() by iterate()
+
+
+class Pager:
+    def __init__(self, columns, types=(int,)):
+        # columns: SQL expressions forming a unique sort key, e.g. ["users.user_id"]
+        # types: how to parse each key value back out of the cursor
+        self.columns = columns
+        self.types = types
+        self.per_page = _page_size(request.args.get('per_page'))
+        self.after = self._parse(request.args.get('after'))
+        self.before = None if self.after else self._parse(request.args.get('before'))
+        self.rows = []
+        self.next_url = None
+        self.prev_url = None
+
+    def _parse(self, cursor):
+        if not cursor:
+            return None
+        values = cursor.split(',')
+        if len(values) != len(self.columns):
+            return None
+        try:
+            return tuple(kind(value) for kind, value in zip(self.types, values))
+        except ValueError:
+            return None
+
+    def _key(self):
+        return self.columns[0] if len(self.columns) == 1 else "(" + ", ".join(self.columns) + ")"
+
+    def where(self):
+        # keyset condition to AND into the query's WHERE clause
+        cursor = self.after or self.before
+        if cursor is None:
+            return "1", ()
+        placeholders = "?" if len(cursor) == 1 else "(" + ", ".join("?" * len(cursor)) + ")"
+        op = ">" if self.after else "<"
+        return f"{self._key()} {op} {placeholders}", cursor
+
+    def order_by(self):
+        direction = "DESC" if self.before else "ASC"
+        return ", ".join(f"{column} {direction}" for column in self.columns)
+
+    def limit(self):
+        # one extra row tells us whether there is another page
+        return self.per_page + 1
+
+    def paginate(self, rows, key):
+        # rows: fetched with where()/order_by()/limit(); key: row -> sort key tuple
+        # fetchall() rather than iterating, so the fetch is timed by instrumentation
+        rows = rows.fetchall() if hasattr(rows, 'fetchall') else list(rows)
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if self.before:
+            rows.reverse()
+        self.rows = rows
+        self._links(rows[0] if rows else None, rows[-1] if rows else None, more, key)
+        return rows
+
+    def iterate(self, cursor, key):
+        # like paginate(), but yields the rows as they are fetched, for pages
+        # rendered row by row; next_url/prev_url are set once the rows have been
+        # consumed, so render the page links after the rows
+        if self.before:
+            # a page read backwards has to be reversed, so fetch it whole
+            yield from self.paginate(cursor, key)
+            return
+        first = last = None
+        count, more = 0, False
+        while not more:
+            batch = cursor.fetchmany(FETCH_SIZE)
+            if not batch:
+                break
+            for row in batch:
+                if count == self.per_page:
+                    more = True
+                    break
+                if first is None:
+                    first = row
+                last = row
+                count += 1
+                yield row
+        self._links(first, last, more, key)
+
+    def _links(self, first, last, more, key):
+        # first/last: rows of the page in display order, None when it is empty
+        if first is not None:
+            has_next = more if not self.before else True
+            has_prev = more if self.before else self.after is not None
+            if has_next:
+                self.next_url = self._url(after=_cursor(key(last)))
+            if has_prev:
+                self.prev_url = self._url(before=_cursor(key(first)))
+        elif self.after or self.before:
+            # ran off the end (e.g. rows deleted since the link was made)
+            self.prev_url = self._url()
+
+    def _url(self, **cursor):
+        args = {k: v for k, v in request.args.items() if k not in ('after', 'before')}
+        args.update(cursor)
+        return url_for(request.endpoint, **request.view_args, **args)
+
+
+def _cursor(values):
+    return ",".join(repr(v) if isinstance(v, float) else str(v) for v in values)
+
+
+def _page_size(value):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
@@ -0,0 +1,89 @@
+import os
+
+
+# "Members who borrowed this also borrowed". book_pairs is a sparse
+# book x book co-borrowing matrix: together counts the members who borrowed
+# both books. Each member's distinct books are taken in the order they were
+# first borrowed, and a book is only paired with the PAIR_WINDOW books
+# either side of it, which keeps the matrix (and the work per loan) bounded
+# for members with a long history. The circulation engine adds a new loan's
+# pairs in the issue's transaction (record_loan); rebuild() recomputes the
+# whole matrix from users_record in SQL. Top-N lookups read the first rows
+# of idx_book_pairs_top, so they cost the same however large the matrix is.
+
+PAIR_WINDOW = int(os.environ.get("RECOMMENDATION_WINDOW", "20"))
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+
+
+def rebuild(conn, window=None):
+    # recompute book_pairs from users_record (the caller commits); returns
+    # the number of pairs stored
+    window = PAIR_WINDOW if window is None else window
+    conn.execute("DROP TABLE IF EXISTS temp.member_books")
+    conn.execute("""
+        CREATE TEMP TABLE member_books AS
+        SELECT user_id, book_id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY MIN(users_record_id)) AS position
+        FROM users_record
+        GROUP BY user_id, book_id
+    """)
+    conn.execute("CREATE INDEX temp.idx_member_books ON member_books(user_id, position)")
+    conn.execute("DELETE FROM book_pairs")
+    conn.execute("""
+        INSERT INTO book_pairs (book_id, related_id, together)
+        SELECT first.book_id, second.book_id, COUNT(*)
+        FROM member_books AS first
+        JOIN member_books AS second
+          ON second.user_id = first.user_id
+         AND second.position BETWEEN first.position - ? AND first.position + ?
+         AND second.position <> first.position
+        GROUP BY first.book_id, second.book_id
+    """, (window, window))
+    conn.execute("DROP TABLE temp.member_books")
+    return conn.execute("SELECT COUNT(*) FROM book_pairs").fetchone()[0]
+
+
+def record_loan(conn, user_id, book_id, window=None):
+    # called inside the issue's transaction, after the users_record insert.
+    # Only a member's first loan of a book adds pairs: with the books they
+    # first borrowed most recently before it.
+    window = PAIR_WINDOW if window is None else window
+    loans = conn.execute("SELECT COUNT(*) FROM users_record WHERE user_id = ? AND book_id = ?",
+                         (user_id, book_id)).fetchone()[0]
+    if loans != 1 or window <= 0:
+        return 0
+    previous = [row[0] for row in conn.execute("""
+        SELECT book_id FROM users_record
+        WHERE user_id = ? AND book_id <> ?
+        GROUP BY book_id
+        ORDER BY MIN(users_record_id) DESC
+        LIMIT ?
+    """, (user_id, book_id, window)).fetchall()]
+    conn.executemany("""
+        INSERT INTO book_pairs (book_id, related_id, together) VALUES (?, ?, 1)
+        ON CONFLICT (book_id, related_id) DO UPDATE SET together = together + 1
+    """, [(book_id, other) for other in previous] + [(other, book_id) for other in previous])
+    return len(previous)
+
+
+def clamp_limit(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_LIMIT
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def related_books(conn, book_id, limit=DEFAULT_LIMIT):
+    # books most often borrowed by the members who borrowed book_id
+    return [dict(row) for row in conn.execute("""
+        SELECT pairs.related_id AS book_id, books.title, books.isbn, books.copies_available, pairs.together
+        FROM (
+            SELECT related_id, together FROM book_pairs INDEXED BY idx_book_pairs_top
+            WHERE book_id = ?
+            ORDER BY together DESC, related_id DESC
+            LIMIT ?
+        ) AS pairs
+        JOIN books ON books.book_id = pairs.related_id
+        ORDER BY pairs.together DESC, pairs.related_id DESC
+    """, (book_id, limit)).fetchall()]
@@ -0,0 +1,64 @@
+import threading
+from data_versions import read_versions
+
+
+# In-process cache of the authors, publishers and genres lists used by the
+# book forms and the add/update pages. Entries are keyed by the table's data
+# version, which triggers bump on every write (see data_versions.py), so a
+# write in any worker invalidates the cached list in every worker.
+
+ENTITIES = ("authors", "publishers", "genres")
+
+QUERIES = {
+    "authors": "SELECT * FROM authors WHERE is_deleted = 0 ORDER BY author_id DESC",
+    "publishers": "SELECT * FROM publishers WHERE is_deleted = 0 ORDER BY publisher_id DESC",
+    "genres": "SELECT * FROM genres WHERE is_deleted = 0 ORDER BY genre_id DESC",
+}
+
+
+class ReferenceCache:
+    def __init__(self):
+        self._entries = {}  # entity -> (version, rows)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conn, *entities):
+        # returns the row list for each entity, in order; the lists are shared
+        # between requests and must not be modified
+        versions = read_versions(conn)
+        lists = []
+        for entity in entities:
+            version = versions.get(entity)
+            entry = self._entries.get(entity)
+            if entry is not None and version is not None and entry[0] == version:
+                with self._lock:
+                    self.hits += 1
+                lists.append(entry[1])
+                continue
+            rows = conn.execute(QUERIES[entity]).fetchall()
+            with self._lock:
+                self.misses += 1
+                self._entries[entity] = (version, rows)
+            lists.append(rows)
+        return lists
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+reference_cache = ReferenceCache()
+
+
+def get_reference_lists(conn, *entities):
+    return reference_cache.get(conn, *entities)
@@ -0,0 +1,152 @@
+from datetime import date, datetime, timedelta
+
+
+# Circulation analytics. Three rollup tables summarise users_record:
+#   circulation_daily  issues, returns and members borrowing per calendar day
+#   circulation_books  issues, returns and last issue per book
+#   circulation_users  issues, returns and last issue per member
+# The circulation engine updates them in the same transaction as every issue
+# and return (record_issue / record_return), so the analytics page and API
+# read a few hundred rollup rows instead of aggregating the whole lending
+# history. backfill() rebuilds them from users_record.
+
+DEFAULT_DAYS = 90
+MAX_DAYS = 731
+ACTIVE_WINDOWS = (30, 90, 365)
+DAY_FORMAT = '%Y-%m-%d'
+
+
+def backfill(conn):
+    # recompute every rollup from users_record (the caller commits);
+    # returns the number of rows written per table
+    for table in ("circulation_daily", "circulation_books", "circulation_users"):
+        conn.execute(f"DELETE FROM {table}")
+    conn.execute("""
+        INSERT INTO circulation_daily (day, issues, returns, active_members)
+        SELECT day, SUM(issues), SUM(returns), SUM(active_members) FROM (
+            SELECT date(issue_date) AS day, COUNT(*) AS issues, 0 AS returns,
+                   COUNT(DISTINCT user_id) AS active_members
+            FROM users_record WHERE date(issue_date) IS NOT NULL
+            GROUP BY day
+            UNION ALL
+            SELECT date(return_date), 0, COUNT(*), 0
+            FROM users_record WHERE is_returned = 1 AND date(return_date) IS NOT NULL
+            GROUP BY date(return_date)
+        )
+        GROUP BY day
+    """)
+    for table, column in (("circulation_books", "book_id"), ("circulation_users", "user_id")):
+        conn.execute(f"""
+            INSERT INTO {table} ({column}, issues, returns, last_issued)
+            SELECT {column}, COUNT(*), SUM(is_returned = 1), MAX(issue_date)
+            FROM users_record GROUP BY {column}
+        """)
+    return {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("circulation_daily", "circulation_books", "circulation_users")}
+
+
+def record_issue(conn, user_id, book_id, issued_at):
+    # called inside the issue's transaction; issued_at: the issue_date written
+    day = issued_at[:10]
+    last = conn.execute("SELECT last_issued FROM circulation_users WHERE user_id = ?", (user_id,)).fetchone()
+    first_today = last is None or last[0] is None or last[0][:10] < day
+    conn.execute("""
+        INSERT INTO circulation_daily (day, issues, active_members) VALUES (?, 1, ?)
+        ON CONFLICT (day) DO UPDATE SET issues = issues + 1, active_members = active_members + excluded.active_members
+    """, (day, int(first_today)))
+    for table, column, key in (("circulation_books", "book_id", book_id), ("circulation_users", "user_id", user_id)):
+        conn.execute(f"""
+            INSERT INTO {table} ({column}, issues, last_issued) VALUES (?, 1, ?)
+            ON CONFLICT ({column}) DO UPDATE SET issues = issues + 1,
+                last_issued = MAX(COALESCE(last_issued, ''), excluded.last_issued)
+        """, (key, issued_at))
+
+
+def record_return(conn, user_id, book_id, returned_at):
+    # called inside the return's transaction; returned_at: the return_date written
+    conn.execute("""
+        INSERT INTO circulation_daily (day, returns) VALUES (?, 1)
+        ON CONFLICT (day) DO UPDATE SET returns = returns + 1
+    """, (returned_at[:10],))
+    for table, column, key in (("circulation_books", "book_id", book_id), ("circulation_users", "user_id", user_id)):
+        conn.execute(f"""
+            INSERT INTO {table} ({column}, returns) VALUES (?, 1)
+            ON CONFLICT ({column}) DO UPDATE SET returns = returns + 1
+        """, (key,))
+
+
+def parse_range(date_from=None, date_to=None, today=None):
+    # (start, end) dates, both inclusive; defaults to the last DEFAULT_DAYS
+    # days. Raises ValueError for bad dates or ranges longer than MAX_DAYS.
+    today = today or date.today()
+    try:
+        end = datetime.strptime(date_to, DAY_FORMAT).date() if date_to else today
+        start = datetime.strptime(date_from, DAY_FORMAT).date() if date_from else end - timedelta(days=DEFAULT_DAYS - 1)
+    except ValueError:
+        raise ValueError("from and to must be dates like 2024-01-31")
+    if start > end:
+        raise ValueError("from must not be after to")
+    if (end - start).days + 1 > MAX_DAYS:
+        raise ValueError(f"the range can span at most {MAX_DAYS} days")
+    return start, end
+
+
+def daily(conn, start, end):
+    # one entry per day of the range, days without loans included
+    rows = {row['day']: row for row in conn.execute("""
+        SELECT day, issues, returns, active_members FROM circulation_daily
+        WHERE day BETWEEN ? AND ? ORDER BY day
+    """, (start.strftime(DAY_FORMAT), end.strftime(DAY_FORMAT))).fetchall()}
+    days = []
+    for offset in range((end - start).days + 1):
+        day = (start + timedelta(days=offset)).strftime(DAY_FORMAT)
+        row = rows.get(day)
+        days.append({"day": day, "issues": row['issues'] if row else 0, "returns": row['returns'] if row else 0,
+                     "active_members": row['active_members'] if row else 0})
+    return days
+
+
+def top_books(conn, limit=10):
+    return [dict(row) for row in conn.execute("""
+        SELECT circulation_books.book_id, books.title, circulation_books.issues, circulation_books.returns,
+               circulation_books.last_issued
+        FROM circulation_books INDEXED BY idx_circulation_books_issues
+        LEFT JOIN books ON books.book_id = circulation_books.book_id
+        ORDER BY circulation_books.issues DESC
+        LIMIT ?
+    """, (limit,)).fetchall()]
+
+
+def top_members(conn, limit=10):
+    return [dict(row) for row in conn.execute("""
+        SELECT circulation_users.user_id, users.username, users.pa_pss_number, circulation_users.issues,
+               circulation_users.returns, circulation_users.last_issued
+        FROM circulation_users INDEXED BY idx_circulation_users_issues
+        LEFT JOIN users ON users.user_id = circulation_users.user_id
+        ORDER BY circulation_users.issues DESC
+        LIMIT ?
+    """, (limit,)).fetchall()]
+
+
+def active_members(conn, today=None, windows=ACTIVE_WINDOWS):
+    # {days: members who borrowed in the last `days` days}
+    today = today or date.today()
+    counts = {}
+    for days in windows:
+        since = (today - timedelta(days=days - 1)).strftime(DAY_FORMAT)
+        counts[days] = conn.execute("SELECT COUNT(*) FROM circulation_users WHERE last_issued >= ?",
+                                    (since,)).fetchone()[0]
+    return counts
+
+
+def report(conn, start, end, limit=10):
+    days = daily(conn, start, end)
+    return {
+        "from": start.strftime(DAY_FORMAT),
+        "to": end.strftime(DAY_FORMAT),
+        "totals": {"issues": sum(day['issues'] for day in days), "returns": sum(day['returns'] for day in days)},
+        "daily": days,
+        "top_books": top_books(conn, limit),
+        "top_members": top_members(conn, limit),
+        "active_members": active_members(conn),
+    }
@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+from circulation import (immediate_transaction, issue_in_transaction, return_in_transaction, DATE_FORMAT, LOAN_DAYS,
+                         ISSUE, RETURN, INVALID, ISSUED, RETURNED, USER_NOT_FOUND, BOOK_NOT_FOUND)
+from copies import find_copy
+
+
+# Barcode scanner circulation desk. Scanners send what is printed on the
+# book (an ISBN-13/EAN barcode, sometimes with hyphens or spaces) and on the
+# member card (the PA/PSS number). Both are matched through unique indexes
+# on a normalized form of the column (ISBN_KEY, MEMBER_KEY), so every lookup
+# is a single index seek. A copy barcode (copies.py) is matched first and
+# names the exact copy to issue or return. A scan of member plus book is resolved and
+# issued or returned in one BEGIN IMMEDIATE transaction.
+
+ISBN_KEY = "upper(replace(replace(trim(isbn), '-', ''), ' ', ''))"
+MEMBER_KEY = "upper(trim(pa_pss_number))"
+
+# result code for a return scan of a book the member does not have
+NOT_ISSUED = 'not_issued'
+
+
+def isbn_key(code):
+    # the Python twin of ISBN_KEY
+    return (code or "").strip(" ").replace("-", "").replace(" ", "").upper()
+
+
+def member_key(code):
+    # the Python twin of MEMBER_KEY
+    return (code or "").strip(" ").upper()
+
+
+def isbn_variants(code):
+    # the scanned ISBN plus its ISBN-10 / ISBN-13 equivalent, as catalog
+    # records may hold either
+    key = isbn_key(code)
+    variants = [key]
+    if len(key) == 13 and key.startswith("978") and key.isdigit():
+        body = key[3:12]
+        check = (11 - sum((10 - i) * int(digit) for i, digit in enumerate(body)) % 11) % 11
+        variants.append(body + ("X" if check == 10 else str(check)))
+    elif len(key) == 10 and key[:9].isdigit():
+        body = "978" + key[:9]
+        check = (10 - sum(int(digit) * (3 if i % 2 else 1) for i, digit in enumerate(body)) % 10) % 10
+        variants.append(body + str(check))
+    return variants
+
+
+def find_book(conn, code):
+    # by copy barcode (the result then also names the copy) or by ISBN
+    copy = find_copy(conn, code)
+    if copy is not None:
+        row = conn.execute("""
+            SELECT book_id, title, isbn, copies_total, copies_available, status FROM books WHERE book_id = ?
+        """, (copy["book_id"],)).fetchone()
+        return dict(row, copy_id=copy["copy_id"], barcode=copy["barcode"], copy_state=copy["state"]) if row else None
+    variants = isbn_variants(code)
+    if not variants[0]:
+        return None
+    row = conn.execute(f"""
+        SELECT book_id, title, isbn, copies_total, copies_available, status FROM books
+        WHERE {ISBN_KEY} IN ({",".join("?" * len(variants))})
+        ORDER BY book_id LIMIT 1
+    """, variants).fetchone()
+    return dict(row) if row else None
+
+
+def find_member(conn, code):
+    key = member_key(code)
+    if not key:
+        return None
+    row = conn.execute(f"""
+        SELECT user_id, username, pa_pss_number, is_active,
+               (SELECT COUNT(*) FROM users_record WHERE users_record.user_id = users.user_id AND is_returned = 0) AS open_loans
+        FROM users WHERE {MEMBER_KEY} = ? AND is_deleted = 0
+    """, (key,)).fetchone()
+    return dict(row) if row else None
+
+
+def scan(conn, member_code, book_code, action=None, now=None):
+    # issue or return the book for the member in one transaction. action:
+    # "issue", "return" or None to return the book if the member has it out
+    # and issue it otherwise. Returns a compact result dict.
+    if action not in (None, ISSUE, RETURN) or not member_code or not book_code:
+        return {"result": INVALID, "ok": False}
+    now = now or datetime.now()
+    with immediate_transaction(conn):
+        member = conn.execute(f"SELECT user_id FROM users WHERE {MEMBER_KEY} = ? AND is_deleted = 0",
+                              (member_key(member_code),)).fetchone()
+        if member is None:
+            return {"result": USER_NOT_FOUND, "ok": False}
+        book = find_book(conn, book_code)
+        if book is None:
+            return {"result": BOOK_NOT_FOUND, "ok": False, "user_id": member[0]}
+        result = {"user_id": member[0], "book_id": book["book_id"], "title": book["title"]}
+        copy_id = book.get("copy_id")
+        if copy_id is None:
+            open_loan = conn.execute("""
+                SELECT users_record_id FROM users_record
+                WHERE user_id = ? AND book_id = ? AND is_returned = 0
+            """, (member[0], book["book_id"])).fetchone()
+        else:
+            result["copy_id"] = copy_id
+            open_loan = conn.execute("""
+                SELECT users_record_id FROM users_record INDEXED BY idx_users_record_open_copy
+                WHERE copy_id = ? AND user_id = ? AND is_returned = 0
+            """, (copy_id, member[0])).fetchone()
+        if action == RETURN or (action is None and open_loan):
+            if open_loan is None:
+                return {**result, "action": RETURN, "result": NOT_ISSUED, "ok": False}
+            code, _ = return_in_transaction(conn, open_loan[0], now)
+            result.update(action=RETURN, users_record_id=open_loan[0])
+        else:
+            code, users_record_id = issue_in_transaction(conn, member[0], book["book_id"], now, copy_id)
+            result.update(action=ISSUE, users_record_id=users_record_id)
+            if code == ISSUED:
+                result["due_date"] = (now + timedelta(days=LOAN_DAYS)).strftime(DATE_FORMAT)
+        available = conn.execute("SELECT copies_available FROM books WHERE book_id = ?", (book["book_id"],)).fetchone()
+        result.update(result=code, ok=code in (ISSUED, RETURNED), copies_available=available[0])
+    return result
@@ -0,0 +1,46 @@
+import re
+
+
+# Full text index over the catalog. One row per book (rowid = book_id) holding
+# the text of the book and of its author, publisher and genres, so a search is
+# a single FTS5 lookup instead of a LIKE scan over a four-way join. The
+# index, the triggers that keep it current and its bm25 weights are created
+# by migration 2 (migrations.py).
+
+# columns the search form can restrict a search to
+SEARCH_COLUMNS = {"title": "title", "author": "author", "genre": "genres"}
+
+# rebuilds the index rows for every book matching the WHERE clause
+_INDEX_ROWS = """
+    INSERT INTO books_fts (rowid, title, isbn, author, publisher, genres)
+    SELECT b.book_id, b.title, b.isbn, a.name, p.name,
+           (SELECT GROUP_CONCAT(g.genre_name, ' ')
+              FROM book_genres bg JOIN genres g ON g.genre_id = bg.genre_id
+             WHERE bg.book_id = b.book_id)
+    FROM books b
+    LEFT JOIN authors a ON a.author_id = b.author_id
+    LEFT JOIN publishers p ON p.publisher_id = b.publisher_id
+"""
+
+
+def rebuild_search_index(conn):
+    # re-index the whole catalog from the base tables
+    conn.execute("DELETE FROM books_fts")
+    conn.execute(_INDEX_ROWS)
+    conn.execute("INSERT INTO books_fts (books_fts) VALUES ('optimize')")
+    conn.commit()
+    return conn.execute("SELECT COUNT(*) FROM books_fts").fetchone()[0]
+
+
+def match_expression(query, search_by=''):
+    # Turn what the user typed into an FTS5 query: every word must match and
+    # the last characters typed match as a prefix ("tolk" finds "Tolkien").
+    # Returns None when there is nothing searchable in the query.
+    terms = re.findall(r"\w+", query)
+    if not terms:
+        return None
+    expression = " ".join(f'"{term}"*' for term in terms)
+    column = SEARCH_COLUMNS.get(search_by)
+    if column:
+        expression = f"{column} : ({expression})"
+    return expression
@@ -0,0 +1,321 @@
+import csv, io, time
+from datetime import datetime
+from circulation import DATE_FORMAT, immediate_transaction
+from copies import AVAILABLE, ON_LOAN, MISSING, WITHDRAWN
+from scanner import ISBN_KEY, isbn_key, isbn_variants
+
+
+# Stocktake (inventory) sessions. Staff walk the shelves with a scanner and
+# the scans, each an ISBN or a copy barcode plus the shelf it was found on,
+# are stored per session: uploaded as a file or sent in batches to the API.
+# Codes are resolved to copies and books when they arrive, through the
+# barcode and normalized ISBN indexes, one IN query per batch.
+# compare() then diffs the scans against what the catalog expects on the
+# scanned shelves (copies on the shelf, i.e. not on loan or withdrawn) in a
+# handful of set-based statements and writes the outcome to
+# stocktake_results:
+#   found       the copy is where it belongs
+#   misplaced   the copy was scanned on another shelf than its own
+#   missing     a copy expected on a scanned shelf was not scanned anywhere
+#   unexpected  an unknown code, a copy on loan or withdrawn, a copy scanned
+#               twice or more copies of a book than the catalog has
+# A scanned ISBN does not say which copy it is, so ISBN scans take the copies
+# of that book left over by the barcode scans: copies of the same shelf
+# first, then copies belonging elsewhere.
+
+BATCH_SIZE = 5000
+MAX_API_SCANS = 5000
+FETCH_SIZE = 1000
+FOUND, MISPLACED, MISSING_COPY, UNEXPECTED = "found", "misplaced", "missing", "unexpected"
+KINDS = (MISSING_COPY, MISPLACED, UNEXPECTED, FOUND)
+REPORT_COLUMNS = ("kind", "reason", "shelf_number", "expected_shelf", "code", "barcode", "book_id", "title", "isbn")
+
+
+def create_session(conn, name):
+    with immediate_transaction(conn):
+        return conn.execute("INSERT INTO stocktake_sessions (name, started_at) VALUES (?, ?)",
+                            (name, datetime.now().strftime(DATE_FORMAT))).lastrowid
+
+
+def get_session(conn, session_id):
+    row = conn.execute("SELECT * FROM stocktake_sessions WHERE session_id = ?", (session_id,)).fetchone()
+    return dict(row, stale=(row['compared_scans'] or 0) != row['scans']) if row else None
+
+
+def list_sessions(conn, limit=50):
+    return conn.execute("SELECT * FROM stocktake_sessions ORDER BY session_id DESC LIMIT ?", (limit,)).fetchall()
+
+
+def read_scans(stream, shelf=None):
+    # yields (line number, shelf, code) from a scanner file: one code per
+    # line, "SHELF <number>" lines switch the shelf, or "shelf,code" rows
+    # (a "shelf,code" header row is skipped). shelf: the shelf until the
+    # file names one.
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line or line.lower().replace(" ", "") == "shelf,code":
+            continue
+        if line.upper().startswith("SHELF"):
+            shelf = line[5:].strip(" :=\t") or None
+            continue
+        if "," in line:
+            row_shelf, code = (part.strip() for part in line.split(",", 1))
+            yield line_number, row_shelf or shelf, code
+        else:
+            yield line_number, shelf, line
+
+
+def _resolve(conn, codes):
+    # {code: (copy_id, book_id)} for the codes that are copy barcodes or ISBNs
+    resolved = {}
+    keys = {code: isbn_key(code) for code in codes}
+    barcodes = list(set(keys.values()))
+    for row in conn.execute(f"""
+            SELECT copy_id, book_id, barcode FROM book_copies
+            WHERE barcode IN ({",".join("?" * len(barcodes))})""", barcodes).fetchall():
+        resolved[row[2]] = (row[0], row[1])
+    variants = {code: isbn_variants(code) for code, key in keys.items() if key not in resolved}
+    books = {}
+    wanted = list({variant for found in variants.values() for variant in found})
+    if wanted:
+        for row in conn.execute(f"""
+                SELECT {ISBN_KEY}, MIN(book_id) FROM books
+                WHERE {ISBN_KEY} IN ({",".join("?" * len(wanted))}) GROUP BY 1""", wanted).fetchall():
+            books[row[0]] = row[1]
+    result = {}
+    for code, key in keys.items():
+        if key in resolved:
+            result[code] = resolved[key]
+        else:
+            book_id = next((books[variant] for variant in variants[code] if variant in books), None)
+            if book_id is not None:
+                result[code] = (None, book_id)
+    return result
+
+
+def _write_batch(conn, session_id, batch, scanned_at):
+    with immediate_transaction(conn):
+        resolved = _resolve(conn, {code for _, code in batch})
+        conn.executemany("""
+            INSERT INTO stocktake_scans (session_id, shelf_number, code, copy_id, book_id, scanned_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(session_id, shelf, code, *resolved.get(code, (None, None)), scanned_at) for shelf, code in batch])
+        conn.execute("UPDATE stocktake_sessions SET scans = scans + ? WHERE session_id = ?", (len(batch), session_id))
+    return sum(1 for _, code in batch if code not in resolved)
+
+
+def add_scans(conn, session_id, scans, batch_size=BATCH_SIZE):
+    # scans: iterable of (line number or index, shelf, code); written in
+    # batched transactions. Raises ValueError for an unknown or closed
+    # session. Returns a report like the catalog import's.
+    session = get_session(conn, session_id)
+    if session is None:
+        raise ValueError("Stocktake session not found.")
+    if session['closed_at']:
+        raise ValueError("This stocktake session is closed.")
+    started = time.perf_counter()
+    scanned_at = datetime.now().strftime(DATE_FORMAT)
+    added, unknown, rejects, batch = 0, 0, [], []
+    for line_number, shelf, code in scans:
+        shelf, code = str(shelf or "").strip(), str(code or "").strip()
+        if not shelf or not code:
+            rejects.append((line_number, "missing shelf" if code else "missing code"))
+            continue
+        batch.append((shelf, code))
+        if len(batch) >= batch_size:
+            unknown += _write_batch(conn, session_id, batch, scanned_at)
+            added, batch = added + len(batch), []
+    if batch:
+        unknown += _write_batch(conn, session_id, batch, scanned_at)
+        added += len(batch)
+    return {"scans": added, "unknown": unknown, "rejected": len(rejects), "rejects": rejects,
+            "seconds": round(time.perf_counter() - started, 3)}
+
+
+def _claimed():
+    # copies not yet accounted for by this session's results
+    return "copy_id NOT IN (SELECT copy_id FROM stocktake_results WHERE session_id = :session AND copy_id IS NOT NULL)"
+
+
+def compare(conn, session_id):
+    # rewrite the session's results from its scans in one transaction;
+    # returns the summary
+    params = {"session": session_id}
+    started = time.perf_counter()
+    with immediate_transaction(conn):
+        conn.execute("DELETE FROM stocktake_results WHERE session_id = :session", params)
+
+        # copy barcodes name the copy: it is found, misplaced or should not be on a shelf
+        conn.execute(f"""
+            INSERT INTO stocktake_results (session_id, kind, reason, scan_id, copy_id, book_id, shelf_number, expected_shelf)
+            SELECT :session,
+                   CASE WHEN scan.seen > 1 OR copy.state IN ('{ON_LOAN}', '{WITHDRAWN}') THEN '{UNEXPECTED}'
+                        WHEN copy.shelf_number IS NOT scan.shelf_number THEN '{MISPLACED}'
+                        ELSE '{FOUND}' END,
+                   CASE WHEN scan.seen > 1 THEN 'scanned twice'
+                        WHEN copy.state = '{ON_LOAN}' THEN 'on loan'
+                        WHEN copy.state = '{WITHDRAWN}' THEN 'withdrawn'
+                        WHEN copy.state = '{MISSING}' THEN 'was marked missing' END,
+                   scan.scan_id, CASE WHEN scan.seen = 1 THEN scan.copy_id END, scan.book_id,
+                   scan.shelf_number, copy.shelf_number
+            FROM (SELECT scan_id, copy_id, book_id, shelf_number,
+                         ROW_NUMBER() OVER (PARTITION BY copy_id ORDER BY scan_id) AS seen
+                  FROM stocktake_scans INDEXED BY idx_stocktake_scans_session
+                  WHERE session_id = :session AND copy_id IS NOT NULL) AS scan
+            JOIN book_copies AS copy ON copy.copy_id = scan.copy_id
+        """, params)
+
+        # ISBN scans take the copies of their book left over: same shelf first
+        conn.execute("DROP TABLE IF EXISTS temp.stocktake_isbn")
+        conn.execute("DROP TABLE IF EXISTS temp.stocktake_candidates")
+        conn.execute("""
+            CREATE TEMP TABLE stocktake_isbn AS
+            SELECT scan_id, book_id, shelf_number FROM stocktake_scans INDEXED BY idx_stocktake_scans_session
+            WHERE session_id = :session AND copy_id IS NULL AND book_id IS NOT NULL
+        """, params)
+        conn.execute(f"""
+            CREATE TEMP TABLE stocktake_candidates AS
+            SELECT copy_id, book_id, shelf_number, state,
+                   shelf_number IN (SELECT shelf_number FROM stocktake_scans WHERE session_id = :session) AS in_scope
+            FROM book_copies
+            WHERE book_id IN (SELECT book_id FROM temp.stocktake_isbn)
+              AND state IN ('{AVAILABLE}', '{MISSING}') AND {_claimed()}
+        """, params)
+        conn.execute(f"""
+            INSERT INTO stocktake_results (session_id, kind, reason, scan_id, copy_id, book_id, shelf_number, expected_shelf)
+            SELECT :session, '{FOUND}', CASE WHEN copy.state = '{MISSING}' THEN 'was marked missing' END,
+                   scan.scan_id, copy.copy_id, scan.book_id, scan.shelf_number, copy.shelf_number
+            FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY book_id, shelf_number ORDER BY scan_id) AS n
+                  FROM temp.stocktake_isbn) AS scan
+            JOIN (SELECT *, ROW_NUMBER() OVER (PARTITION BY book_id, shelf_number
+                                               ORDER BY state <> '{AVAILABLE}', copy_id) AS n
+                  FROM temp.stocktake_candidates) AS copy
+              ON copy.book_id = scan.book_id AND copy.shelf_number = scan.shelf_number AND copy.n = scan.n
+        """, params)
+        # then copies belonging elsewhere, preferring ones that would
+        # otherwise be reported missing from a scanned shelf
+        conn.execute(f"""
+            INSERT INTO stocktake_results (session_id, kind, reason, scan_id, copy_id, book_id, shelf_number, expected_shelf)
+            SELECT :session, '{MISPLACED}', CASE WHEN copy.state = '{MISSING}' THEN 'was marked missing' END,
+                   scan.scan_id, copy.copy_id, scan.book_id, scan.shelf_number, copy.shelf_number
+            FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY book_id ORDER BY scan_id) AS n
+                  FROM temp.stocktake_isbn
+                  WHERE scan_id NOT IN (SELECT scan_id FROM stocktake_results WHERE session_id = :session)) AS scan
+            JOIN (SELECT *, ROW_NUMBER() OVER (PARTITION BY book_id
+                                               ORDER BY in_scope DESC, state <> '{AVAILABLE}', copy_id) AS n
+                  FROM temp.stocktake_candidates WHERE {_claimed()}) AS copy
+              ON copy.book_id = scan.book_id AND copy.n = scan.n
+        """, params)
+        conn.execute(f"""
+            INSERT INTO stocktake_results (session_id, kind, reason, scan_id, book_id, shelf_number)
+            SELECT :session, '{UNEXPECTED}',
+                   CASE WHEN book_id IS NULL OR copy_id IS NOT NULL THEN 'unknown code'
+                        ELSE 'more copies than catalogued' END,
+                   scan_id, book_id, shelf_number
+            FROM stocktake_scans INDEXED BY idx_stocktake_scans_session
+            WHERE session_id = :session
+              AND scan_id NOT IN (SELECT scan_id FROM stocktake_results WHERE session_id = :session)
+        """, params)
+        conn.execute("DROP TABLE temp.stocktake_isbn")
+        conn.execute("DROP TABLE temp.stocktake_candidates")
+
+        # expected holdings of the scanned shelves that nothing accounted for
+        conn.execute(f"""
+            INSERT INTO stocktake_results (session_id, kind, reason, copy_id, book_id, shelf_number, expected_shelf)
+            SELECT :session, '{MISSING_COPY}', CASE WHEN state = '{MISSING}' THEN 'already marked missing' END,
+                   copy_id, book_id, shelf_number, shelf_number
+            FROM book_copies INDEXED BY idx_book_copies_shelf_state
+            WHERE shelf_number IN (SELECT shelf_number FROM stocktake_scans INDEXED BY idx_stocktake_scans_session
+                                   WHERE session_id = :session)
+              AND state IN ('{AVAILABLE}', '{MISSING}') AND {_claimed()}
+        """, params)
+        conn.execute("""
+            UPDATE stocktake_sessions SET compared_at = ?, compared_scans = scans WHERE session_id = ?
+        """, (datetime.now().strftime(DATE_FORMAT), session_id))
+    return dict(summary(conn, session_id), seconds=round(time.perf_counter() - started, 3))
+
+
+def summary(conn, session_id):
+    counts = dict(conn.execute("""
+        SELECT kind, COUNT(*) FROM stocktake_results WHERE session_id = ? GROUP BY kind
+    """, (session_id,)).fetchall())
+    shelves = conn.execute("SELECT COUNT(DISTINCT shelf_number) FROM stocktake_scans WHERE session_id = ?",
+                           (session_id,)).fetchone()[0]
+    return {"session_id": session_id, "shelves": shelves, **{kind: counts.get(kind, 0) for kind in KINDS}}
+
+
+def shelf_summary(conn, session_id):
+    # one row per shelf with the count of each kind
+    return conn.execute(f"""
+        SELECT shelf_number, {", ".join(f"SUM(kind = '{kind}') AS {kind}" for kind in KINDS)}
+        FROM stocktake_results WHERE session_id = ?
+        GROUP BY shelf_number ORDER BY shelf_number
+    """, (session_id,)).fetchall()
+
+
+REPORT_QUERY = """
+    SELECT stocktake_results.result_id, stocktake_results.kind, stocktake_results.reason,
+           stocktake_results.shelf_number, stocktake_results.expected_shelf, stocktake_scans.code,
+           book_copies.barcode, stocktake_results.book_id, books.title, books.isbn
+    FROM stocktake_results INDEXED BY idx_stocktake_results_session
+    LEFT JOIN stocktake_scans ON stocktake_scans.scan_id = stocktake_results.scan_id
+    LEFT JOIN book_copies ON book_copies.copy_id = stocktake_results.copy_id
+    LEFT JOIN books ON books.book_id = stocktake_results.book_id
+"""
+
+
+def report(conn, session_id, kind=None, after=0, limit=200):
+    # results by kind and shelf; after: result_id keyset cursor
+    kinds = [kind] if kind else list(KINDS)
+    return conn.execute(f"""
+        {REPORT_QUERY}
+        WHERE stocktake_results.session_id = ? AND stocktake_results.kind IN ({",".join("?" * len(kinds))})
+          AND stocktake_results.result_id > ?
+        ORDER BY stocktake_results.result_id
+        LIMIT ?
+    """, (session_id, *kinds, after, limit)).fetchall()
+
+
+def report_csv(conn, session_id, kind=None):
+    # yields the full report as CSV chunks of FETCH_SIZE rows
+    kinds = [kind] if kind else list(KINDS)
+    cursor = conn.execute(f"""
+        {REPORT_QUERY}
+        WHERE stocktake_results.session_id = ? AND stocktake_results.kind IN ({",".join("?" * len(kinds))})
+        ORDER BY stocktake_results.kind, stocktake_results.shelf_number, stocktake_results.result_id
+    """, (session_id, *kinds))
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(REPORT_COLUMNS)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        writer.writerows([row[column] for column in REPORT_COLUMNS] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def close_session(conn, session_id, apply=False):
+    # compare once more and close the session. apply: mark copies reported
+    # missing as missing and copies found again as available (the counters
+    # follow, see copies.py). Returns the summary.
+    result = compare(conn, session_id)
+    with immediate_transaction(conn):
+        if apply:
+            conn.execute(f"""
+                UPDATE book_copies SET state = '{MISSING}'
+                WHERE state = '{AVAILABLE}' AND copy_id IN (
+                    SELECT copy_id FROM stocktake_results WHERE session_id = ? AND kind = '{MISSING_COPY}')
+            """, (session_id,))
+            conn.execute(f"""
+                UPDATE book_copies SET state = '{AVAILABLE}'
+                WHERE state = '{MISSING}' AND copy_id IN (
+                    SELECT copy_id FROM stocktake_results WHERE session_id = ? AND kind IN ('{FOUND}', '{MISPLACED}'))
+            """, (session_id,))
+        conn.execute("UPDATE stocktake_sessions SET closed_at = ? WHERE session_id = ?",
+                     (datetime.now().strftime(DATE_FORMAT), session_id))
+    return result
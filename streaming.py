@@ -0,0 +1,19 @@
+from flask import current_app
+from markupsafe import Markup
+
+
+# Bounded page windows for the large listing pages (books, users, users
+# record). A page shows at most MAX_PAGE_SIZE rows (see pagination.py) and
+# the rows are rendered as they are read from the cursor (Pager.iterate), so
+# the worker holds the HTML of one page window, never the whole result set.
+# The pages are rendered with render_template inside the request, so the
+# pooled connection goes back at teardown like for any other page.
+
+
+def stream_fragment(template, **context):
+    # a template rendered piece by piece, so a fragment_cache miss reads its
+    # rows while rendering; the page outputs it with
+    # {% for chunk in fragment %}{{ chunk }}{% endfor %}
+    current_app.update_template_context(context)
+    for chunk in current_app.jinja_env.get_template(template).generate(context):
+        yield Markup(chunk)
@@ -0,0 +1,75 @@
+# Prefix search for the member and book pickers on /issue_book. Each column
+# is searched as an index range (prefix <= value < prefix with its last
+# character bumped) and stops after `limit` rows, so a lookup is an index
+# seek whatever the size of the tables.
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+
+
+def prefix_range(prefix):
+    # (low, high) such that value starts with prefix <=> low <= value < high
+    last = prefix[-1]
+    if ord(last) >= 0x10FFFF:
+        return prefix, prefix + "\U0010FFFF"
+    return prefix, prefix[:-1] + chr(ord(last) + 1)
+
+
+def clamp_limit(value):
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_LIMIT
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def search_users(conn, query, limit=DEFAULT_LIMIT):
+    # active members whose name or PA/PSS number starts with query
+    query = (query or "").strip()
+    if not query:
+        return []
+    low, high = prefix_range(query)
+    rows = conn.execute("""
+        SELECT user_id, username, pa_pss_number FROM (
+            SELECT * FROM (
+                SELECT user_id, username, pa_pss_number FROM users
+                WHERE username >= :low COLLATE NOCASE AND username < :high COLLATE NOCASE AND is_deleted = 0
+                ORDER BY username COLLATE NOCASE LIMIT :limit)
+            UNION
+            SELECT * FROM (
+                SELECT user_id, username, pa_pss_number FROM users
+                WHERE pa_pss_number >= :low COLLATE NOCASE AND pa_pss_number < :high COLLATE NOCASE AND is_deleted = 0
+                ORDER BY pa_pss_number COLLATE NOCASE LIMIT :limit)
+        )
+        ORDER BY username COLLATE NOCASE, user_id
+        LIMIT :limit
+    """, {"low": low, "high": high, "limit": limit}).fetchall()
+    return [{"user_id": row[0], "username": row[1], "pa_pss_number": row[2]} for row in rows]
+
+
+def search_books(conn, query, limit=DEFAULT_LIMIT, available_only=False):
+    # books whose title or ISBN starts with query
+    query = (query or "").strip()
+    if not query:
+        return []
+    low, high = prefix_range(query)
+    available = "AND copies_available > 0" if available_only else ""
+    rows = conn.execute(f"""
+        SELECT matches.book_id, matches.title, matches.isbn, matches.copies_available, authors.name
+        FROM (
+            SELECT * FROM (
+                SELECT book_id, title, isbn, copies_available, author_id FROM books
+                WHERE title >= :low COLLATE NOCASE AND title < :high COLLATE NOCASE {available}
+                ORDER BY title COLLATE NOCASE LIMIT :limit)
+            UNION
+            SELECT * FROM (
+                SELECT book_id, title, isbn, copies_available, author_id FROM books
+                WHERE isbn >= :low AND isbn < :high {available}
+                ORDER BY isbn LIMIT :limit)
+        ) AS matches
+        LEFT JOIN authors ON authors.author_id = matches.author_id
+        ORDER BY matches.title COLLATE NOCASE, matches.book_id
+        LIMIT :limit
+    """, {"low": low, "high": high, "limit": limit}).fetchall()
+    return [{"book_id": row[0], "title": row[1], "isbn": row[2], "copies_available": row[3], "author": row[4]}
+            for row in rows]